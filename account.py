@@ -1,30 +1,52 @@
 import os
 import time
-import json
+from math import ceil
 from utils import start_logger
 from typing import List
 from datetime import datetime
-from td.client import TDClient
 from options import Instrument
-from utils import get_param
+from portfolio import select_portfolio
+from utils import get_param, RateLimiter, write_atomic
 import logging
 
 logger = start_logger("account")
 
 class Watchlist:
 
-    def __init__(self, client, name, remote=True):
+    def __init__(self, client, name, remote=True, quotes=None, chains=None, order=None):
+        """
+        name is the TDA watchlist name for remote watchlists, or the path to a file of symbols for local ones.
+        Local watchlists can instead be given quotes (symbol -> TDA quote, see get_quotes) to scan just those symbols.
+        chains (symbol -> OptionChain) are used instead of pulling those symbols again. order is a sort key for the
+        symbols: they're pulled in that order, but still listed in the watchlist's own
+        """
         self.td_client = client
+        self.chains = chains or {}
+        self.order = order
         self.instruments = {'EQUITY': [], 'ETF': []}
         self.raw = None
+        self.strategies = None
 
         if not remote:
-            with open(name) as local_watchlist:
-                symbols = local_watchlist.read().strip().split('\n')
-                for symbol in symbols:
-                    processed = Instrument(self.td_client, symbol)
-                    self.instruments['EQUITY'].append(processed)
-                    time.sleep(.6)
+            self.name = name
+
+            if quotes is not None:
+                symbols = list(quotes)
+            else:
+                quotes = {}
+                with open(name) as local_watchlist:
+                    symbols = local_watchlist.read().strip().split('\n')
+
+            rate_limiter = RateLimiter.from_params()
+            processed = {}
+            for symbol in (sorted(symbols, key=order) if order else symbols):
+                chain = self.chains.get(symbol)
+                if chain is None:
+                    rate_limiter.wait()
+
+                processed[symbol] = Instrument(self.td_client, symbol, quote=quotes.get(symbol), chain=chain)
+
+            self.instruments['EQUITY'] = [processed[symbol] for symbol in symbols]
 
         else:
 
@@ -56,20 +78,19 @@ class Watchlist:
         os.makedirs(out_dir, exist_ok=True)
         dt = datetime.strftime(datetime.now(), "%d %b %Y %I-%M-%S")
         filename = "%s %s.json" % (title, dt)
-        out_path = os.path.join(out_dir, filename)
-        outfile = open(out_path, 'w')
-
-        outfile.write(json.dumps(data))
-        outfile.close()
+        write_atomic(os.path.join(out_dir, filename), data)
 
-    def write_strikes_json(self):
+    def strike_dicts(self):
         strikes = []
         for instrument in self.instruments['EQUITY']:
             for expiration in instrument.strike_dict():
                 for strike in expiration:
                     strikes.append(strike)
 
-        self._write("options-chain", strikes)
+        return strikes
+
+    def write_strikes_json(self):
+        self._write("options-chain", self.strike_dicts())
 
     def write_quotes(self):
         quotes = []
@@ -144,62 +165,235 @@ class Watchlist:
             # rate delay is .1 in microseconds
             rate_delay = 500000
 
-        for item in raw_watchlist['watchlistItems']:
-            instrument_dict = item['instrument']
-            instrument_type = instrument_dict['assetType']
-            symbol = instrument_dict['symbol']
+        items = raw_watchlist['watchlistItems']
+        if self.order:
+            items = sorted(items, key=lambda item: self.order(item['instrument']['symbol']))
+
+        processed = {}
+        for item in items:
+            symbol = item['instrument']['symbol']
 
             start = datetime.now()
-            instrument = Instrument(self.td_client, symbol)
+            instrument = Instrument(self.td_client, symbol, chain=self.chains.get(symbol))
             end = datetime.now()
             elapsed = (end - start).microseconds
-            if elapsed < rate_delay:
+            if elapsed < rate_delay and symbol not in self.chains:
                 time.sleep(.5)
 
+            processed[symbol] = instrument
+
+        for item in raw_watchlist['watchlistItems']:
+            instrument = processed[item['instrument']['symbol']]
             if instrument.quote:
-                self.instruments[instrument_type].append(instrument)
+                self.instruments[item['instrument']['assetType']].append(instrument)
 
     def analyze_strategies(self):
+        # the chains don't change once the watchlist is pulled, so the spreads are only analyzed once
+        # and shared by every output (json, excel, portfolio)
+        if self.strategies is not None:
+            return self.strategies
+
+        time_spreads = get_param('time spreads')
+
         spreads = []
         for instrument in self.all():
             logger.info("Analyzing symbol: %s" % instrument)
-            put_spreads = instrument.analyze_PCS()
-            call_spreads = instrument.analyze_CCS()
-            spreads.append(put_spreads)
-            spreads.append(call_spreads)
+            spreads.extend(analyze_instrument(instrument, time_spreads))
 
+        self.strategies = spreads
         return spreads
 
+    def accepted_spreads(self) -> list:
+        """
+        Every spread with a score above 0 as VertSpread instances, across all instruments and expirations
+        """
+        accepted = []
+        for instrument in self.analyze_strategies():
+            for spreads in instrument.values():
+                accepted.extend(spread for spread in spreads if spread.score > 0)
+
+        return accepted
+
+    def get_portfolio(self) -> list:
+        """
+        The score maximizing set of accepted spreads within "max total risk". See portfolio.py
+        """
+        return select_portfolio(self.accepted_spreads())
+
+
+def analyze_instrument(instrument, time_spreads=None) -> list:
+    """
+    Every strategy for one instrument. Each is a dict of expiration date -> spreads, in the order the outputs list them
+    """
+    if time_spreads is None:
+        time_spreads = get_param('time spreads')
+
+    # credit spreads are only worth selling when IV is rich compared to earlier scans. No history yet passes
+    min_percentile = get_param('min iv percentile') or 0
+    percentile = instrument.volatility.iv_percentile if instrument.volatility else None
+
+    if min_percentile and percentile is not None and percentile < min_percentile:
+        logger.info("Skipping credit spreads for %s, IV percentile %s" % (instrument, percentile))
+        strategies = [{}, {}]
+    else:
+        strategies = [instrument.analyze_PCS(), instrument.analyze_CCS()]
+
+    # calendars and diagonals
+    if time_spreads:
+        strategies.append(instrument.analyze_time_spreads())
+
+    return strategies
+
+
+def accepted_dicts(strategies: list) -> list:
+    """
+    The spreads get_spreads would output for these strategies (see analyze_instrument), as dicts
+    """
+    accepted = []
+    for strategy in strategies:
+        for spreads in strategy.values():
+            accepted.extend(spread.to_dict() for spread in spreads if spread.score > 0)
+
+    return accepted
+
 
 class TDAuth:
 
-    def __init__(self):
+    def __init__(self, keep_alive=False, priority=None):
+        """
+        keep_alive is for processes that hold on to one TDAuth for their whole life (hunterd). The access token is
+        then refreshed in the background before it expires instead of by whichever call finds it stale
+
+        priority is the client's place in line for the shared api budget with "rate budget" on (ratebudget.LIVE or
+        ratebudget.BATCH, the default)
+        """
+        # imported here so the td package is only loaded by commands that talk to TDA
+        from transport import PooledTDClient
+        from ratebudget import RateBudget, BATCH, budget_enabled
+
         client_file = open('tda.txt', 'r')
         client_id = client_file.read().strip()
         client_file.close()
 
         # Create a new session, credentials path is optional.
-        self.td_client = TDClient(
+        # every call goes through one pooled, keep-alive http session
+        self.td_client = PooledTDClient(
             client_id=client_id,
             redirect_uri='http://localhost',
-            credentials_path='creds.txt'
+            credentials_path='creds.txt',
+            rate_budget=RateBudget(BATCH if priority is None else priority) if budget_enabled() else None
         )
 
         # Login to the session
         self.td_client.login()
 
+        if keep_alive:
+            self.td_client.start_refresher()
+
+    def close(self):
+        self.td_client.close()
+
     def get_account_id(self):
         accounts = self.td_client.get_accounts()
         account_id = accounts[0]['securitiesAccount']['accountId']
         return account_id
 
 
-def get_watchlist(options=None, process_market=False):
-    # initialize connection with TD ameritrade account
-    td_client = TDAuth()
+def get_quotes(client, symbols: list, batch_size: int = None) -> dict:
+    """
+    Pulls quotes for a lot of symbols with as few calls as possible. TDA takes hundreds of symbols per quotes call
+
+    :return: dict of symbol -> TDA quote
+    """
+    if batch_size is None:
+        batch_size = get_param('quote batch size')
+
+    rate_limiter = RateLimiter.from_params()
+
+    quotes = {}
+    for i in range(0, len(symbols), batch_size):
+        rate_limiter.wait()
+        batch = symbols[i:i + batch_size]
+        quotes.update(client.get_quotes(instruments=batch) or {})
+
+    logger.info("Pulled %s quotes for %s symbols in %s calls" % (len(quotes), len(symbols),
+                                                                ceil(len(symbols) / batch_size)))
+    return quotes
+
+
+def screen_quotes(quotes: dict) -> dict:
+    """
+    First pass of a market scan. Drops symbols that can't have acceptable spreads before any chains are pulled:
+        - price outside "market scan min price" and "market scan max price"
+        - volume below "market scan min volume"
+        - not optionable. The quotes don't say this directly, so only listed, marginable, non-halted
+          equities and ETFs are kept. Nearly all optionable underlyings pass that test and OTC/pink sheet names don't
+    """
+    min_price = get_param('market scan min price') or 0
+    max_price = get_param('market scan max price') or float('inf')
+    min_volume = get_param('market scan min volume') or 0
+
+    screened = {}
+    for symbol, quote in quotes.items():
+        if quote.get('assetType') not in ('EQUITY', 'ETF'):
+            continue
+
+        if quote.get('exchangeName') in ('PINK', 'OTC', 'OTCBB') or quote.get('securityStatus') == 'Halted':
+            continue
+
+        if not quote.get('marginable'):
+            continue
+
+        if not min_price <= (quote.get('lastPrice') or 0) <= max_price:
+            continue
+
+        if (quote.get('totalVolume') or 0) < min_volume:
+            continue
+
+        screened[symbol] = quote
+
+    logger.info("%s of %s symbols passed the quote screen" % (len(screened), len(quotes)))
+    return screened
+
+
+def watchlist_symbols(options, td_auth=None) -> list:
+    """
+    Symbols of the -l/-r/-t watchlist in the order a Watchlist would scan them (equities, then ETFs), without
+    pulling any chains. Only remote watchlists need a TDA connection
+    """
+    if options.remote:
+        td_client = (td_auth or TDAuth()).td_client
+        name = get_param('remote watchlist')
+
+        for watchlist in td_client.get_watchlist_accounts('all'):
+            if watchlist['name'] == name:
+                raw = td_client.get_watchlist(account=watchlist['accountId'], watchlist_id=watchlist['watchlistId'])
+                items = [item['instrument'] for item in raw['watchlistItems']]
+
+                return [item['symbol'] for asset_type in ('EQUITY', 'ETF') for item in items
+                        if item['assetType'] == asset_type]
+
+        logger.warning("No watchlist found: %s" % name)
+        return []
+
+    name = get_param('local watchlist') if options.local else get_param('test watchlist')
+    with open(name) as local_watchlist:
+        return local_watchlist.read().strip().split('\n')
+
+
+def get_watchlist(options=None, process_market=False, td_auth=None, chains=None, order=None):
+    # initialize connection with TD ameritrade account, unless the caller is holding on to one
+    td_client = td_auth or TDAuth()
 
     if process_market:
-        return Watchlist(td_client.td_client, "watchlists/all-symbols.txt", remote=False)
+        # phase one: batch quote every symbol in the market and screen out the ones not worth a chain
+        with open("watchlists/all-symbols.txt") as all_symbols:
+            symbols = all_symbols.read().split()
+
+        quotes = screen_quotes(get_quotes(td_client.td_client, symbols))
+
+        # phase two: only pull chains for the symbols that are left
+        return Watchlist(td_client.td_client, "watchlists/all-symbols.txt", remote=False, quotes=quotes)
 
     else:
         # get the local or remote watchlist name
@@ -211,7 +405,6 @@ def get_watchlist(options=None, process_market=False):
             watchlist_name = get_param('test watchlist')
 
         # pull the local or remote watchlist and get option chains for each symbol
-        watchlist = Watchlist(td_client.td_client, watchlist_name, remote=options.remote)
+        watchlist = Watchlist(td_client.td_client, watchlist_name, remote=options.remote, chains=chains, order=order)
 
         return watchlist
-
@@ -15,3 +15,11 @@ This will need a few componets to work:
     1) write trading logic
     2) have factory return 
 """
+
+
+def select_trades(watchlist):
+    """
+    2) criteria to select trades. Takes the score maximizing set of accepted spreads that fits in "max total risk"
+    (see portfolio.py) so the trader never opens more risk than the budget allows
+    """
+    return watchlist.get_portfolio()
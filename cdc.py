@@ -0,0 +1,132 @@
+"""
+Change data capture for the analyzed spreads.
+
+Most spreads are the same from one run to the next, so instead of writing (or indexing) every accepted spread each
+cycle, SpreadChangeLog keeps a fingerprint of each spread from the last run and only emits what changed:
+
+    {
+        "run": 42,
+        "timestamp": "2020-08-21T10:05:00",
+        "snapshot": false,
+        "inserts": [<spread dict>, ...],     # spreads that weren't accepted last run
+        "updates": [<spread dict>, ...],     # same legs, different credit or score
+        "removals": [<spread key>, ...],     # accepted last run, not this run
+        "spreads": [<spread dict>, ...]      # every accepted spread. Only in snapshots
+    }
+
+Every "cdc snapshot every" runs (and whenever there's no previous state) the record is a full snapshot so a consumer
+can start from it without replaying every change before it. Each spread dict gets a "Key" field that identifies its
+legs across runs.
+"""
+import os
+import json
+from datetime import datetime
+from utils import get_param, start_logger
+
+logger = start_logger("cdc")
+
+STATE_DIR = "out-data/cdc-state"
+
+
+def spread_key(spread: dict) -> str:
+    # the legs of the spread. Stays the same from run to run while the prices move
+    key = "%s %s %s %s/%s" % (spread["Symbol"], spread["Type"], spread["Expiration Date"], spread["S. Strike"],
+                              spread["L. Strike"])
+
+    # calendars and diagonals also need the long leg's expiration
+    long_expiration = spread.get("L. Expiration Date", spread["Expiration Date"])
+    if long_expiration != spread["Expiration Date"]:
+        key += " " + long_expiration
+
+    return key
+
+
+def spread_fingerprint(spread: dict) -> str:
+    return "%s:%s" % (spread["Net Credit"], spread["Score"])
+
+
+class SpreadChangeLog:
+
+    def __init__(self, name: str, snapshot_every: int = None):
+        """
+        name keeps the state of each consumer (raw json, elastic, ...) separate so they can't get out of step
+        """
+        self.name = name
+        self.state_path = os.path.join(STATE_DIR, "%s.json" % name)
+
+        if snapshot_every is None:
+            snapshot_every = get_param('cdc snapshot every') or 1
+        self.snapshot_every = snapshot_every
+
+        self.run = 0
+        self.fingerprints = None
+        self.load()
+
+    def load(self) -> None:
+        if not os.path.exists(self.state_path):
+            return
+
+        with open(self.state_path) as state_file:
+            state = json.load(state_file)
+
+        self.run = state["run"]
+        self.fingerprints = state["fingerprints"]
+
+    def save(self) -> None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+
+        # write then rename so a crash mid-write can't leave a half written state behind
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w') as state_file:
+            json.dump({"run": self.run, "fingerprints": self.fingerprints}, state_file)
+
+        os.replace(tmp_path, self.state_path)
+
+    def changes(self, spreads: list) -> dict:
+        """
+        Compares this run's spreads to the last run's and returns the change record. Call save() once the record
+        has been written out. If that never happens the same changes are emitted again next run
+        """
+        previous = self.fingerprints
+        self.run += 1
+
+        snapshot = previous is None or self.run % self.snapshot_every == 0
+        if previous is None:
+            previous = {}
+
+        fingerprints = {}
+        inserts = []
+        updates = []
+
+        for spread in spreads:
+            key = spread_key(spread)
+            fingerprint = spread_fingerprint(spread)
+
+            spread["Key"] = key
+            fingerprints[key] = fingerprint
+
+            if key not in previous:
+                inserts.append(spread)
+            elif previous[key] != fingerprint:
+                updates.append(spread)
+
+        removals = [key for key in previous if key not in fingerprints]
+
+        record = {
+            "run": self.run,
+            "timestamp": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            "snapshot": snapshot,
+            "inserts": inserts,
+            "updates": updates,
+            "removals": removals
+        }
+
+        if snapshot:
+            record["spreads"] = spreads
+
+        self.fingerprints = fingerprints
+
+        logger.info("CDC run %s for %s: %s inserts, %s updates, %s removals%s" % (
+            self.run, self.name, len(inserts), len(updates), len(removals), " (snapshot)" if snapshot else ""))
+
+        return record
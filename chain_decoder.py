@@ -0,0 +1,179 @@
+"""
+Decodes TDA option chain responses straight into an OptionChain.
+
+Chains for big underlyings are megabytes of nested putExpDateMap/callExpDateMap json. Instead of decoding the whole
+response into dicts and then copying those into OptionStrike objects, the response is read as a stream and each
+strike is handed to the chain as soon as it has been parsed. The json backend is picked with the "json backend"
+parameter in parameters.txt:
+
+    auto   - ijson if it is installed, otherwise the fastest full decoder available (default)
+    ijson  - incremental parsing. Only one strike is held as a dict at a time
+    orjson, ujson, json - decode the full response with that library, then walk it one expiration at a time,
+             dropping each expiration's dicts once its strikes have been built
+"""
+from utils import get_param, start_logger
+
+logger = start_logger("chain_decoder")
+
+EXP_DATE_MAPS = ('putExpDateMap', 'callExpDateMap')
+
+FULL_DECODERS = ('orjson', 'ujson', 'json')
+
+
+def get_backend(name=None):
+    """
+    Returns (name, module) for the json backend to use. Unavailable backends fall through to the next best one
+    """
+    if name is None:
+        name = get_param('json backend') or 'auto'
+
+    candidates = ('ijson',) + FULL_DECODERS if name == 'auto' else (name,) + FULL_DECODERS
+
+    for candidate in candidates:
+        try:
+            module = __import__(candidate)
+        except ImportError:
+            if candidate == name:
+                logger.warning("json backend '%s' is not installed" % name)
+            continue
+
+        return candidate, module
+
+
+def load_chain(chain, client, option_chain, backend=None):
+    """
+    Requests the option chain described by option_chain (a td OptionChain) and decodes it into chain. A chain can be
+    loaded from several requests, so calling chain.finish() once they're all in is left to the caller.
+
+    Only a PooledTDClient can hand back the raw response. Any other client (a plain TDClient, a paper trading or
+    test client) is asked for the chain through get_options_chain and its dict is decoded instead.
+    """
+    from transport import PooledTDClient
+
+    name, module = get_backend(backend)
+
+    if not isinstance(client, PooledTDClient):
+        decode_dict(chain, client.get_options_chain(option_chain=option_chain))
+        return
+
+    response = client.request_stream('marketdata/chains', params=option_chain.query_parameters)
+
+    try:
+        if name == 'ijson':
+            # let urllib3 undo any gzip/deflate content encoding while we read
+            response.raw.decode_content = True
+            decode_stream(chain, response.raw, module)
+        else:
+            decode_dict(chain, module.loads(response.content))
+    finally:
+        response.close()
+
+
+def decode_dict(chain, chain_raw: dict):
+    """
+    Walks an already decoded chain. Each expiration is popped off the raw dict once its strikes are built, so the
+    raw dicts are released as the chain fills up instead of all living until the end
+    """
+    for key, value in chain_raw.items():
+        if key not in EXP_DATE_MAPS:
+            chain.process_chain_field(key, value)
+
+    for exp_map in EXP_DATE_MAPS:
+        dates = chain_raw.pop(exp_map, {})
+
+        for exp_date in list(dates):
+            for strike, strike_data in dates.pop(exp_date).items():
+                chain.process_raw_strike(exp_map, exp_date, strike, strike_data[0])
+
+
+
+def decode_stream(chain, stream, ijson):
+    """
+    Incrementally parses a chain response from a file-like object of bytes.
+
+    The response looks like {<field>: <value>, ..., "putExpDateMap": {<exp date>: {<strike>: [{...}]}}, ...}.
+    Strike dicts are flat, so they are filled in directly from the parse events and handed to the chain one at a
+    time. Nested values (the underlying quote, optionDeliverablesList) are built with ijson's ObjectBuilder.
+    """
+    depth = 0
+    key = None
+    exp_map = None
+    exp_date = None
+    strike = None
+    strike_index = 0
+
+    # the strike dict being filled in and the key of its next value
+    raw_strike = None
+    strike_key = None
+
+    builder = None
+    builder_depth = 0
+
+    for event, value in ijson.basic_parse(stream, use_float=True):
+
+        # keep feeding a nested object until it's closed
+        if builder is not None:
+            builder.event(event, value)
+
+            if event == 'start_map' or event == 'start_array':
+                builder_depth += 1
+            elif event == 'end_map' or event == 'end_array':
+                builder_depth -= 1
+
+            if builder_depth == 0:
+                if raw_strike is not None:
+                    raw_strike[strike_key] = builder.value
+                else:
+                    chain.process_chain_field(key, builder.value)
+
+                builder = None
+
+            continue
+
+        # inside a strike's dict
+        if raw_strike is not None:
+            if event == 'map_key':
+                strike_key = value
+            elif event == 'end_map':
+                # only the first entry in a strike's list is used. Same as strike_data[0] elsewhere
+                if strike_index == 0:
+                    chain.process_raw_strike(exp_map, exp_date, strike, raw_strike)
+
+                strike_index += 1
+                raw_strike = None
+            elif event == 'start_map' or event == 'start_array':
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                builder_depth = 1
+            else:
+                raw_strike[strike_key] = value
+
+            continue
+
+        if event == 'map_key':
+            if depth == 1:
+                key = value
+                exp_map = value if value in EXP_DATE_MAPS else None
+            elif depth == 2:
+                exp_date = value
+            elif depth == 3:
+                strike = value
+                strike_index = 0
+
+        elif event == 'start_map' or event == 'start_array':
+            if depth == 4:
+                raw_strike = {}
+            elif depth == 1 and exp_map is None:
+                # a top level object such as the underlying quote
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                builder_depth = 1
+            else:
+                depth += 1
+
+        elif event == 'end_map' or event == 'end_array':
+            depth -= 1
+
+        elif depth == 1:
+            # top level scalar such as symbol, numberOfContracts or interestRate
+            chain.process_chain_field(key, value)
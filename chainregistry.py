@@ -0,0 +1,142 @@
+"""
+Shares chain pulls between watchlists.
+
+The remote, local, test and weekly watchlists overlap a lot, and each Watchlist builds its own Instruments, so the
+same chain used to be pulled once per list that had the symbol. Fetches now go through a registry keyed by the
+symbol (see OptionChain.shared):
+    - while a fetch is running, anyone else asking for the same key waits for it instead of making their own call
+    - a finished chain is handed out again for "chain share secs" (60), so watchlists scanned one after another
+      in the same cycle share it too
+    - a failed fetch is passed to everyone that was waiting on it and then forgotten, so the next ask tries again
+    - finished chains are dropped once they're older than that, on a timer, so the registry doesn't keep hunterd's
+      chains alive between cycles
+
+API calls end up scaling with unique symbols, not watchlist memberships. The registry is per process. Workers from
+workqueue.py already split symbols between them, so they don't need to share.
+"""
+import time
+import threading
+from utils import get_param, start_logger
+
+logger = start_logger("chainregistry")
+
+
+class _Fetch:
+    __slots__ = ('done', 'result', 'error', 'finished')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished = None
+
+
+class ChainRegistry:
+
+    def __init__(self, ttl: float = None):
+        if ttl is None:
+            ttl = get_param('chain share secs')
+            if ttl is None:
+                ttl = 60
+
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        # key -> _Fetch. Fetches run at the same time and finish in any order, so every one is checked on expiry
+        self.fetches = {}
+        self.timer = None
+
+        self.calls = 0
+        self.shared = 0
+
+    def _expire(self, now: float) -> None:
+        for key in list(self.fetches):
+            fetch = self.fetches[key]
+            if fetch.done.is_set() and now - fetch.finished >= self.ttl:
+                del self.fetches[key]
+
+    def _schedule(self) -> None:
+        # called with the lock held. Runs _expire when the oldest finished fetch goes stale, whether or not anyone
+        # asks for another chain by then
+        if self.timer is not None:
+            return
+
+        now = time.monotonic()
+        finished = [fetch.finished for fetch in self.fetches.values() if fetch.done.is_set()]
+        if not finished:
+            return
+
+        self.timer = threading.Timer(max(min(finished) + self.ttl - now, 0), self._timed_expire)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _timed_expire(self) -> None:
+        with self.lock:
+            self.timer = None
+            self._expire(time.monotonic())
+            self._schedule()
+
+    def get(self, key, fetch_function):
+        """
+        The result of fetch_function() for key. Only one call per key runs at a time, and its result is reused for
+        ttl seconds
+        """
+        with self.lock:
+            self._expire(time.monotonic())
+
+            fetch = self.fetches.get(key)
+            leader = fetch is None
+            if leader:
+                fetch = self.fetches[key] = _Fetch()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if leader:
+            try:
+                fetch.result = fetch_function()
+            except BaseException as e:
+                fetch.error = e
+
+                # nothing to share. The next caller makes a new attempt
+                with self.lock:
+                    if self.fetches.get(key) is fetch:
+                        del self.fetches[key]
+            finally:
+                fetch.finished = time.monotonic()
+                fetch.done.set()
+
+            with self.lock:
+                self._schedule()
+        else:
+            fetch.done.wait()
+
+        if fetch.error is not None:
+            raise fetch.error
+
+        return fetch.result
+
+    def clear(self) -> None:
+        with self.lock:
+            self.fetches = {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"calls": self.calls, "shared": self.shared, "cached": len(self.fetches)}
+
+
+_registry = None
+
+
+def get_registry() -> ChainRegistry:
+    """
+    The process wide registry used by options.Instrument. Made on first use so importing this reads no parameters
+    """
+    global _registry
+    if _registry is None:
+        _registry = ChainRegistry()
+
+    return _registry
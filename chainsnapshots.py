@@ -0,0 +1,312 @@
+"""
+Delta encoded option chain snapshots.
+
+Chains pulled five minutes apart are nearly the same, but out-data/options-chain gets a full copy of every strike
+each run. With "chain snapshot mode" set to "delta", ChainSnapshotWriter writes to out-data/options-chain-delta/<day>/
+instead, one gzipped json record per run:
+
+    keyframe    {"run": 1, "timestamp": ..., "keyframe": true, "fields": [<field>, ...],
+                 "strikes": {<option symbol>: [<value of each field>, ...]}}
+    delta       {"run": 2, "timestamp": ..., "keyframe": false,
+                 "changes": {<option symbol>: [<field position>, <new value>, ...]},    # only the fields that moved
+                 "added": {<option symbol>: [<value of each field>, ...]},
+                 "removed": [<option symbol>, ...]}
+
+The first run of each day, and every "chain keyframe every" runs after it, is a keyframe, so getting to any run means
+reading at most that many records. Everything is in per day directories so old days can simply be deleted.
+
+ChainSnapshotReader puts a run back together (the same strike dicts write_strikes_json writes) from the keyframe
+before it and the deltas since:
+
+    reader = ChainSnapshotReader()              # the latest day, or ChainSnapshotReader(day="2020-08-21")
+    strikes = reader.chain()                    # the latest run
+    strikes = reader.chain(run=40)
+    strikes = reader.at("2020-08-21T10:05:00")  # the last run at or before a time
+    for record, strikes in reader.replay():     # every run in order, one delta applied at a time
+"""
+import os
+import gzip
+import json
+from datetime import datetime
+from utils import get_param, start_logger
+
+logger = start_logger("chainsnapshots")
+
+SNAPSHOT_DIR = "out-data/options-chain-delta"
+
+
+def record_name(run: int, keyframe: bool) -> str:
+    # zero padded so the names sort in run order
+    return "chain %06d %s.json.gz" % (run, "keyframe" if keyframe else "delta")
+
+
+def run_number(name: str) -> int:
+    return int(name.split()[1])
+
+
+def list_records(day_dir: str) -> list:
+    """
+    (run, keyframe, name) of every record in a day's directory, in run order
+    """
+    if not os.path.isdir(day_dir):
+        return []
+
+    records = [(run_number(name), name.split()[2].startswith("keyframe"), name) for name in os.listdir(day_dir)
+               if name.startswith("chain ") and name.endswith(".json.gz")]
+
+    return sorted(records)
+
+
+def read_record(path: str) -> dict:
+    with gzip.open(path, 'rt') as record_file:
+        return json.load(record_file)
+
+
+class ChainState:
+    """
+    Every strike of one run, as option symbol -> list of field values
+    """
+
+    def __init__(self, fields: list, strikes: dict, run: int = 0, timestamp: str = None):
+        self.fields = fields
+        self.strikes = strikes
+        self.run = run
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_dicts(cls, strikes: list):
+        fields = list(strikes[0]) if strikes else []
+        return cls(fields, {strike['symbol']: [strike.get(field) for field in fields] for strike in strikes})
+
+    def to_dicts(self) -> list:
+        return [dict(zip(self.fields, values)) for values in self.strikes.values()]
+
+    def apply(self, record: dict) -> None:
+        """
+        Moves the state on by one delta record. Values lists are replaced, not changed, so a list handed out
+        earlier (to_dicts, another state) stays the same
+        """
+        for symbol in record["removed"]:
+            self.strikes.pop(symbol, None)
+
+        for symbol, changes in record["changes"].items():
+            values = list(self.strikes[symbol])
+            for position in range(0, len(changes), 2):
+                values[changes[position]] = changes[position + 1]
+            self.strikes[symbol] = values
+
+        self.strikes.update(record["added"])
+
+        self.run = record["run"]
+        self.timestamp = record["timestamp"]
+
+
+class ChainSnapshotWriter:
+
+    def __init__(self, path: str = SNAPSHOT_DIR, keyframe_every: int = None):
+        if keyframe_every is None:
+            keyframe_every = get_param('chain keyframe every') or 78
+
+        self.path = path
+        self.keyframe_every = keyframe_every
+
+        # the last run written, so the next delta has something to compare to. Read back from disk on the first
+        # write of a day, which also picks up where a restarted process left off
+        self.day = None
+        self.state = None
+        self.since_keyframe = 0
+
+    def _resume(self, day: str) -> None:
+        self.day = day
+        self.state = None
+        self.since_keyframe = 0
+
+        reader = ChainSnapshotReader(self.path, day)
+        records = reader.records
+        if not records:
+            return
+
+        try:
+            self.state = reader.state(records[-1][0])
+        except (OSError, ValueError, KeyError) as e:
+            # a record we can't read. Start the day over from a keyframe, the runs after it will still replay
+            logger.warning("Couldn't read back %s chain snapshots, writing a keyframe: %r" % (day, e))
+            self.state = ChainState([], {}, run=records[-1][0])
+            self.since_keyframe = self.keyframe_every
+            return
+
+        keyframes = [run for run, keyframe, name in records if keyframe]
+        self.since_keyframe = self.state.run - keyframes[-1] if keyframes else self.keyframe_every
+
+    def write(self, strikes: list) -> str:
+        """
+        Writes one run's strike dicts as a keyframe or a delta and returns the path
+        """
+        now = datetime.now()
+        day = now.strftime("%Y-%m-%d")
+        if day != self.day:
+            self._resume(day)
+
+        current = ChainState.from_dicts(strikes)
+        current.run = self.state.run + 1 if self.state is not None else 1
+        current.timestamp = now.strftime("%Y-%m-%dT%H:%M:%S")
+
+        previous = self.state
+        keyframe = (previous is None or not previous.fields or previous.fields != current.fields
+                    or self.since_keyframe + 1 >= self.keyframe_every)
+
+        if keyframe:
+            record = {"run": current.run, "timestamp": current.timestamp, "keyframe": True,
+                      "fields": current.fields, "strikes": current.strikes}
+            self.since_keyframe = 0
+        else:
+            record = self._delta(previous, current)
+            self.since_keyframe += 1
+
+        day_dir = os.path.join(self.path, day)
+        os.makedirs(day_dir, exist_ok=True)
+        out_path = os.path.join(day_dir, record_name(current.run, keyframe))
+
+        # write then rename, like utils.write_atomic, so a reader never sees half a record
+        tmp_path = out_path + ".tmp"
+        with gzip.open(tmp_path, 'wt', compresslevel=6) as record_file:
+            json.dump(record, record_file, separators=(',', ':'))
+        os.replace(tmp_path, out_path)
+
+        self.state = current
+
+        if not keyframe:
+            logger.info("Chain run %s: %s changed, %s added, %s removed of %s strikes" % (
+                current.run, len(record["changes"]), len(record["added"]), len(record["removed"]),
+                len(current.strikes)))
+
+        return out_path
+
+    @staticmethod
+    def _delta(previous: ChainState, current: ChainState) -> dict:
+        changes = {}
+        added = {}
+        old_strikes = previous.strikes
+
+        for symbol, values in current.strikes.items():
+            old_values = old_strikes.get(symbol)
+            if old_values is None:
+                added[symbol] = values
+                continue
+
+            if values == old_values:
+                continue
+
+            changed = []
+            for position, value in enumerate(values):
+                if value != old_values[position]:
+                    changed.append(position)
+                    changed.append(value)
+            changes[symbol] = changed
+
+        removed = [symbol for symbol in old_strikes if symbol not in current.strikes]
+
+        return {"run": current.run, "timestamp": current.timestamp, "keyframe": False, "changes": changes,
+                "added": added, "removed": removed}
+
+
+class ChainSnapshotReader:
+
+    def __init__(self, path: str = SNAPSHOT_DIR, day: str = None):
+        """
+        day is a "%Y-%m-%d" directory name. The latest day by default
+        """
+        if day is None:
+            days = sorted(os.listdir(path)) if os.path.isdir(path) else []
+            day = days[-1] if days else None
+
+        self.path = path
+        self.day = day
+        self.day_dir = os.path.join(path, day) if day else None
+        self.records = list_records(self.day_dir) if day else []
+
+    def runs(self) -> list:
+        return [run for run, keyframe, name in self.records]
+
+    def _read(self, name: str) -> dict:
+        return read_record(os.path.join(self.day_dir, name))
+
+    def state(self, run: int = None) -> ChainState:
+        """
+        The ChainState of run (the latest by default): the keyframe at or before it plus the deltas up to it
+        """
+        if not self.records:
+            raise ValueError("No chain snapshots in %s" % (self.day_dir or self.path))
+
+        if run is None:
+            run = self.records[-1][0]
+
+        upto = [record for record in self.records if record[0] <= run]
+        keyframes = [position for position, record in enumerate(upto) if record[1]]
+        if not upto or upto[-1][0] != run or not keyframes:
+            raise ValueError("Can't rebuild chain run %s of %s" % (run, self.day))
+
+        start = keyframes[-1]
+        keyframe = self._read(upto[start][2])
+        state = ChainState(keyframe["fields"], keyframe["strikes"], keyframe["run"], keyframe["timestamp"])
+
+        for record_run, is_keyframe, name in upto[start + 1:]:
+            state.apply(self._read(name))
+
+        return state
+
+    def chain(self, run: int = None) -> list:
+        """
+        Strike dicts of run, the same as the options-chain json of that run would have had
+        """
+        return self.state(run).to_dicts()
+
+    def at(self, timestamp: str) -> list:
+        """
+        Strike dicts of the last run at or before timestamp ("%Y-%m-%dT%H:%M:%S")
+        """
+        # the timestamps are only in the records, but runs are in time order, so binary search by reading a few
+        low, high = 0, len(self.records)
+        while low < high:
+            middle = (low + high) // 2
+            if self._read(self.records[middle][2])["timestamp"] <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low == 0:
+            raise ValueError("No chain snapshot at or before %s" % timestamp)
+
+        return self.chain(self.records[low - 1][0])
+
+    def replay(self):
+        """
+        Yields (record, strike dicts) for every run of the day in order. Cheaper than chain() for each run since
+        every record is only read once
+        """
+        state = None
+        for run, keyframe, name in self.records:
+            record = self._read(name)
+            if keyframe:
+                state = ChainState(record["fields"], record["strikes"], record["run"], record["timestamp"])
+            elif state is None:
+                # the day's first keyframe is missing. Nothing to apply the deltas to
+                continue
+            else:
+                state.apply(record)
+
+            yield record, state.to_dicts()
+
+
+_writer = None
+
+
+def get_writer() -> ChainSnapshotWriter:
+    """
+    The writer raw.write_strikes uses. One per process so the last run stays in memory between hunterd cycles
+    """
+    global _writer
+    if _writer is None:
+        _writer = ChainSnapshotWriter()
+
+    return _writer
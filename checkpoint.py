@@ -0,0 +1,169 @@
+"""
+Checkpoint and warm restart for hunterd.
+
+A restarted daemon used to come back cold: no chains, nothing known about the symbols, so its first cycle was a full
+scan and it waited run frequency minutes before even starting that. After every "checkpoint every" cycles hunterd now
+saves its state to "checkpoint path" (pickled and gzipped, written through a temp file and a rename):
+
+    - every instrument's parsed OptionChain, with the time it was pulled
+    - the accepted spreads of each symbol (their cdc keys) and per symbol stats: when it was pulled, how many spreads
+      were accepted and how many cycles in a row it had none
+    - what OptionChain learned about each symbol to narrow its next request, and the IV surfaces with their history
+
+On startup the checkpoint is loaded back. Chains pulled less than "checkpoint max age secs" ago are handed to the first
+cycle, which only pulls the symbols that are stale (or weren't in the checkpoint) and runs straight away, so there are
+results again within seconds. The stats decide the order of those pulls (see pull_order): the symbols that had
+accepted spreads go first and the ones that have had none for longest go last. Every cycle after that pulls everything
+as usual.
+
+The chains and surfaces are pickled on the main thread between cycles, when nothing is changing them. The accepted
+spreads only exist once the spreads writer has analyzed the watchlist, so the rest of the checkpoint is finished and
+written on that writer's thread, after the cycle's outputs.
+"""
+import os
+import gzip
+import time
+import pickle
+from cdc import spread_key
+from options import OptionChain
+from volatility import IVSurface
+from utils import get_param, start_logger
+
+logger = start_logger("checkpoint")
+
+VERSION = 1
+
+
+class Checkpointer:
+
+    def __init__(self, path: str = None, every: int = None, max_age: float = None):
+        if path is None:
+            path = get_param('checkpoint path') or "out-data/hunterd-checkpoint.pkl.gz"
+        if every is None:
+            every = get_param('checkpoint every')
+            if every is None:
+                every = 1
+        if max_age is None:
+            max_age = get_param('checkpoint max age secs')
+            if max_age is None:
+                max_age = 600
+
+        self.path = path
+        self.every = every
+        self.max_age = max_age
+
+        self.cycles = 0
+
+        # symbol -> {"fetched_at", "accepted", "empty_cycles", "spreads": [cdc keys]}
+        self.stats = {}
+
+    def checkpoint(self, watchlist, output=None) -> None:
+        """
+        Called after each cycle. Every "checkpoint every" cycles, saves the watchlist's state. With an OutputStage
+        the save happens on the spreads writer, after the cycle's own outputs
+        """
+        self.cycles += 1
+        if not self.every or self.cycles % self.every:
+            return
+
+        started = time.monotonic()
+        instruments = watchlist.all()
+        state = pickle.dumps({
+            "chains": {instrument.symbol: instrument.chain for instrument in instruments},
+            "strike_intervals": OptionChain.strike_intervals,
+            "contract_counts": OptionChain.contract_counts,
+            "last_prices": OptionChain.last_prices,
+            "surfaces": {instrument.symbol: IVSurface.surfaces[instrument.symbol] for instrument in instruments
+                         if instrument.symbol in IVSurface.surfaces}
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+
+        logger.debug("Pickled %s chains in %.2fs" % (len(instruments), time.monotonic() - started))
+
+        if output is None:
+            self.save(watchlist, state)
+        else:
+            output.submit("spreads", self.save, watchlist, state)
+
+    def save(self, watchlist, state: bytes) -> None:
+        started = time.monotonic()
+
+        accepted = {}
+        for spread in watchlist.accepted_spreads():
+            accepted.setdefault(spread.instrument.symbol, []).append(spread_key(spread.to_dict()))
+
+        for instrument in watchlist.all():
+            keys = accepted.get(instrument.symbol, [])
+            previous = self.stats.get(instrument.symbol, {})
+
+            self.stats[instrument.symbol] = {
+                "fetched_at": getattr(instrument.chain, 'fetched_at', None),
+                "accepted": len(keys),
+                "empty_cycles": 0 if keys else previous.get("empty_cycles", 0) + 1,
+                "spreads": keys
+            }
+
+        data = pickle.dumps({"version": VERSION, "saved": time.time(), "state": state, "stats": self.stats},
+                            protocol=pickle.HIGHEST_PROTOCOL)
+
+        checkpoint_dir = os.path.dirname(self.path)
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+        # write then rename, so a crash mid-write leaves the last good checkpoint in place
+        tmp_path = self.path + ".tmp"
+        with gzip.open(tmp_path, 'wb', compresslevel=3) as checkpoint_file:
+            checkpoint_file.write(data)
+        os.replace(tmp_path, self.path)
+
+        logger.info("Checkpointed %s symbols (%.1f MB) in %.2fs" % (len(self.stats), os.path.getsize(self.path) / 1e6,
+                                                                  time.monotonic() - started))
+
+    def restore(self) -> dict:
+        """
+        Loads the checkpoint, if there is one. Puts the per symbol caches and IV surfaces back and returns the chains
+        young enough to skip pulling again (symbol -> OptionChain)
+        """
+        if not self.max_age or not os.path.exists(self.path):
+            return {}
+
+        try:
+            with gzip.open(self.path, 'rb') as checkpoint_file:
+                checkpoint = pickle.load(checkpoint_file)
+
+            if checkpoint.get("version") != VERSION:
+                logger.warning("Ignoring checkpoint %s from another version" % self.path)
+                return {}
+
+            state = pickle.loads(checkpoint["state"])
+        except Exception as e:
+            # a bad checkpoint only costs a cold start
+            logger.warning("Couldn't restore checkpoint %s: %r" % (self.path, e))
+            return {}
+
+        self.stats = checkpoint["stats"]
+
+        # whatever this process has learned already wins over the checkpoint
+        for name in ("strike_intervals", "contract_counts", "last_prices"):
+            cache = getattr(OptionChain, name)
+            for symbol, value in state[name].items():
+                cache.setdefault(symbol, value)
+
+        for symbol, surface in state["surfaces"].items():
+            IVSurface.surfaces.setdefault(symbol, surface)
+
+        now = time.time()
+        chains = {symbol: chain for symbol, chain in state["chains"].items()
+                  if now - getattr(chain, 'fetched_at', 0) < self.max_age}
+
+        logger.info("Restored checkpoint from %.0fs ago: %s of %s chains still fresh" % (
+            now - checkpoint["saved"], len(chains), len(state["chains"])))
+
+        return chains
+
+    def pull_order(self, symbol: str) -> tuple:
+        """
+        Sort key for the first cycle's pulls: most accepted spreads last time first, then fewest cycles in a row with
+        none, then the longest ago pulled. Symbols not in the checkpoint go after the ones that had spreads
+        """
+        stats = self.stats.get(symbol, {})
+        return -stats.get("accepted", 0), stats.get("empty_cycles", 0), stats.get("fetched_at") or 0
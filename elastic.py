@@ -1,19 +1,19 @@
 import os
-import logging
-import optparse
 import json
-import requests
+from urllib.parse import quote
 from utils import get_param, start_logger, define_parser
 from account import get_watchlist
-from options import VertSpread
+from cdc import SpreadChangeLog
 from datetime import datetime
 
 
 logger = start_logger("elastic")
 
-options, args = define_parser()
+ELASTIC_URL = "http://localhost:9200"
+
+def run_elastic(options):
+    import requests
 
-def run_elastic():
     # initialize TDA connection and get the appropriate watchlist
     watchlist = get_watchlist(options=options)
 
@@ -24,6 +24,11 @@ def run_elastic():
     # calculate all PCS and CCS vertical spreads
     spreads = watchlist.get_spreads()
 
+    # in cdc mode only the spreads that changed since the last run are sent to elastic
+    if get_param('output mode') == 'cdc':
+        index_changes(spreads)
+        return
+
     # create a directory to store output data
     out_dir = "out-data/options-analyzed/"
     outdir = os.makedirs(out_dir, exist_ok=True)
@@ -35,8 +40,47 @@ def run_elastic():
 
     for spread in spreads:
         spread['timestamp'] = dt
-        r=requests.post("http://localhost:9200/options-analyzed/_doc/", json=spread)
+        r=requests.post("%s/options-analyzed/_doc/" % ELASTIC_URL, json=spread)
         print(r.content)
 
+def index_changes(spreads):
+    """
+    Applies the changes since the last run to the options-spreads index with one bulk request. Each spread is
+    indexed under its key, so updates overwrite the old document and removals delete it. Snapshots re-index
+    everything
+    """
+    import requests
+
+    change_log = SpreadChangeLog("elastic")
+    record = change_log.changes(spreads)
+
+    if record["snapshot"]:
+        upserts = record["spreads"]
+    else:
+        upserts = record["inserts"] + record["updates"]
+
+    lines = []
+    for spread in upserts:
+        spread['timestamp'] = record["timestamp"]
+        lines.append(json.dumps({"index": {"_index": "options-spreads", "_id": quote(spread["Key"], safe='')}}))
+        lines.append(json.dumps(spread))
+
+    for key in record["removals"]:
+        lines.append(json.dumps({"delete": {"_index": "options-spreads", "_id": quote(key, safe='')}}))
+
+    if not lines:
+        change_log.save()
+        return
+
+    r = requests.post("%s/_bulk" % ELASTIC_URL, data="\n".join(lines) + "\n",
+                      headers={"Content-Type": "application/x-ndjson"})
+
+    # only move the change log forward once elastic has the changes. Otherwise they're sent again next run
+    if r.ok and not r.json().get("errors"):
+        change_log.save()
+    else:
+        logger.error("Bulk indexing failed: %s" % r.content)
+
 if __name__ == "__main__":
-    run_elastic()
+    options, args = define_parser()
+    run_elastic(options)
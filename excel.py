@@ -1,18 +1,16 @@
-import optparse
-from utils import get_param, start_logger, define_parser
+from utils import start_logger, define_parser
 from account import get_watchlist
-from openpyxl import Workbook
-from openpyxl.styles import Alignment, Font
-from options import VertSpread, PutCreditSpread, CallCreditSpread
+from options import VertSpread
 from datetime import datetime
 
 logger = start_logger("excel")
 
-options, args = define_parser()
-
 class ExcelFormatter:
 
     def __init__(self, document):
+        from openpyxl import Workbook
+        from openpyxl.styles import Alignment, Font
+
         self.wkbook = Workbook()
         self.sheet = self.wkbook.active
 
@@ -23,23 +21,37 @@ class ExcelFormatter:
 
     def save(self):
         # apply the styles
-        for header in self.sheet["1:1"]:
-            header.font = self.bold
+        for sheet in self.wkbook.worksheets:
+            for header in sheet["1:1"]:
+                header.font = self.bold
 
-        for row in self.sheet.rows:
-            for cell in row:
-                cell.alignment = self.alignment
+            for row in sheet.rows:
+                for cell in row:
+                    cell.alignment = self.alignment
 
-        for column in self.sheet.columns:
-            bold_columns = ["% OTM", "R/R", "POP", "Score"]
-            if column[0].value in bold_columns:
-                for cell in column:
-                    cell.font = self.bold
+            for column in sheet.columns:
+                bold_columns = ["% OTM", "R/R", "POP", "Score"]
+                if column[0].value in bold_columns:
+                    for cell in column:
+                        cell.font = self.bold
 
         self.wkbook.save(filename=self.filename)
 
-    def write(self, data: list):
-        self.sheet.append(data)
+    def write(self, data: list, sheet=None):
+        if sheet is None:
+            sheet = self.sheet
+
+        sheet.append(data)
+
+    def write_portfolio(self, portfolio: list):
+        # the picked spreads go on their own sheet, with the same columns as the main one
+        sheet = self.wkbook.create_sheet("Portfolio")
+        self.write(VertSpread.field_names, sheet=sheet)
+
+        for vert_spread in portfolio:
+            self.write(vert_spread.details(), sheet=sheet)
+
+        logger.info("Wrote %s portfolio spreads to %s" % (len(portfolio), self.filename))
 
     def write_spreads(self, instrument_spreads):
         # instrument spreads is a dict with a bunch of instrument expiration dates
@@ -68,21 +80,27 @@ class ExcelFormatter:
 
                         count += 1
 
-            logger.info("Wrote %s %s spreads to %s.xlsx" % (count, symbol, filename))
+            logger.info("Wrote %s %s spreads to %s" % (count, symbol, self.filename))
+
+def run_excel(options):
+    # initialize TDA connection and get the appropriate watchlist
+    watchlist = get_watchlist(options)
 
-        self.save()
+    dt = datetime.strftime(datetime.now(), "%d %b %Y %I-%M-%S")
+    filename = "Option Hunter %s" % dt
+    sheet = ExcelFormatter(filename)
 
-# initialize TDA connection and get the appropriate watchlist
-watchlist = get_watchlist(options)
+    # need to add searching/filtering from this level. Not buried in the classes
+    # list of dicts (each item is an instrument), where each key is a date and values are lists of VerticalSpreads
+    instrument_spreads = watchlist.analyze_strategies()
 
-dt = datetime.strftime(datetime.now(), "%d %b %Y %I-%M-%S")
-filename = "Option Hunter %s" % dt
-sheet = ExcelFormatter(filename)
+    # write the column headers
+    sheet.write(VertSpread.field_names)
+    sheet.write_spreads(instrument_spreads)
 
-# write the column headers
-sheet.write(VertSpread.field_names)
+    sheet.write_portfolio(watchlist.get_portfolio())
+    sheet.save()
 
-# need to add searching/filtering from this level. Not buried in the classes
-# list of dicts (each item is an instrument), where each key is a date and values are lists of VerticalSpreads
-instrument_spreads = watchlist.analyze_strategy()
-sheet.write_spreads(instrument_spreads)
+if __name__ == "__main__":
+    options, args = define_parser()
+    run_excel(options)
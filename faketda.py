@@ -1,9 +1,36 @@
-import sqlite3
-from sqlite3 import Error
-from account import TDAuth
-from flask import Flask, request, render_template
+"""
+Fake TDA API for paper trading. Orders sent to it are filled by paperbroker.PaperBroker instead of a real account.
+
+    POST /v1/accounts/<account id>/orders             place a vertical spread order (TDA order json)
+    GET  /v1/accounts/<account id>/orders             every order placed, shaped like TDA's response. Paper orders
+                                                      fill at once, so they're all FILLED
+    GET  /v1/accounts/<account id>/orders/<order id>  one order
+    GET  /positions                                   open positions and the P&L summary. Not a TDA endpoint
+    POST /marks                                       mark to market. Either {<option symbol>: <price>} or a list of
+                                                      strike dicts like the ones in out-data/options-chain
+    POST /flush                                       write everything queued to sqlite now
+
+The broker (and its sqlite file) is only created when the first request needs it, so importing this module has no
+side effects. Its queued writes are flushed when the server exits.
+"""
+import atexit
+from flask import Flask, request, jsonify
+from paperbroker import PaperBroker
 
 app = Flask(__name__)
+_broker = None
+
+
+def get_broker() -> PaperBroker:
+    global _broker
+    if _broker is None:
+        _broker = PaperBroker()
+
+        # rows still queued when the server stops would otherwise be lost, and missing from the open positions
+        # loaded back on restart
+        atexit.register(lambda: _broker and _broker.close())
+
+    return _broker
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -11,3 +38,59 @@ def data():
     print(request.form)
     return "G2G"
 
+
+@app.route('/v1/accounts/<account_id>/orders', methods=['POST'])
+def place_order(account_id):
+    try:
+        position_id = get_broker().place_order(request.get_json(force=True))
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    # same response as TDA: an empty body with the new order's url in the Location header
+    return "", 201, {"Location": "%s/%s" % (request.base_url, position_id)}
+
+
+@app.route('/v1/accounts/<account_id>/orders', methods=['GET'])
+def get_orders(account_id):
+    return jsonify(get_broker().orders(account_id))
+
+
+@app.route('/v1/accounts/<account_id>/orders/<int:order_id>', methods=['GET'])
+def get_order(account_id, order_id):
+    orders = get_broker().orders(account_id, order_id)
+    if not orders:
+        return jsonify({"error": "Order not found"}), 404
+
+    return jsonify(orders[0])
+
+
+@app.route('/positions', methods=['GET'])
+def get_positions():
+    broker = get_broker()
+    return jsonify({
+        "summary": broker.summary(),
+        "positions": [position.to_dict() for position in broker.open_positions()]
+    })
+
+
+@app.route('/marks', methods=['POST'])
+def mark():
+    marks = request.get_json(force=True)
+
+    if isinstance(marks, list):
+        closed = get_broker().mark_strikes(marks)
+    else:
+        closed = get_broker().mark(marks)
+
+    return jsonify({"closed": [position.to_dict() for position in closed]})
+
+
+@app.route('/flush', methods=['POST'])
+def flush():
+    broker = get_broker()
+    broker.flush()
+    return jsonify(broker.summary())
+
+
+if __name__ == '__main__':
+    app.run()
@@ -0,0 +1,359 @@
+"""
+Local daily price history, and the strike statistics built on it.
+
+Bars are kept in out-data/price-history/<symbol>/ as one flat binary file per column (day, high, low, close), written
+with the array module. A pull only asks TDA for the days after the last stored bar, once per symbol per day, so after
+the first pull of a symbol a scan costs at most one small request for it. Only finished sessions are stored.
+
+PriceHistory answers, for the short strike of a spread:
+    - days_since_touch   calendar days since the underlying last traded through the strike (None: not in the history)
+    - touch_percent      how often the underlying moved as far as the strike within the spread's days to expiration,
+                         over every window of that length in the history
+    - max_move           the largest move towards the strike seen over a window of that length, in percent
+and beta() against the "beta benchmark" (SPY).
+
+The work that doesn't depend on the strike is done once per symbol (running lows and highs) or once per symbol and
+window length (the sorted moves), so each strike after that is a couple of binary searches. The files are in the
+machine's native byte order, like everything else array writes.
+"""
+import os
+import json
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import date
+from utils import get_param, start_logger
+
+logger = start_logger("history")
+
+HISTORY_DIR = "out-data/price-history"
+
+# column -> array type code. day is days since 1970-01-01
+COLUMNS = (('day', 'i'), ('high', 'd'), ('low', 'd'), ('close', 'd'))
+
+DAY_MS = 86400000
+EPOCH = date(1970, 1, 1)
+
+
+def today_number() -> int:
+    return (date.today() - EPOCH).days
+
+
+class PriceHistory:
+
+    def __init__(self, symbol: str, day: array, high: array, low: array, close: array):
+        self.symbol = symbol
+        self.day = day
+        self.high = high
+        self.low = low
+        self.close = close
+
+        self._suffix_low = None
+        self._suffix_high = None
+        self._moves = {}
+        self._betas = {}
+
+    def __len__(self):
+        return len(self.day)
+
+    def __str__(self):
+        return "%s price history (%s days)" % (self.symbol, len(self.day))
+
+    def __repr__(self):
+        return self.__str__()
+
+    def _running_extremes(self) -> None:
+        # lowest low and highest high from each day to the end. The lows go up and the highs go down from day to
+        # day, so the last day through a strike is a binary search. The highs are stored negated to sort upwards
+        n = len(self.day)
+        suffix_low = [0.0] * n
+        suffix_high = [0.0] * n
+
+        lowest = float('inf')
+        highest = float('-inf')
+        for i in range(n - 1, -1, -1):
+            lowest = min(lowest, self.low[i])
+            highest = max(highest, self.high[i])
+            suffix_low[i] = lowest
+            suffix_high[i] = -highest
+
+        self._suffix_low = suffix_low
+        self._suffix_high = suffix_high
+
+    def days_since_touch(self, put_call: str, strike: float):
+        """
+        Calendar days since the underlying was at or below a put strike (at or above a call strike)
+        """
+        if not self.day:
+            return None
+
+        if self._suffix_low is None:
+            self._running_extremes()
+
+        if put_call == 'PUT':
+            last = bisect_right(self._suffix_low, strike) - 1
+        else:
+            last = bisect_right(self._suffix_high, -strike) - 1
+
+        if last < 0:
+            return None
+
+        return today_number() - self.day[last]
+
+    def moves(self, put_call: str, sessions: int) -> list:
+        """
+        For every window of sessions trading days: the lowest low (puts) or highest high (calls) in the window,
+        relative to the close the day before it starts. Sorted. Worked out once per length
+        """
+        key = (put_call, sessions)
+        if key not in self._moves:
+            extremes = self.low if put_call == 'PUT' else self.high
+            better = (lambda a, b: a <= b) if put_call == 'PUT' else (lambda a, b: a >= b)
+
+            # sliding window minimum (maximum) with a monotonic deque, so this is one pass
+            moves = []
+            window = deque()
+            for i in range(1, len(self.day)):
+                while window and better(extremes[i], extremes[window[-1]]):
+                    window.pop()
+                window.append(i)
+
+                start = i - sessions + 1
+                if start < 1:
+                    continue
+                if window[0] < start:
+                    window.popleft()
+
+                moves.append(extremes[window[0]] / self.close[start - 1] - 1)
+
+            moves.sort()
+            self._moves[key] = moves
+
+        return self._moves[key]
+
+    @staticmethod
+    def sessions(days: int) -> int:
+        # trading days in days calendar days
+        return max(int(round(days * 252 / 365)), 1)
+
+    def touch_percent(self, put_call: str, strike: float, last: float, days: int):
+        """
+        Percent of the windows of the same length as days where the underlying got from last to strike
+        """
+        moves = self.moves(put_call, self.sessions(days))
+        if not moves or not last:
+            return None
+
+        needed = strike / last - 1
+        if put_call == 'PUT':
+            touched = bisect_right(moves, needed)
+        else:
+            touched = len(moves) - bisect_left(moves, needed)
+
+        return round(touched / len(moves) * 100, 2)
+
+    def max_move(self, put_call: str, days: int):
+        """
+        The biggest drop (puts) or rally (calls) over any window of the same length as days, in percent
+        """
+        moves = self.moves(put_call, self.sessions(days))
+        if not moves:
+            return None
+
+        move = moves[0] if put_call == 'PUT' else moves[-1]
+        return round(move * 100, 2)
+
+    def beta(self, benchmark, sessions: int = 252):
+        """
+        Beta of daily returns against benchmark (another PriceHistory) over the last sessions days both have
+        """
+        if benchmark is None or benchmark is self:
+            return 1.0 if benchmark is self else None
+
+        key = (benchmark.symbol, len(benchmark), len(self), sessions)
+        if key not in self._betas:
+            benchmark_closes = dict(zip(benchmark.day, benchmark.close))
+            pairs = [(close, benchmark_closes[day]) for day, close in zip(self.day, self.close)
+                     if day in benchmark_closes][-(sessions + 1):]
+
+            returns = [(b[0] / a[0] - 1, b[1] / a[1] - 1) for a, b in zip(pairs, pairs[1:])]
+            beta = None
+
+            if len(returns) > 20:
+                mean_x = sum(x for x, y in returns) / len(returns)
+                mean_y = sum(y for x, y in returns) / len(returns)
+                covariance = sum((x - mean_x) * (y - mean_y) for x, y in returns)
+                variance = sum((y - mean_y) ** 2 for x, y in returns)
+                if variance:
+                    beta = round(covariance / variance, 2)
+
+            self._betas[key] = beta
+
+        return self._betas[key]
+
+
+class PriceHistoryStore:
+
+    def __init__(self, path: str = HISTORY_DIR, years: int = None):
+        if years is None:
+            years = get_param('price history years') or 2
+
+        self.path = path
+        self.years = years
+
+        # symbol -> PriceHistory, and the day each symbol was last brought up to date
+        self.histories = {}
+        self.checked = {}
+
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    def _symbol_dir(self, symbol: str) -> str:
+        return os.path.join(self.path, symbol.replace('/', '_'))
+
+    def load(self, symbol: str) -> PriceHistory:
+        symbol_dir = self._symbol_dir(symbol)
+        columns = []
+
+        for name, type_code in COLUMNS:
+            values = array(type_code)
+            column_path = os.path.join(symbol_dir, name)
+
+            if os.path.exists(column_path):
+                with open(column_path, 'rb') as column_file:
+                    data = column_file.read()
+
+                values.frombytes(data[:len(data) - len(data) % values.itemsize])
+
+            columns.append(values)
+
+        # an append cut short leaves the columns at different lengths. Only whole rows count
+        rows = min(len(values) for values in columns)
+        for values in columns:
+            del values[rows:]
+
+        meta_path = os.path.join(symbol_dir, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                self.checked[symbol] = json.load(meta_file).get('checked')
+
+        return PriceHistory(symbol, *columns)
+
+    def _append(self, symbol: str, history: PriceHistory, bars: list) -> PriceHistory:
+        """
+        Writes bars after the stored ones and returns the longer history. history itself isn't changed, spreads
+        still being written out may be using it
+        """
+        symbol_dir = self._symbol_dir(symbol)
+        os.makedirs(symbol_dir, exist_ok=True)
+
+        columns = []
+        for position, (name, type_code) in enumerate(COLUMNS):
+            existing = getattr(history, name)
+            new = array(type_code, [bar[position] for bar in bars])
+
+            # rewrite the file if load cut it back to whole rows, otherwise just add to the end
+            column_path = os.path.join(symbol_dir, name)
+            full_size = len(existing) * existing.itemsize
+            mode = 'ab' if os.path.exists(column_path) and os.path.getsize(column_path) == full_size else 'wb'
+
+            with open(column_path, mode) as column_file:
+                if mode == 'wb':
+                    existing.tofile(column_file)
+                new.tofile(column_file)
+
+            columns.append(existing + new)
+
+        return PriceHistory(symbol, *columns)
+
+    def _save_checked(self, symbol: str) -> None:
+        symbol_dir = self._symbol_dir(symbol)
+        os.makedirs(symbol_dir, exist_ok=True)
+
+        with open(os.path.join(symbol_dir, "meta.json"), 'w') as meta_file:
+            json.dump({"checked": self.checked[symbol]}, meta_file)
+
+    def get(self, client, symbol: str) -> PriceHistory:
+        """
+        The symbol's history, brought up to yesterday's close with at most one call a day
+        """
+        # instruments are built on several threads and they all want the benchmark
+        with self.lock:
+            symbol_lock = self.locks.setdefault(symbol, threading.Lock())
+
+        with symbol_lock:
+            history = self.histories.get(symbol)
+            if history is None:
+                history = self.histories[symbol] = self.load(symbol)
+
+            today = today_number()
+            if self.checked.get(symbol) == today:
+                return history
+
+            if history.day:
+                start = history.day[-1] + 1
+            else:
+                start = today - self.years * 365
+
+            if start < today:
+                try:
+                    bars = self.fetch(client, symbol, start, today)
+                except Exception as e:
+                    # stale history is still useful. It isn't marked checked, so the next scan tries again
+                    logger.warning("Couldn't pull price history for %s: %r" % (symbol, e))
+                    return history
+
+                if bars:
+                    history = self.histories[symbol] = self._append(symbol, history, bars)
+                    logger.debug("Added %s days to %s" % (len(bars), history))
+
+            self.checked[symbol] = today
+            self._save_checked(symbol)
+            return history
+
+    @staticmethod
+    def fetch(client, symbol: str, start: int, end: int) -> list:
+        """
+        Daily bars from day start up to (not including) day end, as (day, high, low, close)
+        """
+        response = client.get_price_history(symbol, period_type='year', frequency_type='daily', frequency='1',
+                                            start_date=str(start * DAY_MS), end_date=str(end * DAY_MS - 1),
+                                            extended_hours=False)
+
+        bars = []
+        last_day = start - 1
+        for candle in (response or {}).get('candles', []):
+            # candles are stamped at midnight central time, which is still the same day in UTC
+            day = candle['datetime'] // DAY_MS
+            if day <= last_day or day >= end:
+                continue
+
+            bars.append((day, candle['high'], candle['low'], candle['close']))
+            last_day = day
+
+        return bars
+
+
+_store = None
+
+
+def get_store() -> PriceHistoryStore:
+    global _store
+    if _store is None:
+        _store = PriceHistoryStore()
+
+    return _store
+
+
+def symbol_history(client, symbol: str):
+    """
+    (history, benchmark history) for an Instrument, or (None, None) with "price history" off
+    """
+    if not get_param('price history'):
+        return None, None
+
+    store = get_store()
+    benchmark = get_param('beta benchmark') or "SPY"
+
+    return store.get(client, symbol), store.get(client, benchmark)
@@ -1,48 +1,88 @@
 #! /usr/bin/python3
 
-import os
-import logging
-import optparse
-import json
 import time
-import schedule
 from raw import run_raw
+from account import TDAuth
+from outputs import OutputStage
+from ratebudget import LIVE
+from checkpoint import Checkpointer
 from utils import get_param, start_logger, define_parser
-from account import get_watchlist
-from options import VertSpread
 from datetime import datetime
 
 logger = start_logger("hunterd")
-options, args = define_parser()
 
-logger.info("starting hunterd daemon")
+def run_cycle(options, td_auth, output, chains=None, checkpointer=None, order=None):
+    """
+    One scheduled scan: pull and analyze the watchlist, hand the writes to output and log how the writers are doing.
+    chains are already pulled chains to use instead and order a sort key for the rest of the pulls (see
+    checkpoint.py). soak.py runs this against a simulated TDA
+    """
+    watchlist = run_raw(options, td_auth=td_auth, output=output, chains=chains, order=order)
 
-run_frequency = get_param("run frequency mins")
+    if checkpointer is not None:
+        checkpointer.checkpoint(watchlist, output)
 
-# wrap the function with a log entry
-def run_job():
-    run_raw()
-    logger.info(f"Pausing for {run_frequency} minutes")
+    output.report()
+    return watchlist
 
-schedule.every(run_frequency).minutes.do(run_job)
+def run_daemon(options):
+    import schedule
 
-# run a job immediately
-#run_job()
+    logger.info("starting hunterd daemon")
 
-while True:
-    # only run on weekdays
-    if datetime.today().weekday() in range(0, 5):
+    run_frequency = get_param("run frequency mins")
 
-        # only run between 9:00 - 5:00. Can fit to market hours later if we want.
-        if datetime.today.hour in range(9, 17):
+    # one client for the life of the daemon. Its connections are reused between cycles and its access token is
+    # refreshed in the background, so a cycle never starts with a login or token round trip
+    # the live scan goes ahead of batch scans (weekly, excel) in the shared api budget. See ratebudget.py
+    td_auth = TDAuth(keep_alive=True, priority=LIVE)
 
-            # run a new job each amount of minutes specified by the user in parameters.txt
-            schedule.run_pending()
-            time.sleep(1)
+    # files are written on background threads so the next cycle doesn't wait on them. See outputs.py
+    output = OutputStage()
 
-    # check again in a minute if it's time to run jobs
-    #logger.info("Not time to run jobs. Pausing 60s.")
-    time.sleep(60)
+    # state is saved after every cycle and a restart picks up from it. See checkpoint.py
+    checkpointer = Checkpointer()
+    warm_chains = checkpointer.restore()
 
-# this wont get called for now
-logger.info("stopping hunterd daemon")
+    # wrap the function with a log entry
+    def run_job(chains=None, order=None):
+        run_cycle(options, td_auth, output, chains=chains, checkpointer=checkpointer, order=order)
+        logger.info(f"Pausing for {run_frequency} minutes")
+
+    schedule.every(run_frequency).minutes.do(run_job)
+
+    # run a job immediately
+    #run_job()
+
+    try:
+        # after a restart, don't wait run frequency minutes with nothing new. Only the stale symbols get pulled,
+        # the ones that had spreads first
+        if warm_chains and datetime.today().weekday() in range(0, 5) and datetime.today().hour in range(9, 17):
+            run_job(chains=warm_chains, order=checkpointer.pull_order)
+        warm_chains = None
+
+        while True:
+            # only run on weekdays
+            if datetime.today().weekday() in range(0, 5):
+
+                # only run between 9:00 - 5:00. Can fit to market hours later if we want.
+                if datetime.today().hour in range(9, 17):
+
+                    # run a new job each amount of minutes specified by the user in parameters.txt
+                    schedule.run_pending()
+                    time.sleep(1)
+
+            # check again in a minute if it's time to run jobs
+            #logger.info("Not time to run jobs. Pausing 60s.")
+            time.sleep(60)
+    finally:
+        # ctrl-c or a crash. Finish writing whatever was handed off
+        output.close()
+        td_auth.close()
+
+    # this wont get called for now
+    logger.info("stopping hunterd daemon")
+
+if __name__ == "__main__":
+    options, args = define_parser()
+    run_daemon(options)
@@ -0,0 +1,176 @@
+"""
+Monte Carlo probability of profit and expected value for credit spreads.
+
+The delta POP in VertSpread.analyze only looks at the short leg. This simulates the underlying's price at
+expiration instead (lognormal, using the at the money IV of that expiration) and scores the whole spread against the
+simulated prices: POP, expected P&L and the chance of taking the max loss.
+
+Paths are shared. One set of standard normal draws is made per process and sorted once. For an expiration, every
+terminal price is an increasing function of its draw, so the terminal prices come out already sorted. Their prefix
+sums let every spread on that expiration be scored with a couple of binary searches instead of a pass over every
+path, so the simulation costs the same whether an expiration has ten candidate spreads or ten thousand.
+"""
+import random
+from bisect import bisect_left
+from itertools import accumulate
+from math import erf, exp, log, sqrt
+from utils import get_param, start_logger
+
+logger = start_logger("montecarlo")
+
+# the same draws every run so scores don't jitter from scan to scan
+SEED = 20200821
+
+_normals = {}
+
+
+def sorted_normals(paths: int) -> list:
+    """
+    paths standard normal draws, sorted. Antithetic pairs (z, -z) keep the mean exactly 0
+    """
+    if paths not in _normals:
+        rng = random.Random(SEED)
+        half = [rng.gauss(0, 1) for _ in range(paths // 2)]
+        _normals[paths] = sorted(half + [-z for z in half])
+
+    return _normals[paths]
+
+
+def option_value(put_call: str, price: float, strike: float, years: float, iv: float) -> float:
+    """
+    Black-Scholes value of an option with no rates or dividends. Used to price the long leg of a calendar or diagonal
+    once the front month has expired
+    """
+    if put_call == 'PUT':
+        intrinsic = max(strike - price, 0)
+    else:
+        intrinsic = max(price - strike, 0)
+
+    if years <= 0 or iv <= 0 or price <= 0:
+        return intrinsic
+
+    sigma = (iv / 100) * sqrt(years)
+    d1 = (log(price / strike) + 0.5 * sigma * sigma) / sigma
+    d2 = d1 - sigma
+
+    call = price * _norm_cdf(d1) - strike * _norm_cdf(d2)
+    if put_call == 'PUT':
+        # put-call parity
+        return call - price + strike
+
+    return call
+
+
+def _norm_cdf(x: float) -> float:
+    return 0.5 * (1 + erf(x / sqrt(2)))
+
+
+def valid_iv(strike) -> bool:
+    # TDA sends NaN or -999 when it couldn't work out an IV
+    iv = strike.volatility
+    return isinstance(iv, (int, float)) and 0 < iv < 1000
+
+
+def atm_iv(date, last: float):
+    """
+    IV (in percent, like TDA sends it) of the strikes closest to the underlying's price on this expiration. Falls
+    back to the median IV of the expiration when the at the money strikes don't have one
+    """
+    ivs = []
+    for strikes in (date.puts, date.calls):
+        if not strikes:
+            continue
+
+        closest = min(strikes, key=lambda strike: abs(strike.strikePrice - last))
+        if valid_iv(closest):
+            ivs.append(closest.volatility)
+
+    if ivs:
+        return sum(ivs) / len(ivs)
+
+    ivs = sorted(strike.volatility for strike in date.puts + date.calls if valid_iv(strike))
+    if ivs:
+        return ivs[len(ivs) // 2]
+
+
+def expiration_model(date, last: float, paths: int = None, surface=None):
+    """
+    The simulated prices for one OptionExpDate, or None if there isn't enough to build them from. surface is the
+    symbol's volatility.IVSurface. Its ATM IV is used when it has one for this expiration
+    """
+    if not last or not (date.puts or date.calls):
+        return None
+
+    days = (date.puts or date.calls)[0].daysToExpiration
+
+    iv = surface.atm(days) if surface is not None else None
+    if iv is None:
+        iv = atm_iv(date, last)
+    if iv is None:
+        logger.debug("No usable IV for %s" % date)
+        return None
+
+    if paths is None:
+        paths = get_param('monte carlo paths') or 10000
+
+    return TerminalPrices(last, iv, days, sorted_normals(paths))
+
+
+class TerminalPrices:
+
+    def __init__(self, last: float, iv: float, days: int, normals: list):
+        # expiration day still has the rest of the session left
+        years = max(days, 0.5) / 365
+        sigma = (iv / 100) * sqrt(years)
+
+        # no drift beyond the convexity term so the mean terminal price is today's price
+        drift = -0.5 * sigma * sigma
+
+        self.last = last
+        self.iv = iv
+        self.n = len(normals)
+        self.prices = [last * exp(drift + sigma * z) for z in normals]
+        # accumulate only takes initial= from 3.8 on
+        self.sums = [0] + list(accumulate(self.prices))
+        self._quantiles = {}
+
+    def below(self, price: float) -> int:
+        # number of paths that end under price
+        return bisect_left(self.prices, price)
+
+    def quantiles(self, count: int) -> list:
+        """
+        count prices spread evenly through the simulated distribution. For payoffs that are too costly to check
+        against every path
+        """
+        if count not in self._quantiles:
+            self._quantiles[count] = [self.prices[int((i + 0.5) * self.n / count)] for i in range(count)]
+
+        return self._quantiles[count]
+
+    def put_value(self, strike: float) -> float:
+        # average of max(strike - S, 0) over the paths
+        k = self.below(strike)
+        return (strike * k - self.sums[k]) / self.n
+
+    def call_value(self, strike: float) -> float:
+        # average of max(S - strike, 0) over the paths
+        k = self.below(strike)
+        return (self.sums[self.n] - self.sums[k] - strike * (self.n - k)) / self.n
+
+    def credit_spread(self, put_call: str, short_strike: float, long_strike: float, credit: float):
+        """
+        :return: (POP in percent, expected P&L in dollars per contract, chance of max loss in percent)
+        """
+        if put_call == 'PUT':
+            breakeven = short_strike - credit
+            pop = 1 - self.below(breakeven) / self.n
+            max_loss = self.below(long_strike) / self.n
+            payout = self.put_value(short_strike) - self.put_value(long_strike)
+        else:
+            breakeven = short_strike + credit
+            pop = self.below(breakeven) / self.n
+            max_loss = 1 - self.below(long_strike) / self.n
+            payout = self.call_value(short_strike) - self.call_value(long_strike)
+
+        return round(pop * 100, 2), round((credit - payout) * 100, 2), round(max_loss * 100, 2)
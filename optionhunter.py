@@ -0,0 +1,131 @@
+#! /usr/bin/python3
+"""
+Single command line entry point for the option hunting tools.
+
+    python3 optionhunter.py raw -t
+    python3 optionhunter.py excel -r
+    python3 optionhunter.py daemon -l
+    python3 optionhunter.py coordinator -l
+    python3 optionhunter.py worker
+    python3 optionhunter.py query-api --port 5001
+    python3 optionhunter.py weekly
+    python3 optionhunter.py soak --symbols 2000 --minutes 390
+    python3 optionhunter.py create-watchlist -n "Russell 1k" -s watchlists/russell-1k.txt
+
+Each subcommand imports its module only when it runs, so `--help` and cron
+invocations don't pay for td, openpyxl, requests or flask unless they need them.
+"""
+import argparse
+from utils import add_watchlist_options, check_watchlist_options
+
+
+def run_raw(options):
+    from raw import run_raw
+    run_raw(options)
+
+
+def run_excel(options):
+    from excel import run_excel
+    run_excel(options)
+
+
+def run_elastic(options):
+    from elastic import run_elastic
+    run_elastic(options)
+
+
+def run_daemon(options):
+    from hunterd import run_daemon
+    run_daemon(options)
+
+
+def run_coordinator(options):
+    from workqueue import run_coordinator
+    run_coordinator(options)
+
+
+def run_worker(options):
+    from workqueue import run_worker
+    run_worker(options)
+
+
+def run_query_api(options):
+    from queryapi import run_query_api
+    run_query_api(options)
+
+
+def run_soak(options):
+    from soak import run_soak
+    run_soak(options)
+
+
+def run_weekly(options):
+    from weekly_watchlist import run_weekly
+    run_weekly()
+
+
+def run_create_watchlist(options):
+    from create_watchlist import create_watchlist
+    create_watchlist(options.name, options.symbols)
+
+
+def define_parser():
+    parser = argparse.ArgumentParser(prog="optionhunter")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    # commands that scan a watchlist all take the same -l/-r/-t flags
+    watchlist_commands = [
+        ("raw", run_raw, "write the raw chains and analyzed spreads to out-data as json"),
+        ("excel", run_excel, "write the analyzed spreads to an excel sheet"),
+        ("elastic", run_elastic, "index the analyzed spreads in elasticsearch"),
+        ("daemon", run_daemon, "run the raw scan on a schedule (hunterd)"),
+        ("coordinator", run_coordinator, "queue a scan for workers and write the merged spreads like raw"),
+    ]
+
+    for name, func, help_text in watchlist_commands:
+        subparser = subparsers.add_parser(name, help=help_text)
+        add_watchlist_options(subparser)
+        subparser.set_defaults(func=func, check_watchlist=True)
+
+    worker = subparsers.add_parser("worker", help="scan symbols from the work queue")
+    worker.add_argument('-n', "--name", dest="worker", default=None,
+                        help="name shown in the queue. Defaults to host-pid")
+    worker.add_argument('-e', "--exit-when-empty", dest="exit_when_empty", action="store_true",
+                        help="stop once there are no jobs left instead of waiting for more")
+    worker.set_defaults(func=run_worker, check_watchlist=False)
+
+    query_api = subparsers.add_parser("query-api", help="serve the latest accepted spreads over http")
+    query_api.add_argument("--host", dest="host", default="127.0.0.1")
+    query_api.add_argument('-p', "--port", dest="port", type=int, default=5001)
+    query_api.set_defaults(func=run_query_api, check_watchlist=False)
+
+    weekly = subparsers.add_parser("weekly", help="scan the whole market and rebuild weekly-watchlist.txt")
+    weekly.set_defaults(func=run_weekly, check_watchlist=False)
+
+    # the soak module only uses the standard library until it runs, so its options can be added here
+    from soak import add_soak_options
+    soak = subparsers.add_parser("soak", help="run hunterd's cycle against a simulated TDA and report on it")
+    add_soak_options(soak)
+    soak.set_defaults(func=run_soak, check_watchlist=False)
+
+    create = subparsers.add_parser("create-watchlist", help="create a TDA watchlist from a file of symbols")
+    create.add_argument('-s', "--symbols", dest="symbols", required=True)
+    create.add_argument('-n', "--name", dest="name", required=True)
+    create.set_defaults(func=run_create_watchlist, check_watchlist=False)
+
+    return parser
+
+
+def main(args=None):
+    parser = define_parser()
+    options = parser.parse_args(args)
+
+    if options.check_watchlist:
+        check_watchlist_options(parser, options)
+
+    options.func(options)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,10 +12,8 @@ Need to:
     1) pull down account status
     3) display account positions
     4) search for options that meet TOMIC criteria
-    10) add in days since underlying last hit short leg strike
     12) do something with IV
     17) set trade critera (account size, max acceptable loss)
-    19) add beta for each symbol
     20) add a sheet for fundamentals
     21) check assumption: long open interest more important. may not be the case. get avg or keep short??
 """
@@ -1,57 +1,282 @@
 import json
+import time
 import logging
-from math import sqrt
+import threading
+from math import sqrt, ceil
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from utils import get_param, start_logger
 from datetime import datetime, timedelta
-from td.option_chain import OptionChain as OptionParams
 from itertools import combinations
+from chain_decoder import load_chain, decode_dict
+from chainregistry import get_registry
+from montecarlo import expiration_model, option_value, valid_iv
+from volatility import IVSurface
+from history import symbol_history
+from rules import RuleSet, Column
+from operator import attrgetter
 
 logger = start_logger("options")
 
 class OptionChain:
+    # what was learned about each symbol's chain the last time it was pulled. Used to narrow the next request
+    strike_intervals = {}
+    contract_counts = {}
+    last_prices = {}
 
-    def __init__(self, client, symbol: str):
+    def __init__(self, client, symbol: str, last: float = None):
         self.td_client = client
         logger.info("Building Options Chain for: %s" % symbol)
-        date_range = datetime.today() + timedelta(get_param('search days'))
-        self.params = OptionParams(symbol=symbol, strategy="SINGLE",  opt_range='otm',
-                                   to_date=date_range, include_quotes="TRUE")
-        self.params.validate_chain()
+
+        if last is None:
+            last = self.last_prices.get(symbol)
+
+        self.params = self.build_requests(symbol, last)
 
         self.dates = []
 
+        self.symbol = symbol
+        self.num_contracts = 0
+        self.interest = None
+        self.underlying = None
+
+        # expirations are collected here as strikes are decoded and moved to self.dates once the chain is complete
+        self._pending_dates = {}
+        self._lock = threading.Lock()
+
+        self._strike_index = None
+        self._strike_prices = None
+
         try:
-            self.chain_raw = self.td_client.get_options_chain(option_chain=self.params)
+            self.load(self.params)
         except ConnectionRefusedError:
             time.sleep(60)
-            self.chain_raw = self.td_client.get_options_chain(option_chain=self.params)
+            self._pending_dates = {}
+            self.num_contracts = 0
+            self.load(self.params)
+
+        self.finish()
+        self.remember()
 
-        self.process_raw_chain(self.chain_raw)
+        # wall clock, so it still means something after a checkpoint is restored in another process
+        self.fetched_at = time.time()
 
         strike_count = 0
         for date in self.dates:
             strike_count += len(date)
 
-        logger.info("Pulled %s expiration dates and %s strikes" % (len(self.dates), strike_count))
+        logger.info("Pulled %s expiration dates and %s strikes in %s requests" % (len(self.dates), strike_count,
+                                                                                len(self.params)))
+
+    def __getstate__(self):
+        # for hunterd's checkpoint. The client and the lock belong to the process that pulled the chain
+        state = self.__dict__.copy()
+        state['td_client'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, client, symbol: str, last: float = None):
+        """
+        The chain for symbol, pulled once for everyone asking for it at about the same time (every watchlist with the
+        symbol in it). See chainregistry.py
+
+        The requests themselves aren't part of the key. Every watchlist screens with the same parameters and the
+        requests only differ by how much was learned about the symbol from the last pull (see build_requests), so a
+        chain pulled for one watchlist is the chain any of them would have pulled
+        """
+        return get_registry().get(symbol, lambda: cls(client, symbol, last=last))
+
+    @classmethod
+    def build_requests(cls, symbol: str, last: float = None) -> list:
+        """
+        Builds the chain requests for a symbol from the active screen so TDA only sends strikes that could end up
+        in an acceptable spread:
+            - expirations between "min search days" and "search days" from today
+            - OTM strikes only. With "max percent otm" set (it's off by default), limited to that plus the widest
+              spread the risk budget allows (needs the underlying price. The strike interval is the one seen last
+              time, or a guess from the price)
+            - chains bigger than "max contracts per request" last time are split into put and call requests over
+              several expiration windows. These are fetched in parallel and merged into one chain
+        """
+        from td.option_chain import OptionChain as OptionParams
+
+        today = datetime.today()
+        first_day = get_param('min search days') or 0
+        last_day = get_param('search days')
+
+        strike_count = cls.strike_count(symbol, last)
+
+        contract_types = ['ALL']
+        windows = 1
+        max_contracts = get_param('max contracts per request')
+        expected_contracts = cls.contract_counts.get(symbol, 0)
+
+        if max_contracts and expected_contracts > max_contracts:
+            contract_types = ['PUT', 'CALL']
+            windows = ceil(expected_contracts / (max_contracts * 2))
+
+        span = max(last_day - first_day, 1)
+        windows = min(windows, span)
+        bounds = [first_day + round(span * i / windows) for i in range(windows + 1)]
+
+        requests = []
+        for contract_type in contract_types:
+            for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+                # windows after the first start the day after the previous one ends so no expiration is pulled twice
+                if i > 0:
+                    start += 1
+
+                from_date = (today + timedelta(start)).strftime("%Y-%m-%d") if start else None
+                to_date = (today + timedelta(end)).strftime("%Y-%m-%d")
+
+                params = OptionParams(symbol=symbol, contract_type=contract_type, strike_count=strike_count,
+                                      strategy="SINGLE", opt_range='otm', from_date=from_date, to_date=to_date,
+                                      include_quotes="TRUE")
+                params.validate_chain()
+                requests.append(params)
+
+        return requests
+
+    @classmethod
+    def strike_count(cls, symbol: str, last: float = None):
+        """
+        Number of strikes above and below the money that can hold the short leg of an acceptable spread, plus room
+        for the long leg. None without a price to narrow around. Until the symbol has been pulled once its strike
+        interval is guessed from the price
+        """
+        max_otm = get_param('max percent otm')
+        if not max_otm or not last:
+            return None
+
+        interval = cls.strike_intervals.get(symbol) or cls.provisional_interval(last)
+
+        # the widest spread that fits the risk budget with no credit. Not exact but close enough to size the request
+        max_width = VertSpread.acceptable_risk() / 100
+
+        return ceil((last * (max_otm / 100) + max_width) / interval) + 1
+
+    @staticmethod
+    def provisional_interval(last: float) -> float:
+        """
+        A guess at the strike interval for a symbol that hasn't been pulled yet, from its price. Errs on the small
+        side, so the first request asks for more strikes than it needs rather than fewer
+        """
+        if last < 25:
+            return 0.5
+        if last < 100:
+            return 1
+        if last < 250:
+            return 2.5
+
+        return 5
+
+    def load(self, requests: list) -> None:
+        if len(requests) == 1:
+            load_chain(self, self.td_client, requests[0])
+            return
+
+        with ThreadPoolExecutor(max_workers=len(requests)) as pool:
+            futures = [pool.submit(load_chain, self, self.td_client, params) for params in requests]
+
+            for future in futures:
+                future.result()
+
+    def remember(self) -> None:
+        """
+        Keeps the price, size and strike interval of this chain around to narrow the next request for the symbol
+        """
+        self.contract_counts[self.symbol] = self.num_contracts
+
+        if self.underlying:
+            self.last_prices[self.symbol] = self.underlying['last']
+
+        intervals = []
+        for date in self.dates:
+            strikes = sorted(set(put.strikePrice for put in date.puts))
+            intervals.extend(high - low for low, high in zip(strikes, strikes[1:]))
+
+        if intervals:
+            self.strike_intervals[self.symbol] = min(intervals)
 
     def process_raw_chain(self, chain_raw: dict):
-        self.symbol = chain_raw['symbol']
-        self.num_contracts = chain_raw['numberOfContracts']
-        self.interest = chain_raw['interestRate']
-
-        self.underlying = chain_raw['underlying']
-
-        # Assumption is made that putExpDateMap and callExpDateMap will have the same keys (expiration dates)
-        # has proved true so far but possible edge case
-        for exp_date in chain_raw['putExpDateMap']:
-            exp_datetime = self.clean_exp_format(exp_date)
-            # Only add an expiration date if it comes with a put and call. Does this make sense?
-            if exp_date in chain_raw['putExpDateMap'] and exp_date in chain_raw['callExpDateMap']:
-                calls = chain_raw['callExpDateMap'][exp_date]
-                puts = chain_raw['putExpDateMap'][exp_date]
-                expiration = OptionExpDate(self.symbol, exp_datetime, puts, calls)
+        decode_dict(self, chain_raw)
+        self.finish()
+
+    def process_chain_field(self, key: str, value) -> None:
+        """
+        Called by the chain decoder for each top level field of the chain response
+        """
+        if key == 'symbol':
+            self.symbol = value
+        elif key == 'numberOfContracts':
+            # split chains report their own part of the count
+            with self._lock:
+                self.num_contracts += value
+        elif key == 'interestRate':
+            self.interest = value
+        elif key == 'underlying':
+            self.underlying = value
+
+    def process_raw_strike(self, exp_map: str, exp_date: str, strike: str, raw_strike: dict) -> None:
+        """
+        Called by the chain decoder for each strike in the putExpDateMap and callExpDateMap
+        """
+        expiration = self._pending_dates.get(exp_date)
+        if expiration is None:
+            # split requests are decoded on several threads and put/call requests share expiration dates
+            with self._lock:
+                expiration = self._pending_dates.get(exp_date)
+                if expiration is None:
+                    expiration = OptionExpDate(self.symbol, self.clean_exp_format(exp_date))
+                    self._pending_dates[exp_date] = expiration
+
+        if exp_map == 'putExpDateMap':
+            expiration.puts.append(OptionStrike(strike, raw_strike))
+        else:
+            expiration.calls.append(OptionStrike(strike, raw_strike))
+
+    def finish(self) -> None:
+        # Only add an expiration date if it comes with a put and call. Does this make sense?
+        # the keys look like 2020-08-21:6 so sorting them puts split requests back in expiration order
+        for exp_date in sorted(self._pending_dates):
+            expiration = self._pending_dates[exp_date]
+            if expiration.puts and expiration.calls:
+                expiration.symbol = self.symbol
                 self.dates.append(expiration)
 
+        self._pending_dates = {}
+
+    def strike_index(self) -> dict:
+        """
+        Every strike in the chain keyed by (putCall, strikePrice), each list in expiration order. Lets strategies
+        that pair expirations find the same strike on other dates with a lookup
+        """
+        if self._strike_index is None:
+            index = {}
+            prices = {'PUT': set(), 'CALL': set()}
+
+            for date in self.dates:
+                for strike in date.puts + date.calls:
+                    index.setdefault((strike.putCall, strike.strikePrice), []).append(strike)
+                    prices[strike.putCall].add(strike.strikePrice)
+
+            self._strike_index = index
+            self._strike_prices = {put_call: sorted(strikes) for put_call, strikes in prices.items()}
+
+        return self._strike_index
+
+    def strike_prices(self, put_call: str) -> list:
+        """
+        Sorted strike prices of one type across every expiration
+        """
+        self.strike_index()
+        return self._strike_prices[put_call]
+
     def clean_exp_format(self, expiration_str: str):
         expiration_str = expiration_str.split(":")[0]
         expiration = datetime.strptime(expiration_str, "%Y-%m-%d")
@@ -88,14 +313,16 @@ class OptionChain:
 
 class OptionExpDate:
 
-    def __init__(self, symbol: str, expiration: str, put_dates: dict, call_dates: dict):
+    def __init__(self, symbol: str, expiration: str, put_dates: dict = None, call_dates: dict = None):
         self.expiration = expiration
         self.symbol = symbol
 
         self.calls = []
         self.puts = []
 
-        self.process_raw_date(put_dates, call_dates)
+        # the chain decoder adds strikes one at a time, so the raw dicts are optional
+        if put_dates is not None and call_dates is not None:
+            self.process_raw_date(put_dates, call_dates)
 
     def __str__(self) -> str:
         return "%s(%s)" % (self.symbol, self.expiration)
@@ -125,10 +352,17 @@ class OptionExpDate:
 
 
 class OptionStrike:
+    # only these keys are kept from the raw TDA strike. The rest of the raw dict is dropped so it can be freed
+    fields = ('symbol', 'description', 'putCall', 'strikePrice', 'daysToExpiration', 'expirationDate',
+              'bid', 'ask', 'last', 'mark', 'netChange', 'percentChange', 'lowPrice', 'highPrice',
+              'openInterest', 'totalVolume', 'delta', 'gamma', 'theta', 'vega', 'rho', 'timeValue',
+              'volatility', 'theoreticalVolatility', 'inTheMoney')
+
+    __slots__ = fields + ('strike', 'spread', 'mid', '_expiration_date')
 
     def __init__(self, strike: str, raw_strike: dict):
         self.strike = strike
-        self.raw = raw_strike
+        self._expiration_date = None
         self.process_raw_strike(raw_strike)
         self.validate_greeks()
 
@@ -138,6 +372,14 @@ class OptionStrike:
     def __repr__(self) -> str:
         return self.__str__()
 
+    @property
+    def expiration_date(self) -> str:
+        # only split the description when something actually asks for it
+        if self._expiration_date is None:
+            self._expiration_date = ' '.join(self.description.split()[1:3])
+
+        return self._expiration_date
+
     def to_dict(self):
         return {
             "symbol": self.symbol,
@@ -165,7 +407,8 @@ class OptionStrike:
 
     def process_raw_strike(self, raw_strike: dict):
         """
-        This should assign the following attributes to instances of this class (values are a sample)
+        This should assign the following attributes to instances of this class (values are a sample).
+        Only the keys listed in OptionStrike.fields are kept
         'ask': 1.82,
         'askSize': 1,
         'bid': 1.7,
@@ -214,14 +457,12 @@ class OptionStrike:
         'vega': 0.103,
         'volatility': 28.607}
         """
-        for key, val in raw_strike.items():
-            setattr(self, key, val)
+        for key in self.fields:
+            setattr(self, key, raw_strike.get(key))
 
         self.spread = self.ask - self.bid
         self.mid = (self.ask + self.bid) / 2
 
-        self.expiration_date = ' '.join(self.description.split()[1:3])
-
     def validate_greeks(self):
         """
         for some reason the TDA app doesn't always return the greeks for a strike
@@ -242,7 +483,29 @@ class OptionStrike:
 
 
 class VertSpread:
-    field_names = []
+    # Net Credit is negative and Premium is what's paid when a spread is opened for a debit (calendars, diagonals).
+    # Max Profit is the same as Premium for credit spreads. For calendars and diagonals it's the estimated best case
+    field_names = ["Symbol", "Type", "DTE", "Expiration Date", "L. Expiration Date", "S. Strike", "L. Strike",
+                   "UL Last", "% OTM", "UL Low", "UL High", "Net Credit", "Premium", "Max Loss", "Max Profit", "R/R",
+                   "POP", "Score",
+                   "MC POP", "Exp. P/L", "Max Loss Prob",
+                   "S. IV", "ATM IV", "IV Skew", "IV Pctl",
+                   "Days Since Touch", "Hist. Touch %", "Max Move %", "Beta",
+                   "L. B/A Spread", "S. B/A Spread", "Total B/A Spread",
+                   "L. Volume", "S. Volume", "Avg Volume",
+                   "S. Open Interest", "L. Open Interest",
+                   "S. Delta", "L. Delta", "Net Delta",
+                   "S. Theta", "L. Theta", "Net Theta",
+                   "S. Gamma", "L. Gamma", "Net Gamma",
+                   "S. Vega", "L. Vega", "Net Vega", "Assumption"]
+
+    # a spread is built for every pair of strikes and most get thrown away, so only the legs and the numbers
+    # needed to score and accept a spread are stored. Display strings and output rows are built lazily
+    __slots__ = ('instrument', 'short', 'long', 'strike_spread', 'net_credit', 'profit', 'risk', 'rr', 'pop',
+                 'potm', 'total_spread', 'score', 'mc_pop', 'expected_pnl', 'max_loss_prob', '_details')
+
+    type = None
+    assumption = None
 
     def __init__(self, instrument, short_opt: OptionStrike, long_opt: OptionStrike):
         """
@@ -252,15 +515,11 @@ class VertSpread:
         self.short = short_opt
         self.long = long_opt
 
-        self.description = "%s / %s" % (self.short.description, self.long.description)
-        self.underlying_symbol = self.description.split(' ')[0]
-        self.expiration = ' '.join(self.description.split(' ')[1:4])
+        self.mc_pop = None
+        self.expected_pnl = None
+        self.max_loss_prob = None
 
-        # Greeks!
-        self.net_delta = round(self.short.delta - self.long.delta, 5)
-        self.net_theta = round(self.short.theta - self.long.theta, 5)
-        self.net_gamma = round(self.short.gamma - self.long.gamma, 5)
-        self.net_vega = round(self.short.vega - self.long.gamma, 5)
+        self._details = None
 
     def __str__(self) -> str:
         return "%s %s %s/%s" % (self.instrument.symbol, self.expiration, self.short.strikePrice, self.long.strikePrice)
@@ -268,6 +527,44 @@ class VertSpread:
     def __repr__(self) -> str:
         return self.__str__()
 
+    @property
+    def description(self) -> str:
+        return "%s / %s" % (self.short.description, self.long.description)
+
+    @property
+    def underlying_symbol(self) -> str:
+        return self.short.description.split(' ')[0]
+
+    @property
+    def expiration(self) -> str:
+        return ' '.join(self.short.description.split(' ')[1:4])
+
+    @property
+    def long_expiration(self) -> str:
+        # same as expiration except for spreads across expirations (calendars, diagonals)
+        return ' '.join(self.long.description.split(' ')[1:4])
+
+    # Greeks!
+    @property
+    def net_delta(self):
+        return round(self.short.delta - self.long.delta, 5)
+
+    @property
+    def net_theta(self):
+        return round(self.short.theta - self.long.theta, 5)
+
+    @property
+    def net_gamma(self):
+        return round(self.short.gamma - self.long.gamma, 5)
+
+    @property
+    def net_vega(self):
+        return round(self.short.vega - self.long.gamma, 5)
+
+    @property
+    def avg_volume(self):
+        return (self.short.totalVolume + self.long.totalVolume) / 2
+
     def _calculate_credit(self) -> int:
 
         cost = round(self.short.mid - self.long.mid, 2)
@@ -276,7 +573,8 @@ class VertSpread:
 
         return cost
 
-    def _model_pop(self, pop):
+    @staticmethod
+    def _model_pop(pop):
         if pop <= 0:
             return 0
 
@@ -285,7 +583,8 @@ class VertSpread:
         # divide by 12 to have the function equal 5 at pop=100
         return (pop - 40) / 12
 
-    def _model_rr(self, rr):
+    @staticmethod
+    def _model_rr(rr):
         # anything with a reward/risk less than 10 is not within my acceptable levels of risk and
         # would throw a domain error (ValueError in python) if ran through this model
         if rr < 10:
@@ -347,7 +646,6 @@ class VertSpread:
         self.potm = abs(round(100 - ((self.short.strikePrice / self.instrument.last) * 100), 2))
 
         self.total_spread = round(self.short.spread + self.long.spread, 5)
-        self.avg_volume = (self.short.totalVolume + self.long.totalVolume) / 2
 
         # aggregated risk score. Needs improvement.
         self.score = self._calculate_score(self.rr, self.pop, self.potm, self.total_spread)
@@ -356,47 +654,74 @@ class VertSpread:
         # this is also IV of short. Need to figure out how to combine for a spread or instrument
         #self.iv = BS([self.instrument.last, self.short.strikePrice, 0, self.short.daysToExpiration], putPrice=self.short.mid).impliedVolatility
 
-    def setup_field_names(self):
+    def simulate(self, model, model_pop=False) -> None:
         """
-        Output the following fields when printing:
-        symbol, expiration date, short strike, long strike, net credit, profit, max loss, rr, pop, score
+        Monte Carlo POP, expected P&L and chance of max loss from model, the montecarlo.TerminalPrices shared by every
+        spread on this expiration. With model_pop the simulated POP replaces the delta POP in the score.
 
+        Nothing in acceptable() depends on these, so only accepted spreads are simulated
         """
-        columns = ["Symbol", "Type", "DTE", "Expiration Date", "S. Strike", "L. Strike", "UL Last", "% OTM", "UL Low",
-                   "UL High", "Net Credit", "Premium", "Max Loss", "R/R", "POP", "Score",
-                   "L. B/A Spread", "S. B/A Spread", "Total B/A Spread",
-                   "L. Volume", "S. Volume", "Avg Volume",
-                   "S. Open Interest", "L. Open Interest",
-                   "S. Delta", "L. Delta", "Net Delta",
-                   "S. Theta", "L. Theta", "Net Theta",
-                   "S. Gamma", "L. Gamma", "Net Gamma",
-                   "S. Vega", "L. Vega", "Net Vega", "Assumption"]
+        self.mc_pop, self.expected_pnl, self.max_loss_prob = model.credit_spread(
+            self.short.putCall, self.short.strikePrice, self.long.strikePrice, self.net_credit)
 
-        for column in columns:
-            if column not in VertSpread.field_names:
-                VertSpread.field_names.append(column)
+        if model_pop:
+            self.pop = self.mc_pop
+            self.score = self._calculate_score(self.rr, self.pop, self.potm, self.total_spread)
 
     def details(self):
         """
-        This function exists for a reason I can't recall
-        TODO: remember why I made this a seperate function and comment better next time
+        One output row per spread, in the same order as field_names. Built the first time it is asked for and
+        cached after that, so only spreads that actually get written pay for it
 
         :return:
         """
-        return [self.underlying_symbol, self.type, self.short.daysToExpiration, self.expiration, self.short.strikePrice,
+        if self._details is None:
+            self._details = self._build_details()
+
+        return self._details
+
+    def _build_details(self):
+        volatility = self.instrument.volatility
+        days = self.short.daysToExpiration
+        since_touch, touch_percent, max_move = self.instrument.strike_history(self.short.putCall,
+                                                                              self.short.strikePrice, days)
+
+        return [self.underlying_symbol, self.type, self.short.daysToExpiration, self.expiration, self.long_expiration,
+                self.short.strikePrice,
                 self.long.strikePrice,
                 self.instrument.last, self.potm, self.instrument.low, self.instrument.high,
-                self.net_credit, self.profit, self.risk, self.rr, self.pop, self.score,
+                self.net_credit, round(self.net_credit * 100, 2), self.risk, self.profit, self.rr, self.pop,
+                self.score,
+                self.mc_pop, self.expected_pnl, self.max_loss_prob,
+                self.short.volatility if valid_iv(self.short) else None,
+                volatility.atm(days) if volatility else None,
+                volatility.expiration_skew(days) if volatility else None,
+                volatility.iv_percentile if volatility else None,
+                since_touch, touch_percent, max_move, self.instrument.beta,
                 self.long.spread, self.short.spread, self.total_spread,
                 self.long.totalVolume, self.short.totalVolume, self.avg_volume,
                 self.short.openInterest, self.long.openInterest,
                 self.short.delta, self.long.delta, self.net_delta, self.short.theta, self.long.theta, self.net_theta,
                 self.short.gamma, self.long.gamma, self.net_gamma, self.short.vega, self.long.vega, self.net_vega, self.assumption]
 
-    def acceptable(self):
+    @staticmethod
+    def acceptable_risk():
         option_budget = get_param('account size')
         acceptable_risk_percent = get_param('max risk per trade')
-        acceptable_risk = option_budget * (acceptable_risk_percent / 100)
+        return option_budget * (acceptable_risk_percent / 100)
+
+    def acceptable(self, acceptable_risk=None, max_otm=None):
+        # callers checking a lot of spreads should look these up once and pass them in
+        if acceptable_risk is None:
+            acceptable_risk = self.acceptable_risk()
+
+        if max_otm is None:
+            max_otm = get_param('max percent otm')
+
+        # off unless "max percent otm" is set. The chain request is already limited to it then, but strikes from an
+        # unnarrowed request still need checking
+        if max_otm and self.potm > max_otm:
+            return False
 
         #avg_volume = (self.long.totalVolume + self.short.totalVolume) / 2
 
@@ -411,41 +736,165 @@ class VertSpread:
         return False
 
     def to_dict(self):
-        spread: dict = dict(zip(self.field_names, self.details()))
-
-        return spread
+        # a new dict every time. Callers add their own keys (cdc, elastic) and the spreads are shared by every output
+        return dict(zip(self.field_names, self.details()))
 
     def to_json(self):
         spread = self.to_dict()
         return json.dumps(spread)
 
+    @staticmethod
+    def apply_rules(rule_set: RuleSet, candidates: list, date, instrument, model_pop: bool = False,
+                    screened: bool = False) -> list:
+        """
+        The candidates on one expiration that the user's rules accept (see spread_rules). Accepted spreads are
+        simulated like they are without rules, and scored by the rules when they have a score. screened candidates
+        already passed RuleSet.screen
+        """
+        simulated = []
+
+        def simulate(spreads):
+            model = expiration_model(date, instrument.last, surface=instrument.volatility)
+            if model:
+                for spread in spreads:
+                    spread.simulate(model, model_pop)
+
+            simulated.append(True)
+
+        # rules on the Monte Carlo columns have the survivors of the cheaper rules simulated first
+        accepted = rule_set.accept(candidates, prepare=simulate, screened=screened)
+        if accepted and not simulated:
+            simulate(accepted)
+
+        for spread, score in zip(accepted, rule_set.scores(accepted)):
+            spread.score = round(score, 2)
+
+        return accepted
+
+
+# what user rules can use for the credit spreads. See rules.py and spread_rules()
+RULE_COLUMNS = {
+    "net_credit": Column(attrgetter('net_credit')),
+    "profit": Column(attrgetter('profit')),
+    "risk": Column(attrgetter('risk')),
+    "rr": Column(attrgetter('rr')),
+    "pop": Column(attrgetter('pop')),
+    "potm": Column(attrgetter('potm')),
+    "total_spread": Column(attrgetter('total_spread')),
+    "strike_spread": Column(attrgetter('strike_spread')),
+    "dte": Column(attrgetter('short.daysToExpiration')),
+    "last": Column(attrgetter('instrument.last')),
+    "short_strike": Column(attrgetter('short.strikePrice')),
+    "long_strike": Column(attrgetter('long.strikePrice')),
+    "short_bid_ask": Column(attrgetter('short.spread')),
+    "long_bid_ask": Column(attrgetter('long.spread')),
+    "short_volume": Column(attrgetter('short.totalVolume')),
+    "long_volume": Column(attrgetter('long.totalVolume')),
+    "short_oi": Column(attrgetter('short.openInterest')),
+    "long_oi": Column(attrgetter('long.openInterest')),
+    "short_delta": Column(attrgetter('short.delta')),
+    "long_delta": Column(attrgetter('long.delta')),
+    "short_iv": Column(lambda spread: spread.short.volatility if valid_iv(spread.short) else None, nullable=True),
+    "atm_iv": Column(lambda spread: spread.instrument.volatility.atm(spread.short.daysToExpiration)
+                     if spread.instrument.volatility else None, cost=2, nullable=True),
+    "iv_skew": Column(lambda spread: spread.instrument.volatility.expiration_skew(spread.short.daysToExpiration)
+                      if spread.instrument.volatility else None, cost=2, nullable=True),
+    "iv_percentile": Column(lambda spread: spread.instrument.volatility.iv_percentile
+                            if spread.instrument.volatility else None, cost=2, nullable=True),
+    "days_since_touch": Column(lambda spread: spread.instrument.strike_history(
+        spread.short.putCall, spread.short.strikePrice, spread.short.daysToExpiration)[0], cost=3, nullable=True),
+    "touch_percent": Column(lambda spread: spread.instrument.strike_history(
+        spread.short.putCall, spread.short.strikePrice, spread.short.daysToExpiration)[1], cost=3, nullable=True),
+    "max_move": Column(lambda spread: spread.instrument.strike_history(
+        spread.short.putCall, spread.short.strikePrice, spread.short.daysToExpiration)[2], cost=3, nullable=True),
+    "beta": Column(attrgetter('instrument.beta'), nullable=True),
+    "mc_pop": Column(attrgetter('mc_pop'), cost=10, nullable=True, prepared=True),
+    "expected_pnl": Column(attrgetter('expected_pnl'), cost=10, nullable=True, prepared=True),
+    "max_loss_prob": Column(attrgetter('max_loss_prob'), cost=10, nullable=True, prepared=True),
+}
+
+RULE_FUNCTIONS = {
+    "abs": abs,
+    "min": min,
+    "max": max,
+    "sqrt": sqrt,
+    "rr_model": VertSpread._model_rr,
+    "pop_model": VertSpread._model_pop,
+}
+
+# pairs built before the cheap rules are run on them, so with rules an expiration's pairs aren't all held at once
+RULE_BATCH_SIZE = 1000
+
+# parsed rule sets by their source, so each one is only compiled once per process
+_rule_sets = {}
+
+
+def spread_rules():
+    """
+    The RuleSet for credit spreads from the "rules" parameter, or the json file named by "rules file" (see
+    rules.example.json). None when neither is set, and VertSpread.acceptable and _calculate_score are used instead
+    """
+    spec = get_param('rules')
+    path = get_param('rules file')
+
+    if not spec and path:
+        with open(path) as rules_file:
+            spec = json.load(rules_file)
+
+    if not spec:
+        return None
+
+    max_otm = get_param('max percent otm')
+    constants = {
+        "acceptable_risk": VertSpread.acceptable_risk(),
+        "max_otm": max_otm if max_otm else float('inf'),
+    }
+
+    key = json.dumps([spec, constants], sort_keys=True)
+    if key not in _rule_sets:
+        names = dict(RULE_FUNCTIONS, **constants)
+        _rule_sets[key] = RuleSet(spec.get('accept', []), spec.get('score'), RULE_COLUMNS, names)
+        logger.info("Using spread rules: %s" % _rule_sets[key])
+
+    return _rule_sets[key]
+
 class PutCreditSpread(VertSpread):
+    __slots__ = ()
+
+    type = "PCS"
+    assumption = "Bullish"
 
     def __init__(self, *args, **kwargs):
 
         super(PutCreditSpread, self).__init__(*args, **kwargs)
-        self.type = "PCS"
-        self.assumption = "Bullish"
         self.strike_spread = round(self.short.strikePrice - self.long.strikePrice, 3)
 
         self.analyze()
 
-        self.setup_field_names()
-
     @staticmethod
     def analyze_trades(instrument, exp_dates: list) -> dict:
         spreads = {}
         spread_count = 0
+        acceptable_risk = VertSpread.acceptable_risk()
+        max_otm = get_param('max percent otm')
+        model_pop = get_param('pop model') == 'monte carlo'
+        rule_set = spread_rules()
+
         for date in exp_dates:
             spreads[date] = []
+            candidates = []
+            batch = []
+
+            # one set of simulated prices per expiration, shared by every spread on it. Only built once a spread
+            # on the expiration is accepted
+            model = None
 
             # group all the strikes into overlapping pairs of 2
             # and don't get the last one
             # ex: [1, 2, 3] would turn into [[1, 2], [2, 3]]
-            grouped_spreads = list(combinations(date.puts, 2))
-            spread_count += len(grouped_spreads)
-
-            for raw_spread in grouped_spreads:
+            # combinations is iterated lazily so the pairs are never all held in memory at once
+            for raw_spread in combinations(date.puts, 2):
+                spread_count += 1
 
                 # we're looking at all combinations of strikes so we don't know which
                 # order the long and short leg will be in
@@ -458,41 +907,72 @@ class PutCreditSpread(VertSpread):
                     long_leg = raw_spread[0]
 
                 # validate that these aren't the same option. APIs be weird sometimes
-                if short_leg.description == long_leg.description:
+                if short_leg.symbol == long_leg.symbol:
                     continue
 
                 put_spread = PutCreditSpread(instrument, short_leg, long_leg)
 
-                if put_spread.acceptable():
+                # with user rules the cheap rules are run on each batch of pairs and only the survivors are kept.
+                # The rest of the rules and the scores are run on those once the expiration is done
+                if rule_set is not None:
+                    batch.append(put_spread)
+                    if len(batch) >= RULE_BATCH_SIZE:
+                        candidates.extend(rule_set.screen(batch))
+                        batch = []
+                    continue
+
+                if put_spread.acceptable(acceptable_risk, max_otm):
+                    if model is None:
+                        model = expiration_model(date, instrument.last, surface=instrument.volatility) or False
+
+                    if model:
+                        put_spread.simulate(model, model_pop)
+
                     spreads[date].append(put_spread)
 
+            if rule_set is not None:
+                candidates.extend(rule_set.screen(batch))
+                spreads[date] = VertSpread.apply_rules(rule_set, candidates, date, instrument, model_pop,
+                                                       screened=True)
+
         logger.info("Analyzed %s spreads for %s" % (spread_count, instrument.symbol))
         return spreads
 
 
 class CallCreditSpread(VertSpread):
+    __slots__ = ()
+
+    type = "CCS"
+    assumption = "Bearish"
 
     def __init__(self, *args, **kwargs):
         super(CallCreditSpread, self).__init__(*args, **kwargs)
 
-        self.type = "CCS"
-        self.assumption = "Bearish"
         self.strike_spread = round(self.long.strikePrice - self.short.strikePrice, 3)
         self.analyze()
-        self.setup_field_names()
 
     @staticmethod
     def analyze_trades(instrument, exp_dates: list) -> dict:
         spreads = {}
+        acceptable_risk = VertSpread.acceptable_risk()
+        max_otm = get_param('max percent otm')
+        model_pop = get_param('pop model') == 'monte carlo'
+        rule_set = spread_rules()
+
         for date in exp_dates:
             spreads[date] = []
+            candidates = []
+            batch = []
+
+            # one set of simulated prices per expiration, shared by every spread on it. Only built once a spread
+            # on the expiration is accepted
+            model = None
 
             # group all the strikes into overlapping pairs of 2
             # and don't get the last one
             # ex: [1, 2, 3] would turn into [[1, 2], [2, 3]]
-
-            grouped_spreads = list(combinations(date.calls, 2))
-            for raw_spread in grouped_spreads:
+            # combinations is iterated lazily so the pairs are never all held in memory at once
+            for raw_spread in combinations(date.calls, 2):
 
                 # we're looking at all combinations of strikes so we don't know which
                 # order the long and short leg will be in
@@ -504,34 +984,250 @@ class CallCreditSpread(VertSpread):
                     long_leg = raw_spread[0]
 
                 # validate that these aren't the same option. APIs be weird sometimes
-                if short_leg.description == long_leg.description:
+                if short_leg.symbol == long_leg.symbol:
                     continue
 
                 call_spread = CallCreditSpread(instrument, short_leg, long_leg)
 
-                if call_spread.acceptable():
+                # with user rules the cheap rules are run on each batch of pairs and only the survivors are kept.
+                # The rest of the rules and the scores are run on those once the expiration is done
+                if rule_set is not None:
+                    batch.append(call_spread)
+                    if len(batch) >= RULE_BATCH_SIZE:
+                        candidates.extend(rule_set.screen(batch))
+                        batch = []
+                    continue
+
+                if call_spread.acceptable(acceptable_risk, max_otm):
+                    if model is None:
+                        model = expiration_model(date, instrument.last, surface=instrument.volatility) or False
+
+                    if model:
+                        call_spread.simulate(model, model_pop)
+
                     spreads[date].append(call_spread)
 
+            if rule_set is not None:
+                candidates.extend(rule_set.screen(batch))
+                spreads[date] = VertSpread.apply_rules(rule_set, candidates, date, instrument, model_pop,
+                                                       screened=True)
+
+        return spreads
+
+
+class TimeSpread(VertSpread):
+    """
+    Sells an option and buys a later expiration of the same type. Calendars buy the same strike, diagonals buy a strike
+    further out of the money. These are usually debits and make their money while the short leg decays, so they're
+    priced at the front expiration: what the long leg is worth (Black-Scholes at its own IV) less what the short leg
+    owes, for prices across the simulated distribution of the front expiration
+    """
+    __slots__ = ()
+
+    kind = None
+
+    # price points used to estimate POP and expected P&L. The long leg has to be priced at each one
+    outcomes = 41
+
+    def __init__(self, *args, **kwargs):
+        super(TimeSpread, self).__init__(*args, **kwargs)
+
+        self.strike_spread = round(abs(self.short.strikePrice - self.long.strikePrice), 3)
+        self.analyze()
+
+    @property
+    def type(self) -> str:
+        # PCAL, CCAL, PDIAG, CDIAG
+        return self.short.putCall[0] + self.kind
+
+    @property
+    def assumption(self) -> str:
+        if self.kind == "CAL":
+            return "Neutral"
+
+        return "Bullish" if self.short.putCall == 'PUT' else "Bearish"
+
+    def analyze(self) -> None:
+        self.net_credit = self._calculate_credit()
+
+        # the long leg could still be worth something when the short one is assigned, so this is the worst case
+        self.risk = round((self.strike_spread - self.net_credit) * 100, 2)
+
+        self.potm = abs(round(100 - ((self.short.strikePrice / self.instrument.last) * 100), 2))
+        self.total_spread = round(self.short.spread + self.long.spread, 5)
+
+        # needs the simulated prices. Filled in by simulate() once the spread has been accepted
+        self.profit = 0
+        self.rr = -1
+        self.pop = 0
+        self.score = 0
+
+    def value_at(self, price: float, years: float, iv: float) -> float:
+        """
+        What the spread is worth per share at the front expiration if the underlying is at price
+        """
+        put_call = self.short.putCall
+        short_strike = self.short.strikePrice
+
+        if put_call == 'PUT':
+            short_value = max(short_strike - price, 0)
+        else:
+            short_value = max(price - short_strike, 0)
+
+        return option_value(put_call, price, self.long.strikePrice, years, iv) - short_value + self.net_credit
+
+    def simulate(self, model, model_pop=False) -> None:
+        """
+        model is the montecarlo.TerminalPrices of the front (short) expiration. There's no delta POP to fall back
+        on for these, so the simulated POP is always the one scored
+        """
+        years = (self.long.daysToExpiration - self.short.daysToExpiration) / 365
+        iv = self.long.volatility if valid_iv(self.long) else model.iv
+
+        # best case is the underlying sitting right on the short strike
+        self.profit = round(self.value_at(self.short.strikePrice, years, iv) * 100, 2)
+        if self.profit <= 0 or self.risk <= 0:
+            return
+
+        self.rr = round((self.profit / self.risk) * 100, 2)
+
+        outcomes = [self.value_at(price, years, iv) for price in model.quantiles(self.outcomes)]
+        max_loss = -self.risk / 100 + 0.01
+
+        self.mc_pop = round(sum(1 for outcome in outcomes if outcome > 0) / len(outcomes) * 100, 2)
+        self.expected_pnl = round(sum(outcomes) / len(outcomes) * 100, 2)
+        self.max_loss_prob = round(sum(1 for outcome in outcomes if outcome <= max_loss) / len(outcomes) * 100, 2)
+
+        self.pop = self.mc_pop
+        self.score = self._calculate_score(self.rr, self.pop, self.potm, self.total_spread)
+
+    def _calculate_score(self, rr, pop, potm, ba_spread):
+        """
+        Same reward/risk and POP models as the verticals. No bonus for % OTM since these make the most near the money
+        """
+        score = self._model_rr(rr) * self._model_pop(pop)
+        score = score - (score * ba_spread)
+
+        return round(score, 2)
+
+    def acceptable(self, acceptable_risk=None, max_otm=None):
+        if acceptable_risk is None:
+            acceptable_risk = self.acceptable_risk()
+
+        if max_otm is None:
+            max_otm = get_param('max percent otm')
+
+        if max_otm and self.potm > max_otm:
+            return False
+
+        # debits are fine here. The risk just has to be real and within budget
+        if 0 < self.risk <= acceptable_risk:
+            if self.total_spread > 0:
+                if self.short.totalVolume > 100 and self.long.totalVolume > 100:
+                    if self.long.openInterest > 1000 and self.short.openInterest > 1000:
+                        return True
+        return False
+
+    @staticmethod
+    def analyze_trades(instrument, exp_dates: list) -> dict:
+        """
+        Calendars and diagonals keyed by the short leg's expiration. Long legs are looked up in the chain's strike
+        index, up to "max diagonal strikes" strikes further out of the money than the short leg
+        """
+        spreads = {}
+        spread_count = 0
+        acceptable_risk = VertSpread.acceptable_risk()
+        max_otm = get_param('max percent otm')
+        diagonal_strikes = get_param('max diagonal strikes') or 0
+
+        index = instrument.chain.strike_index()
+
+        for date in exp_dates:
+            spreads[date] = []
+            model = None
+
+            for short_leg in date.puts + date.calls:
+                put_call = short_leg.putCall
+                strike_prices = instrument.chain.strike_prices(put_call)
+                position = bisect_left(strike_prices, short_leg.strikePrice)
+
+                # further out of the money is down for puts and up for calls
+                if put_call == 'PUT':
+                    long_strikes = strike_prices[max(position - diagonal_strikes, 0):position + 1]
+                else:
+                    long_strikes = strike_prices[position:position + diagonal_strikes + 1]
+
+                for long_strike in long_strikes:
+                    spread_type = CalendarSpread if long_strike == short_leg.strikePrice else DiagonalSpread
+
+                    for long_leg in index.get((put_call, long_strike), ()):
+                        if long_leg.daysToExpiration <= short_leg.daysToExpiration:
+                            continue
+
+                        spread_count += 1
+                        time_spread = spread_type(instrument, short_leg, long_leg)
+
+                        if time_spread.acceptable(acceptable_risk, max_otm):
+                            if model is None:
+                                model = expiration_model(date, instrument.last, surface=instrument.volatility) or False
+
+                            if model:
+                                time_spread.simulate(model)
+
+                            spreads[date].append(time_spread)
+
+        logger.info("Analyzed %s calendar and diagonal spreads for %s" % (spread_count, instrument.symbol))
         return spreads
 
 
+class CalendarSpread(TimeSpread):
+    __slots__ = ()
+
+    kind = "CAL"
+
+
+class DiagonalSpread(TimeSpread):
+    __slots__ = ()
+
+    kind = "DIAG"
+
+
 class IronCondor:
     pass
 
 
 class Instrument:
 
-    def __init__(self, client, symbol):
+    def __init__(self, client, symbol, quote=None, chain=None):
+        """
+        quote is an optional TDA quote for the symbol (from get_quotes). Its price is used to narrow the chain request
+        (with "max percent otm" set), even on the symbol's first pull.
+        chain is an already pulled OptionChain to use instead of pulling one (hunterd's restored checkpoint)
+        """
         self.td_client = client
         self.symbol = symbol
-        self.chain = OptionChain(self.td_client, self.symbol)
+
+        if chain is not None:
+            self.chain = chain
+        else:
+            last = quote.get('lastPrice') if quote else None
+            self.chain = OptionChain.shared(self.td_client, self.symbol, last=last)
+
+        # daily bars from the local store (see history.py). None with "price history" off
+        self.history, benchmark = symbol_history(self.td_client, self.symbol)
+        self.beta = self.history.beta(benchmark) if self.history else None
+        self._strike_history = {}
 
         self.quote = self.chain.underlying
+        self.volatility = None
         if self.quote:
             self.last = self.quote['last']
             self.low = self.quote['lowPrice']
             self.high = self.quote['highPrice']
 
+            # built once per chain and shared by every spread. See volatility.py
+            self.volatility = IVSurface.for_chain(self.chain, self.last)
+
     def __str__(self):
         return self.symbol
 
@@ -541,6 +1237,22 @@ class Instrument:
     def strike_dict(self):
         return self.chain.expirations_to_dicts()
 
+    def strike_history(self, put_call: str, strike: float, days: int):
+        """
+        (days since touch, historical touch %, max move %) of a short strike. The same short strike is in a lot of
+        spreads, so each one is only looked up once
+        """
+        key = (put_call, strike, days)
+        if key not in self._strike_history:
+            if self.history is None or not self.quote:
+                self._strike_history[key] = (None, None, None)
+            else:
+                self._strike_history[key] = (self.history.days_since_touch(put_call, strike),
+                                             self.history.touch_percent(put_call, strike, self.last, days),
+                                             self.history.max_move(put_call, days))
+
+        return self._strike_history[key]
+
     def analyze_CCS(self):
         # note that this search will only be able to filter down raw option dicts
         # NOT VertSpread instances that have been enriched
@@ -556,3 +1268,6 @@ class Instrument:
 
         put_spreads = PutCreditSpread.analyze_trades(self, self.chain.dates)
         return put_spreads
+
+    def analyze_time_spreads(self):
+        return TimeSpread.analyze_trades(self, self.chain.dates)
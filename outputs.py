@@ -0,0 +1,143 @@
+"""
+Background output stage for hunterd.
+
+Writing a cycle's output (chain and quote json, the spread analysis, the portfolio, cdc records) used to happen on
+the main thread, so the next cycle couldn't start pulling chains until every file was flushed. run_raw can instead
+hand each output to an OutputStage and return as soon as the chains are in.
+
+Every sink (strikes, quotes, spreads, ...) has its own writer thread and a bounded queue, so:
+    - sinks run side by side, and each one still writes its cycles in order (cdc depends on that)
+    - a slow sink holds on to at most "output queue size" cycles. Past that, submit() blocks and the scan waits for
+      the writer instead of piling up watchlists in memory
+
+Threads rather than processes: the jobs hold a whole Watchlist, which would have to be pickled over to a process
+every cycle. Chain pulls are spent waiting on TDA and the rate limiter, so they overlap fine with the writers.
+
+Per sink stats: jobs submitted, completed and failed, the backlog, and the latency of each job from submit to done
+(queue wait plus the write itself).
+"""
+import time
+import queue
+import threading
+from utils import get_param, start_logger
+
+logger = start_logger("outputs")
+
+
+class Sink:
+
+    def __init__(self, name: str, queue_size: int):
+        self.name = name
+        self.jobs = queue.Queue(maxsize=queue_size)
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy = False
+
+        self.last_latency = None
+        self.max_latency = 0
+        self.total_latency = 0
+        self.total_write = 0
+
+        self.thread = threading.Thread(target=self._run, name="output-%s" % name, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, args: tuple, kwargs: dict) -> None:
+        self.submitted += 1
+        start = time.monotonic()
+        self.jobs.put((start, func, args, kwargs))
+
+        waited = time.monotonic() - start
+        if waited > 1:
+            logger.warning("Waited %.1fs for the %s writer to make room" % (waited, self.name))
+
+    def _run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+
+            submitted, func, args, kwargs = job
+            self.busy = True
+            started = time.monotonic()
+
+            try:
+                func(*args, **kwargs)
+                self.completed += 1
+            except Exception:
+                # the daemon keeps going. The next cycle writes a fresh copy anyway
+                self.failed += 1
+                logger.exception("%s output failed" % self.name)
+            finally:
+                finished = time.monotonic()
+                self.busy = False
+
+                self.last_latency = finished - submitted
+                self.max_latency = max(self.max_latency, self.last_latency)
+                self.total_latency += self.last_latency
+                self.total_write += finished - started
+
+                self.jobs.task_done()
+
+    @property
+    def backlog(self) -> int:
+        return self.jobs.qsize() + (1 if self.busy else 0)
+
+    def stats(self) -> dict:
+        done = self.completed + self.failed
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "backlog": self.backlog,
+            "last_latency": round(self.last_latency, 3) if self.last_latency is not None else None,
+            "avg_latency": round(self.total_latency / done, 3) if done else None,
+            "max_latency": round(self.max_latency, 3),
+            "avg_write": round(self.total_write / done, 3) if done else None
+        }
+
+
+class OutputStage:
+
+    def __init__(self, queue_size: int = None):
+        if queue_size is None:
+            queue_size = get_param('output queue size') or 2
+
+        self.queue_size = queue_size
+        self.sinks = {}
+
+    def submit(self, sink: str, func, *args, **kwargs) -> None:
+        """
+        Runs func(*args, **kwargs) on sink's writer thread, after everything submitted to the sink before it
+        """
+        if sink not in self.sinks:
+            self.sinks[sink] = Sink(sink, self.queue_size)
+
+        self.sinks[sink].submit(func, args, kwargs)
+
+    def stats(self) -> dict:
+        return {name: sink.stats() for name, sink in self.sinks.items()}
+
+    def report(self) -> None:
+        for name, stats in self.stats().items():
+            logger.info("Output %s: %s done, %s failed, %s queued, latency last %ss avg %ss max %ss" % (
+                name, stats["completed"], stats["failed"], stats["backlog"], stats["last_latency"],
+                stats["avg_latency"], stats["max_latency"]))
+
+    def drain(self) -> None:
+        """
+        Waits for everything submitted so far to be written
+        """
+        for sink in self.sinks.values():
+            sink.jobs.join()
+
+    def close(self) -> None:
+        for sink in self.sinks.values():
+            sink.jobs.put(None)
+
+        for sink in self.sinks.values():
+            sink.thread.join()
+
+        self.report()
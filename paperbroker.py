@@ -0,0 +1,389 @@
+"""
+Paper trading engine behind faketda.py.
+
+Takes vertical spread orders in the same json format as the TDA orders endpoint, keeps every open position in memory
+indexed by its option legs, and marks them to market from chain snapshots. Each position gets the brackets from the
+autotrader notes, both as a percent of the credit received:
+    - stop loss when the loss reaches "paper stop loss pct" (50) percent of the credit. Never past the spread's width
+    - take profit when the gain reaches "paper take profit pct" (70) percent of the credit
+
+Everything is persisted to SQLite in WAL mode, but writes are queued and flushed in batches ("paper write batch
+size" rows, or on flush()) so thousands of orders and mark updates per cycle stay in memory speed. Queued rows are
+never held longer than "paper flush secs", and close() writes whatever is left.
+"""
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from utils import get_param, start_logger
+
+logger = start_logger("paperbroker")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS positions (
+    id INTEGER PRIMARY KEY,
+    underlying TEXT,
+    short_leg TEXT,
+    long_leg TEXT,
+    quantity INTEGER,
+    width REAL,
+    credit REAL,
+    stop_price REAL,
+    target_price REAL,
+    mark REAL,
+    status TEXT,
+    opened TEXT,
+    closed TEXT,
+    close_price REAL,
+    order_json TEXT
+);
+CREATE TABLE IF NOT EXISTS marks (
+    position_id INTEGER,
+    time TEXT,
+    mark REAL
+);
+CREATE INDEX IF NOT EXISTS positions_status ON positions (status);
+"""
+
+
+def parse_option_symbol(symbol: str):
+    """
+    'MSFT_082120P205' -> ('MSFT', 'P', 205.0)
+    """
+    underlying, rest = symbol.split('_')
+    return underlying, rest[6], float(rest[7:])
+
+
+def spread_order(spread, quantity: int = 1) -> dict:
+    """
+    TDA order json to open a vertical credit spread (a VertSpread) at its net credit
+    """
+    return {
+        "orderType": "NET_CREDIT",
+        "session": "NORMAL",
+        "duration": "DAY",
+        "orderStrategyType": "SINGLE",
+        "price": "%.2f" % spread.net_credit,
+        "orderLegCollection": [
+            {"instruction": "SELL_TO_OPEN", "quantity": quantity,
+             "instrument": {"symbol": spread.short.symbol, "assetType": "OPTION"}},
+            {"instruction": "BUY_TO_OPEN", "quantity": quantity,
+             "instrument": {"symbol": spread.long.symbol, "assetType": "OPTION"}}
+        ]
+    }
+
+
+class PaperPosition:
+    __slots__ = ('id', 'underlying', 'short_leg', 'long_leg', 'quantity', 'width', 'credit', 'stop_price',
+                 'target_price', 'mark', 'status', 'opened', 'closed', 'close_price')
+
+    def __init__(self, **fields):
+        for slot in self.__slots__:
+            setattr(self, slot, fields.get(slot))
+
+    def pnl(self, price: float = None) -> float:
+        """
+        Dollar P&L if the spread were closed at price (defaults to the close price, then the latest mark)
+        """
+        if price is None:
+            price = self.close_price if self.close_price is not None else self.mark
+
+        if price is None:
+            return 0
+
+        return round((self.credit - price) * 100 * self.quantity, 2)
+
+    def to_dict(self) -> dict:
+        position = {slot: getattr(self, slot) for slot in self.__slots__}
+        position['pnl'] = self.pnl()
+        return position
+
+
+class PaperBroker:
+
+    def __init__(self, db_path: str = "out-data/paper-trading.db", batch_size: int = None, flush_secs: float = None):
+        if batch_size is None:
+            batch_size = get_param('paper write batch size') or 500
+        if flush_secs is None:
+            flush_secs = get_param('paper flush secs')
+            if flush_secs is None:
+                flush_secs = 5
+
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+        self.stop_loss_pct = get_param('paper stop loss pct') or 50
+        self.take_profit_pct = get_param('paper take profit pct') or 70
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        # flask serves requests on several threads
+        self.lock = threading.RLock()
+
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+        # open positions by id, and the ids of the open positions that use each option as a leg
+        self.positions = {}
+        self.by_leg = {}
+
+        # rows waiting to be written
+        self.pending_inserts = []
+        self.pending_updates = {}
+        self.pending_marks = []
+
+        # flushes the queue flush_secs after its first row, in case nothing comes along to fill the batch
+        self.flush_timer = None
+
+        self.next_id = (self.db.execute("SELECT MAX(id) FROM positions").fetchone()[0] or 0) + 1
+        self.load_open_positions()
+
+    def load_open_positions(self) -> None:
+        columns = [column for column in PaperPosition.__slots__]
+        rows = self.db.execute("SELECT %s FROM positions WHERE status = 'OPEN'" % ", ".join(columns))
+
+        for row in rows:
+            self._index(PaperPosition(**dict(zip(columns, row))))
+
+        logger.info("Loaded %s open paper positions" % len(self.positions))
+
+    def _index(self, position: PaperPosition) -> None:
+        self.positions[position.id] = position
+        self.by_leg.setdefault(position.short_leg, set()).add(position.id)
+        self.by_leg.setdefault(position.long_leg, set()).add(position.id)
+
+    def _unindex(self, position: PaperPosition) -> None:
+        del self.positions[position.id]
+        for leg in (position.short_leg, position.long_leg):
+            ids = self.by_leg.get(leg)
+            if ids:
+                ids.discard(position.id)
+                if not ids:
+                    del self.by_leg[leg]
+
+    def place_order(self, order: dict) -> int:
+        """
+        Opens a vertical credit spread from a TDA order. Returns the new position's id
+        """
+        short_leg = long_leg = None
+        quantity = 1
+        for leg in order['orderLegCollection']:
+            if leg['instruction'] == 'SELL_TO_OPEN':
+                short_leg = leg['instrument']['symbol']
+                quantity = int(leg['quantity'])
+            elif leg['instruction'] == 'BUY_TO_OPEN':
+                long_leg = leg['instrument']['symbol']
+
+        if short_leg is None or long_leg is None:
+            raise ValueError("A vertical spread order needs a SELL_TO_OPEN and a BUY_TO_OPEN leg")
+
+        underlying, put_call, short_strike = parse_option_symbol(short_leg)
+        long_strike = parse_option_symbol(long_leg)[2]
+
+        credit = float(order['price'])
+        width = abs(short_strike - long_strike)
+
+        # brackets. Prices are the cost to close the spread
+        stop_price = round(min(credit * (1 + self.stop_loss_pct / 100), width), 2)
+        target_price = round(credit * (1 - self.take_profit_pct / 100), 2)
+
+        with self.lock:
+            position = PaperPosition(id=self.next_id, underlying=underlying, short_leg=short_leg, long_leg=long_leg,
+                                     quantity=quantity, width=width, credit=credit, stop_price=stop_price,
+                                     target_price=target_price, mark=credit, status='OPEN',
+                                     opened=datetime.now().isoformat())
+            self.next_id += 1
+
+            self._index(position)
+            self.pending_inserts.append((position.id, underlying, short_leg, long_leg, quantity, width, credit,
+                                         stop_price, target_price, credit, 'OPEN', position.opened,
+                                         json.dumps(order)))
+            self._maybe_flush()
+
+        return position.id
+
+    def mark(self, prices: dict) -> list:
+        """
+        Marks every open position with a leg in prices (option symbol -> price) and closes the ones that hit a
+        bracket. Returns the positions closed by this update
+        """
+        now = datetime.now().isoformat()
+        closed = []
+
+        with self.lock:
+            touched = set()
+            for symbol in prices:
+                ids = self.by_leg.get(symbol)
+                if ids:
+                    touched.update(ids)
+
+            for position_id in touched:
+                position = self.positions[position_id]
+                if position.short_leg not in prices or position.long_leg not in prices:
+                    continue
+
+                position.mark = round(prices[position.short_leg] - prices[position.long_leg], 2)
+                self.pending_marks.append((position.id, now, position.mark))
+
+                if position.mark >= position.stop_price:
+                    self._close(position, 'STOPPED', now)
+                    closed.append(position)
+                elif position.mark <= position.target_price:
+                    self._close(position, 'TARGET', now)
+                    closed.append(position)
+                else:
+                    self.pending_updates[position.id] = (position.mark, position.status, None, None, position.id)
+
+            self._maybe_flush()
+
+        if closed:
+            logger.info("Marked %s paper positions, closed %s" % (len(touched), len(closed)))
+
+        return closed
+
+    def mark_strikes(self, strikes: list) -> list:
+        """
+        Marks from a chain snapshot, either OptionStrike objects or the strike dicts in out-data/options-chain
+        """
+        prices = {}
+        for strike in strikes:
+            if isinstance(strike, dict):
+                prices[strike['symbol']] = (strike['bid'] + strike['ask']) / 2
+            else:
+                prices[strike.symbol] = strike.mid
+
+        return self.mark(prices)
+
+    def mark_chain(self, chain) -> list:
+        strikes = []
+        for date in chain.dates:
+            strikes.extend(date.puts)
+            strikes.extend(date.calls)
+
+        return self.mark_strikes(strikes)
+
+    def _close(self, position: PaperPosition, status: str, when: str) -> None:
+        position.status = status
+        position.closed = when
+        position.close_price = position.mark
+
+        self._unindex(position)
+        self.pending_updates[position.id] = (position.mark, status, when, position.close_price, position.id)
+
+        logger.debug("Closed paper position %s %s/%s (%s) for %s" % (position.id, position.short_leg,
+                                                                   position.long_leg, status, position.pnl()))
+
+    def close_position(self, position_id: int, price: float = None) -> PaperPosition:
+        with self.lock:
+            position = self.positions[position_id]
+            if price is not None:
+                position.mark = price
+
+            self._close(position, 'CLOSED', datetime.now().isoformat())
+            self._maybe_flush()
+
+        return position
+
+    def _maybe_flush(self) -> None:
+        pending = len(self.pending_inserts) + len(self.pending_updates) + len(self.pending_marks)
+        if pending >= self.batch_size:
+            self.flush()
+        elif pending and self.flush_timer is None and self.flush_secs:
+            self.flush_timer = threading.Timer(self.flush_secs, self.flush)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def flush(self) -> None:
+        """
+        Writes every queued row in one transaction
+        """
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+            if not (self.pending_inserts or self.pending_updates or self.pending_marks):
+                return
+
+            with self.db:
+                self.db.executemany("INSERT INTO positions (id, underlying, short_leg, long_leg, quantity, width, "
+                                    "credit, stop_price, target_price, mark, status, opened, order_json) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.pending_inserts)
+                self.db.executemany("UPDATE positions SET mark = ?, status = ?, closed = COALESCE(?, closed), "
+                                    "close_price = COALESCE(?, close_price) WHERE id = ?",
+                                    list(self.pending_updates.values()))
+                self.db.executemany("INSERT INTO marks (position_id, time, mark) VALUES (?, ?, ?)",
+                                    self.pending_marks)
+
+            self.pending_inserts = []
+            self.pending_updates = {}
+            self.pending_marks = []
+
+    def open_positions(self) -> list:
+        with self.lock:
+            return list(self.positions.values())
+
+    def orders(self, account_id: str = None, order_id: int = None) -> list:
+        """
+        Placed orders in the shape of TDA's get orders response. Paper orders fill as soon as they're placed, so
+        every order is FILLED. A bracket exit isn't listed as an order of its own. It shows up as the order's
+        closeTime and in the position (see open_positions/summary)
+        """
+        with self.lock:
+            self.flush()
+
+            query = "SELECT id, order_json, opened, closed, quantity FROM positions"
+            params = ()
+            if order_id is not None:
+                query += " WHERE id = ?"
+                params = (order_id,)
+
+            rows = self.db.execute(query + " ORDER BY id", params).fetchall()
+
+        orders = []
+        for position_id, order_json, opened, closed, quantity in rows:
+            order = json.loads(order_json)
+            order.update({
+                "orderId": position_id,
+                "accountId": account_id,
+                "status": "FILLED",
+                "enteredTime": opened,
+                "quantity": quantity,
+                "filledQuantity": quantity,
+                "remainingQuantity": 0,
+                "cancelable": False,
+                "editable": False
+            })
+
+            if closed:
+                order["closeTime"] = closed
+
+            orders.append(order)
+
+        return orders
+
+    def summary(self) -> dict:
+        with self.lock:
+            self.flush()
+            realized = self.db.execute("SELECT COALESCE(SUM((credit - close_price) * 100 * quantity), 0), COUNT(*) "
+                                       "FROM positions WHERE status != 'OPEN'").fetchone()
+
+            return {
+                "open": len(self.positions),
+                "closed": realized[1],
+                "realized_pnl": round(realized[0], 2),
+                "unrealized_pnl": round(sum(position.pnl() for position in self.positions.values()), 2)
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            if self.db is None:
+                return
+
+            self.flush()
+            self.db.close()
+            self.db = None
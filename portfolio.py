@@ -0,0 +1,110 @@
+"""
+Picks the set of accepted spreads to actually trade.
+
+This is a knapsack problem: maximize the total score of the picked spreads while their total max loss stays within
+"max total risk", with at most "max spreads per symbol" on one underlying, at most "max spreads per expiration" on
+one expiration date, and no option used as a leg in two picked spreads.
+
+Solving it exactly doesn't scale to tens of thousands of candidates, so two greedy fills are run and the better one
+is kept: one by score per dollar of risk and one by raw score. Taking the better of the two is the standard greedy
+bound for knapsack (never worse than half the optimum without the caps). It is usually within a few percent, and the
+fractional knapsack upper bound is logged so the gap is visible. Both fills are a sort and a single pass.
+"""
+from utils import get_param, start_logger
+
+logger = start_logger("portfolio")
+
+
+def select_portfolio(spreads: list, max_total_risk: float = None, max_per_symbol: int = None,
+                     max_per_expiration: int = None) -> list:
+    """
+    :param spreads: VertSpread instances. Anything with a score of 0 or less is ignored
+    :return: the picked spreads, best score per dollar of risk first
+    """
+    if max_total_risk is None:
+        max_total_risk = get_param('max total risk')
+    if max_per_symbol is None:
+        max_per_symbol = get_param('max spreads per symbol')
+    if max_per_expiration is None:
+        max_per_expiration = get_param('max spreads per expiration')
+
+    candidates = [spread for spread in spreads if spread.score > 0 and 0 < spread.risk <= max_total_risk]
+    if not candidates:
+        return []
+
+    by_density = sorted(candidates, key=lambda spread: spread.score / spread.risk, reverse=True)
+    by_score = sorted(candidates, key=lambda spread: spread.score, reverse=True)
+
+    min_risk = min(spread.risk for spread in candidates)
+
+    picks = [_fill(ordered, max_total_risk, max_per_symbol, max_per_expiration, min_risk)
+             for ordered in (by_density, by_score)]
+    portfolio = max(picks, key=_total_score)
+
+    bound = _fractional_bound(by_density, max_total_risk)
+    total_score = _total_score(portfolio)
+    total_risk = sum(spread.risk for spread in portfolio)
+
+    logger.info("Picked %s of %s spreads. Score %.2f (upper bound %.2f), risk %.2f of %.2f" % (
+        len(portfolio), len(candidates), total_score, bound, total_risk, max_total_risk))
+
+    portfolio.sort(key=lambda spread: spread.score / spread.risk, reverse=True)
+    return portfolio
+
+
+def _total_score(spreads: list) -> float:
+    return sum(spread.score for spread in spreads)
+
+
+def _fill(ordered: list, max_total_risk: float, max_per_symbol: int, max_per_expiration: int, min_risk: float) -> list:
+    picked = []
+    remaining = max_total_risk
+    symbol_counts = {}
+    expiration_counts = {}
+    used_legs = set()
+
+    for spread in ordered:
+        # nothing else can fit
+        if remaining < min_risk:
+            break
+
+        if spread.risk > remaining:
+            continue
+
+        symbol = spread.instrument.symbol
+        if max_per_symbol and symbol_counts.get(symbol, 0) >= max_per_symbol:
+            continue
+
+        expiration = spread.expiration
+        if max_per_expiration and expiration_counts.get(expiration, 0) >= max_per_expiration:
+            continue
+
+        if spread.short.symbol in used_legs or spread.long.symbol in used_legs:
+            continue
+
+        picked.append(spread)
+        remaining -= spread.risk
+        symbol_counts[symbol] = symbol_counts.get(symbol, 0) + 1
+        expiration_counts[expiration] = expiration_counts.get(expiration, 0) + 1
+        used_legs.add(spread.short.symbol)
+        used_legs.add(spread.long.symbol)
+
+    return picked
+
+
+def _fractional_bound(by_density: list, max_total_risk: float) -> float:
+    """
+    Best possible total score if spreads could be bought in fractions and the caps didn't exist. Nothing can beat it
+    """
+    bound = 0
+    remaining = max_total_risk
+
+    for spread in by_density:
+        if spread.risk >= remaining:
+            bound += spread.score * (remaining / spread.risk)
+            break
+
+        bound += spread.score
+        remaining -= spread.risk
+
+    return bound
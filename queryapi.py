@@ -0,0 +1,335 @@
+"""
+HTTP api over the latest accepted spreads, so results can be queried without opening the newest json or excel file.
+
+    python3 optionhunter.py query-api --port 5001
+
+    GET /spreads    filtered, sorted and paged spreads. Every parameter is optional:
+                        symbol=MSFT,AAPL  type=PCS  expiration=Sep 18 2020   (comma separated lists)
+                        min_score=5  max_score  min_pop=70  max_pop
+                        sort=Score (any column)  order=desc|asc  offset=0  limit=50 (at most 1000)
+    GET /symbols    accepted spread count per symbol
+    GET /status     where the loaded spreads came from and when
+
+Spreads are loaded from the newest file in out-data/options-analyzed, or with "output mode" cdc by replaying
+out-data/options-cdc from its latest snapshot. Each load builds a new SpreadIndex off to the side and then replaces
+the served one in a single assignment. A request grabs the index once and only reads from it, so it always sees one
+complete scan even while the next one is being loaded. The writers in raw.py rename finished files into place, so
+a half written file is never picked up either.
+"""
+import os
+import json
+import time
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from flask import Flask, request, jsonify
+from utils import get_param, start_logger
+
+logger = start_logger("queryapi")
+
+ANALYZED_DIR = "out-data/options-analyzed"
+CDC_DIR = "out-data/options-cdc"
+
+MAX_LIMIT = 1000
+
+app = Flask(__name__)
+_store = None
+
+
+class SpreadIndex:
+    """
+    One scan's accepted spreads (dicts like VertSpread.to_dict) and indexes over them. Never changed once built
+    """
+
+    def __init__(self, spreads: list, source: str = None):
+        self.spreads = spreads
+        self.source = source
+        self.loaded = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+        # positions into self.spreads
+        self.by_symbol = {}
+        self.by_type = {}
+        self.by_expiration = {}
+
+        for position, spread in enumerate(spreads):
+            self.by_symbol.setdefault(spread["Symbol"], []).append(position)
+            self.by_type.setdefault(spread["Type"], []).append(position)
+            self.by_expiration.setdefault(spread["Expiration Date"], []).append(position)
+
+        # positions sorted by score and POP with the sorted values alongside, so a range is two binary searches
+        self.by_score, self.scores = self._ranked("Score")
+        self.by_pop, self.pops = self._ranked("POP")
+
+    def __len__(self):
+        return len(self.spreads)
+
+    def _ranked(self, column: str):
+        positions = sorted(range(len(self.spreads)), key=lambda position: self.spreads[position][column] or 0)
+        return positions, [self.spreads[position][column] or 0 for position in positions]
+
+    @staticmethod
+    def _between(positions: list, values: list, low: float = None, high: float = None) -> list:
+        start = bisect_left(values, low) if low is not None else 0
+        end = bisect_right(values, high) if high is not None else len(values)
+        return positions[start:end]
+
+    def query(self, symbols: list = None, types: list = None, expirations: list = None, min_score: float = None,
+              max_score: float = None, min_pop: float = None, max_pop: float = None, sort: str = "Score",
+              descending: bool = True, offset: int = 0, limit: int = 50):
+        """
+        :return: (number of matching spreads, the requested page of them)
+        """
+        candidates = []
+
+        for index, keys in ((self.by_symbol, symbols), (self.by_type, types), (self.by_expiration, expirations)):
+            if keys:
+                candidates.append([position for key in keys for position in index.get(key, ())])
+
+        if min_score is not None or max_score is not None:
+            candidates.append(self._between(self.by_score, self.scores, min_score, max_score))
+
+        if min_pop is not None or max_pop is not None:
+            candidates.append(self._between(self.by_pop, self.pops, min_pop, max_pop))
+
+        if candidates:
+            # walk the smallest candidate list and check the rest with sets
+            candidates.sort(key=len)
+            others = [set(positions) for positions in candidates[1:]]
+            matches = [position for position in candidates[0] if all(position in other for other in others)]
+        else:
+            matches = range(len(self.spreads))
+
+        if sort == "Score":
+            ranked = self.by_score
+        elif sort == "POP":
+            ranked = self.by_pop
+        else:
+            ranked = None
+
+        if ranked is not None:
+            # already in order. Just keep the ranked positions that matched
+            if len(matches) < len(ranked):
+                matched = set(matches)
+                ordered = [position for position in ranked if position in matched]
+            else:
+                ordered = list(ranked)
+
+            if descending:
+                ordered.reverse()
+        else:
+            ordered = sorted(matches, key=lambda position: _sort_value(self.spreads[position].get(sort)),
+                             reverse=descending)
+
+        page = [self.spreads[position] for position in ordered[offset:offset + limit]]
+        return len(ordered), page
+
+    def symbol_counts(self) -> dict:
+        return {symbol: len(positions) for symbol, positions in self.by_symbol.items()}
+
+
+def _sort_value(value):
+    # None (columns that weren't simulated) sorts before any number. Strings sort after
+    if value is None:
+        return (0, 0)
+    if isinstance(value, str):
+        return (2, value)
+
+    return (1, value)
+
+
+class SpreadStore:
+    """
+    Holds the SpreadIndex being served and loads new scans as they're written
+    """
+
+    def __init__(self, mode: str = None):
+        if mode is None:
+            mode = get_param('output mode')
+
+        self.mode = mode
+        self.index = SpreadIndex([])
+
+        # what the served index was built from, so unchanged output isn't reloaded
+        self.source = None
+
+        # cdc replay state: the last run applied and every spread it left, by key
+        self.cdc_run = None
+        self.cdc_spreads = {}
+
+    def refresh(self) -> bool:
+        """
+        Loads the latest scan if there's a new one. True if the served index changed
+        """
+        if self.mode == 'cdc':
+            index = self._load_cdc()
+        else:
+            index = self._load_analyzed()
+
+        if index is None:
+            return False
+
+        # the swap. Requests already running keep the index they grabbed
+        self.index = index
+        logger.info("Serving %s spreads from %s" % (len(index), index.source))
+        return True
+
+    def _load_analyzed(self):
+        if not os.path.isdir(ANALYZED_DIR):
+            return None
+
+        paths = [os.path.join(ANALYZED_DIR, name) for name in os.listdir(ANALYZED_DIR) if name.endswith(".json")]
+        if not paths:
+            return None
+
+        # the file names have 12 hour times in them, so the newest file is found by its modified time
+        latest = max(paths, key=os.path.getmtime)
+        source = (latest, os.path.getmtime(latest))
+        if source == self.source:
+            return None
+
+        with open(latest) as spreads_file:
+            spreads = json.load(spreads_file)
+
+        self.source = source
+        return SpreadIndex(spreads, os.path.basename(latest))
+
+    def _load_cdc(self):
+        if not os.path.isdir(CDC_DIR):
+            return None
+
+        # options-cdc 000042 changes 21 Aug 2020 10-05-00.json -> run 42
+        records = sorted((int(name.split()[1]), name) for name in os.listdir(CDC_DIR) if name.endswith(".json"))
+        if not records:
+            return None
+
+        latest_run = records[-1][0]
+        if latest_run == self.cdc_run:
+            return None
+
+        # keep going from the last applied run when every record since then is there. Otherwise (first load, the
+        # change log was reset, a file is missing) start over from the newest snapshot
+        pending = [(run, name) for run, name in records if self.cdc_run is not None and run > self.cdc_run]
+        runs = [run for run, name in pending]
+        if self.cdc_run is None or latest_run < self.cdc_run or runs != list(range(self.cdc_run + 1, latest_run + 1)):
+            snapshots = [(run, name) for run, name in records if " snapshot " in name]
+            if not snapshots:
+                return None
+
+            start = snapshots[-1][0]
+            pending = [(run, name) for run, name in records if run >= start]
+            self.cdc_spreads = {}
+
+        for run, name in pending:
+            with open(os.path.join(CDC_DIR, name)) as record_file:
+                record = json.load(record_file)
+
+            if record["snapshot"]:
+                self.cdc_spreads = {spread["Key"]: spread for spread in record["spreads"]}
+                continue
+
+            for spread in record["inserts"] + record["updates"]:
+                self.cdc_spreads[spread["Key"]] = spread
+
+            for key in record["removals"]:
+                self.cdc_spreads.pop(key, None)
+
+        self.cdc_run = latest_run
+        return SpreadIndex(list(self.cdc_spreads.values()), pending[-1][1])
+
+    def start_refresher(self, poll: float = None) -> threading.Thread:
+        if poll is None:
+            poll = get_param('query api poll secs') or 5
+
+        def refresh_loop():
+            while True:
+                try:
+                    self.refresh()
+                except Exception:
+                    # a bad file shouldn't stop the api. The last good index keeps being served
+                    logger.exception("Couldn't load the latest spreads")
+
+                time.sleep(poll)
+
+        thread = threading.Thread(target=refresh_loop, name="query-api-refresh", daemon=True)
+        thread.start()
+        return thread
+
+
+def get_store() -> SpreadStore:
+    global _store
+    if _store is None:
+        _store = SpreadStore()
+        _store.refresh()
+
+    return _store
+
+
+def _list_arg(name: str):
+    value = request.args.get(name)
+    if not value:
+        return None
+
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def _number_arg(name: str, cast=float, default=None):
+    value = request.args.get(name)
+    if value is None or value == "":
+        return default
+
+    try:
+        return cast(value)
+    except ValueError:
+        raise ValueError("%s must be a number, not %r" % (name, value))
+
+
+@app.route('/spreads', methods=['GET'])
+def get_spreads():
+    index = get_store().index
+
+    try:
+        offset = max(_number_arg('offset', int, 0), 0)
+        limit = min(max(_number_arg('limit', int, 50), 0), MAX_LIMIT)
+        filters = {name: _number_arg(name) for name in ('min_score', 'max_score', 'min_pop', 'max_pop')}
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    sort = request.args.get('sort', "Score")
+    if index.spreads and sort not in index.spreads[0]:
+        return jsonify({"error": "Unknown sort column: %s" % sort}), 400
+
+    total, page = index.query(symbols=_list_arg('symbol'), types=_list_arg('type'),
+                              expirations=_list_arg('expiration'), sort=sort,
+                              descending=request.args.get('order', 'desc') != 'asc', offset=offset, limit=limit,
+                              **filters)
+
+    return jsonify({
+        "source": index.source,
+        "loaded": index.loaded,
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "spreads": page
+    })
+
+
+@app.route('/symbols', methods=['GET'])
+def get_symbols():
+    return jsonify(get_store().index.symbol_counts())
+
+
+@app.route('/status', methods=['GET'])
+def get_status():
+    store = get_store()
+    index = store.index
+    return jsonify({"mode": store.mode, "source": index.source, "loaded": index.loaded, "spreads": len(index)})
+
+
+def run_query_api(options):
+    get_store().start_refresher()
+    app.run(host=options.host, port=options.port, threaded=True)
+
+
+if __name__ == '__main__':
+    get_store().start_refresher()
+    app.run(port=5001, threaded=True)
@@ -0,0 +1,200 @@
+"""
+One TDA rate budget shared by every process on the host.
+
+hunterd, the weekly market scan, workers and one off excel runs all use the same consumer key, but each one only
+spaced out its own calls ("api calls per minute"), so two running at once went over TDA's 120 a minute and both got
+throttled. With "rate budget" on, every PooledTDClient call takes a token from a bucket kept in a sqlite file
+("rate budget path") instead:
+
+    - the bucket refills at "rate budget calls per minute" and holds at most "rate budget burst" tokens, so no
+      60 seconds ever see more than the two added together (115 + 5 = TDA's 120)
+    - callers that have to wait queue up in a waiters table, ordered by priority and then arrival. Only the front of
+      the queue can take a token, so the live daemon (LIVE) goes ahead of batch scans (BATCH) whenever both wait
+    - a 429 empties the bucket and pauses everyone for "rate budget penalty secs", instead of every process
+      retrying into the limit on its own
+
+Waiters update their row while they wait, so a process that dies in line is dropped after a few seconds. Every
+thread uses its own sqlite connection. The file has to be on a local disk everyone can see: the same path for every
+process on the host (out-data/ when they all run from the project directory).
+"""
+import os
+import time
+import random
+import sqlite3
+import threading
+from utils import get_param, start_logger
+
+logger = start_logger("ratebudget")
+
+LIVE = 0
+BATCH = 1
+
+# a waiter that hasn't checked in for this long is gone
+STALE_SECS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bucket (
+    id INTEGER PRIMARY KEY,
+    tokens REAL,
+    updated REAL,
+    paused_until REAL
+);
+CREATE TABLE IF NOT EXISTS waiters (
+    id INTEGER PRIMARY KEY,
+    priority INTEGER,
+    pid INTEGER,
+    since REAL,
+    seen REAL
+);
+"""
+
+
+class RateBudget:
+
+    def __init__(self, priority: int = BATCH, path: str = None, calls_per_minute: float = None, burst: int = None,
+                 penalty: float = None):
+        if path is None:
+            path = get_param('rate budget path') or "out-data/rate-budget.db"
+        if calls_per_minute is None:
+            calls_per_minute = get_param('rate budget calls per minute') or 115
+        if burst is None:
+            burst = get_param('rate budget burst') or 5
+        if penalty is None:
+            penalty = get_param('rate budget penalty secs') or 30
+
+        self.priority = priority
+        self.path = path
+        self.rate = calls_per_minute / 60
+        self.burst = burst
+        self.penalty = penalty
+
+        self.local = threading.local()
+
+        # this process' share, for the logs
+        self.calls = 0
+        self.waited = 0
+
+        budget_dir = os.path.dirname(path)
+        if budget_dir:
+            os.makedirs(budget_dir, exist_ok=True)
+
+        db = self._db()
+        db.execute("INSERT OR IGNORE INTO bucket (id, tokens, updated, paused_until) VALUES (1, ?, ?, 0)",
+                   (self.burst, time.time()))
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            # transactions are managed by hand, like workqueue.py, so taking a token holds the write lock
+            db = self.local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+        return db
+
+    def _refill(self, db, now: float):
+        tokens, updated, paused_until = db.execute(
+            "SELECT tokens, updated, paused_until FROM bucket WHERE id = 1").fetchone()
+
+        return min(self.burst, tokens + max(now - updated, 0) * self.rate), paused_until
+
+    def acquire(self) -> float:
+        """
+        Blocks until this process may make one call. Returns how long that took
+        """
+        db = self._db()
+        started = time.time()
+        waiter = None
+
+        while True:
+            now = time.time()
+
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                tokens, paused_until = self._refill(db, now)
+                db.execute("DELETE FROM waiters WHERE seen < ?", (now - STALE_SECS,))
+
+                if waiter is not None:
+                    db.execute("UPDATE waiters SET seen = ? WHERE id = ?", (now, waiter))
+
+                front = db.execute("SELECT id FROM waiters ORDER BY priority, id LIMIT 1").fetchone()
+                our_turn = front is None or front[0] == waiter
+
+                if our_turn and tokens >= 1 and now >= paused_until:
+                    if waiter is not None:
+                        db.execute("DELETE FROM waiters WHERE id = ?", (waiter,))
+                    db.execute("UPDATE bucket SET tokens = ?, updated = ? WHERE id = 1", (tokens - 1, now))
+                    db.execute("COMMIT")
+                    break
+
+                if waiter is None:
+                    waiter = db.execute("INSERT INTO waiters (priority, pid, since, seen) VALUES (?, ?, ?, ?)",
+                                        (self.priority, os.getpid(), now, now)).lastrowid
+
+                    # nobody is in front of a new waiter that's first in line
+                    front = db.execute("SELECT id FROM waiters ORDER BY priority, id LIMIT 1").fetchone()
+                    our_turn = front[0] == waiter
+
+                db.execute("UPDATE bucket SET tokens = ?, updated = ? WHERE id = 1", (tokens, now))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+            # sleep until the next token (or the end of a penalty) when it's our turn, otherwise check back soon.
+            # Never longer than a second so the waiter row stays fresh
+            if our_turn:
+                delay = max(paused_until - now, (1 - tokens) / self.rate, 0.01)
+            else:
+                delay = 0.05
+
+            time.sleep(min(delay, 1) * random.uniform(0.9, 1.1))
+
+        waited = time.time() - started
+        self.calls += 1
+        self.waited += waited
+
+        if waited > 10:
+            logger.info("Waited %.1fs for the shared api budget" % waited)
+
+        return waited
+
+    def penalize(self, seconds: float = None) -> None:
+        """
+        TDA said we're over the limit anyway (429). Nobody on the host calls for seconds
+        """
+        if seconds is None:
+            seconds = self.penalty
+
+        db = self._db()
+        now = time.time()
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("UPDATE bucket SET tokens = 0, updated = ?, paused_until = MAX(paused_until, ?) WHERE id = 1",
+                       (now, now + seconds))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+        logger.warning("TDA rate limit hit. Pausing api calls on this host for %ss" % seconds)
+
+    def stats(self) -> dict:
+        db = self._db()
+        tokens, paused_until = self._refill(db, time.time())
+        waiting = dict(db.execute("SELECT priority, COUNT(*) FROM waiters GROUP BY priority").fetchall())
+
+        return {"calls": self.calls, "waited": round(self.waited, 2), "tokens": round(tokens, 2),
+                "paused": paused_until > time.time(), "waiting": waiting}
+
+    def close(self) -> None:
+        # only this thread's connection. The others go with their threads
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+
+def budget_enabled() -> bool:
+    return bool(get_param('rate budget'))
@@ -1,27 +1,59 @@
 import os
-import logging
-import optparse
-import json
-from utils import get_param, start_logger, define_parser
+from utils import get_param, start_logger, define_parser, write_atomic
 from account import get_watchlist
-from options import VertSpread
+from cdc import SpreadChangeLog
+from chainsnapshots import get_writer
 from datetime import datetime
 
 logger = start_logger("raw")
 
-options, args = define_parser()
+def run_raw(options, td_auth=None, output=None, chains=None, order=None):
+    """
+    output is an optional outputs.OutputStage. With one, the files are written on its writer threads and this
+    returns as soon as the chains are pulled. chains (symbol -> OptionChain) are used instead of pulling those
+    symbols, and order is a sort key for the order the rest are pulled in. Returns the watchlist
+    """
+    # initialize TDA connection (or reuse the caller's) and get the appropriate watchlist
+    watchlist = get_watchlist(options=options, td_auth=td_auth, chains=chains, order=order)
 
-def run_raw():
-    # initialize TDA connection and get the appropriate watchlist
-    watchlist = get_watchlist(options=options)
+    if output is None:
+        write_strikes(watchlist)
+        write_quotes(watchlist)
+        write_analysis(watchlist)
+    else:
+        output.submit("strikes", write_strikes, watchlist)
+        output.submit("quotes", write_quotes, watchlist)
+        output.submit("spreads", write_analysis, watchlist)
+
+    return watchlist
+
+def write_strikes(watchlist):
+    # in delta mode only what changed since the last run is stored, with a full keyframe now and then
+    if get_param('chain snapshot mode') == 'delta':
+        get_writer().write(watchlist.strike_dicts())
+        return
 
     # write all the raw strikes to a json file
     watchlist.write_strikes_json()
+
+def write_quotes(watchlist):
     watchlist.write_quotes()
 
+def write_analysis(watchlist):
     # calculate all PCS and CCS vertical spreads
     spreads = watchlist.get_spreads()
 
+    # the spreads picked to fill the "max total risk" budget
+    write_portfolio(watchlist.get_portfolio())
+
+    # in cdc mode only the spreads that changed since the last run are written, with a full snapshot now and then
+    if get_param('output mode') == 'cdc':
+        write_changes(spreads)
+        return
+
+    write_spreads(spreads)
+
+def write_spreads(spreads):
     # create a directory to store output data
     out_dir = "out-data/options-analyzed/"
     outdir = os.makedirs(out_dir, exist_ok=True)
@@ -32,9 +64,33 @@ def run_raw():
     out_path = os.path.join(out_dir, filename)
 
     # write the analyzed spread data to a file in raw json
-    outfile = open(out_path, 'w')
-    outfile.write(json.dumps(spreads))
-    outfile.close()
+    write_atomic(out_path, spreads)
+
+def write_portfolio(portfolio):
+    out_dir = "out-data/options-portfolio/"
+    os.makedirs(out_dir, exist_ok=True)
+
+    dt = datetime.strftime(datetime.now(), "%d %b %Y %I-%M-%S")
+    filename = "options-portfolio %s.json" % dt
+
+    write_atomic(os.path.join(out_dir, filename), [spread.to_dict() for spread in portfolio])
+
+def write_changes(spreads):
+    change_log = SpreadChangeLog("raw")
+    record = change_log.changes(spreads)
+
+    out_dir = "out-data/options-cdc/"
+    os.makedirs(out_dir, exist_ok=True)
+
+    # the run number keeps the files in order even if the clock is changed
+    dt = datetime.strftime(datetime.now(), "%d %b %Y %I-%M-%S")
+    kind = "snapshot" if record["snapshot"] else "changes"
+    filename = "options-cdc %06d %s %s.json" % (record["run"], kind, dt)
+
+    write_atomic(os.path.join(out_dir, filename), record)
+
+    change_log.save()
 
 if __name__ == "__main__":
-    run_raw()
+    options, args = define_parser()
+    run_raw(options)
@@ -0,0 +1,269 @@
+"""
+User defined acceptance and scoring rules.
+
+Rules are python-like expressions over named columns, e.g. for the credit spreads (see options.RULE_COLUMNS):
+
+    {
+        "accept": ["risk <= acceptable_risk", "net_credit > 0", "short_oi > 1000 and long_oi > 1000"],
+        "score": "rr_model(rr) * pop_model(pop) * (1 + potm / 100) * (1 - total_spread)"
+    }
+
+Each expression is parsed once with ast and checked against a short list of allowed syntax (arithmetic, comparisons,
+and/or/not, if/else and the functions it's given), so a rule can't call into anything else. Top level "and"s are
+split into separate predicates and the predicates are ordered cheapest first (see Column.cost).
+
+Candidates are checked in batches. Only the columns the rules use are pulled out of the candidates, one list per
+column, and each predicate is a single compiled list comprehension over those lists that returns the positions that
+pass. The next predicate only looks at those positions, so an expensive column (like the Monte Carlo POP) is only
+worked out for whatever survived the cheap ones.
+"""
+import ast
+from utils import start_logger
+
+logger = start_logger("rules")
+
+# syntax a rule may use. The number/string nodes changed in 3.8, so whichever exist are allowed
+ALLOWED_NODES = tuple(getattr(ast, name) for name in (
+    'Expression', 'BoolOp', 'And', 'Or', 'UnaryOp', 'Not', 'USub', 'UAdd', 'BinOp', 'Add', 'Sub', 'Mult', 'Div',
+    'FloorDiv', 'Mod', 'Pow', 'Compare', 'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'In', 'NotIn', 'IfExp', 'Call',
+    'Name', 'Load', 'Tuple', 'List', 'Constant', 'Num', 'Str', 'NameConstant') if hasattr(ast, name))
+
+
+class RuleError(ValueError):
+    pass
+
+
+class Column:
+    """
+    A value rules can use. cost orders the predicates (1 is a plain attribute). nullable columns can be None and a
+    candidate with None in a column fails every predicate that uses it. prepared columns are only filled in after the
+    prepare callback given to RuleSet.accept has run on the candidates
+    """
+    __slots__ = ('getter', 'cost', 'nullable', 'prepared')
+
+    def __init__(self, getter, cost: int = 1, nullable: bool = False, prepared: bool = False):
+        self.getter = getter
+        self.cost = cost
+        self.nullable = nullable
+        self.prepared = prepared
+
+
+class Expression:
+    """
+    One compiled rule. evaluate() runs it over every position at once
+    """
+
+    def __init__(self, text: str, tree, columns: dict, score: bool):
+        self.text = text
+        self.names = sorted(set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name)
+                                and node.id in columns))
+        self.cost = sum(columns[name].cost for name in self.names)
+        self.prepared = any(columns[name].prepared for name in self.names)
+
+        # column names become list lookups: risk -> _risk[i]
+        body = _ColumnLookups(self.names).visit(tree.body)
+        checks = [ast.Compare(left=_lookup(name), ops=[ast.IsNot()], comparators=[ast.Constant(value=None)])
+                  for name in self.names if columns[name].nullable]
+
+        position = ast.Name(id='i', ctx=ast.Store())
+        if score:
+            # [<expression> if <no Nones> else 0 for i in positions]
+            if checks:
+                body = ast.IfExp(test=ast.BoolOp(op=ast.And(), values=checks) if len(checks) > 1 else checks[0],
+                                 body=body, orelse=ast.Constant(value=0))
+            comprehension = ast.comprehension(target=position, iter=ast.Name(id='positions', ctx=ast.Load()),
+                                              ifs=[], is_async=0)
+            result = ast.ListComp(elt=body, generators=[comprehension])
+        else:
+            # [i for i in positions if <no Nones> if <expression>]
+            comprehension = ast.comprehension(target=position, iter=ast.Name(id='positions', ctx=ast.Load()),
+                                              ifs=checks + [body], is_async=0)
+            result = ast.ListComp(elt=ast.Name(id='i', ctx=ast.Load()), generators=[comprehension])
+
+        self.code = compile(ast.fix_missing_locations(ast.Expression(body=result)), "<rule %s>" % text, 'eval')
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return self.__str__()
+
+    def evaluate(self, namespace: dict, positions: list) -> list:
+        namespace['positions'] = positions
+        try:
+            return eval(self.code, namespace)
+        except Exception as e:
+            raise RuleError("Rule %r failed: %r" % (self.text, e))
+
+
+class _ColumnLookups(ast.NodeTransformer):
+
+    def __init__(self, names: list):
+        self.names = set(names)
+
+    def visit_Name(self, node):
+        if node.id in self.names:
+            return ast.copy_location(_lookup(node.id), node)
+
+        return node
+
+
+def _lookup(name: str):
+    return ast.Subscript(value=ast.Name(id='_' + name, ctx=ast.Load()),
+                         slice=_index(ast.Name(id='i', ctx=ast.Load())), ctx=ast.Load())
+
+
+def _index(node):
+    # subscripts lost their Index wrapper in 3.9
+    if hasattr(ast, 'Index') and not hasattr(ast, 'unparse'):
+        return ast.Index(value=node)
+
+    return node
+
+
+def parse(text: str, columns: dict, names: dict):
+    """
+    Parses and checks one expression. names are the functions and constants it may use besides the columns
+    """
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError as e:
+        raise RuleError("Can't parse rule %r: %s" % (text, e.msg))
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise RuleError("%s isn't allowed in rule %r" % (type(node).__name__, text))
+
+        if isinstance(node, ast.Name) and node.id not in columns and node.id not in names:
+            raise RuleError("Unknown name %r in rule %r. Known: %s" % (node.id, text, ", ".join(sorted(columns))))
+
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in names or node.keywords:
+                raise RuleError("Only %s can be called in rule %r" % (", ".join(sorted(
+                    name for name, value in names.items() if callable(value))), text))
+
+    return tree
+
+
+class RuleSet:
+
+    def __init__(self, accept: list, score: str = None, columns: dict = None, names: dict = None):
+        """
+        accept is a list of expressions that all have to be true. score is an optional expression that replaces the
+        score of accepted candidates. columns are the Columns the expressions can use, names their functions and
+        constants
+        """
+        self.columns = columns or {}
+        self.names = dict(names or {})
+
+        self.predicates = []
+        for text in accept:
+            tree = parse(text, self.columns, self.names)
+
+            # "a and b" is two predicates, so each half can be ordered by its own cost
+            parts = [tree.body]
+            while any(isinstance(part, ast.BoolOp) and isinstance(part.op, ast.And) for part in parts):
+                split = []
+                for part in parts:
+                    if isinstance(part, ast.BoolOp) and isinstance(part.op, ast.And):
+                        split.extend(part.values)
+                    else:
+                        split.append(part)
+                parts = split
+
+            for part in parts:
+                part_text = text if len(parts) == 1 else _source(text, part)
+                self.predicates.append(Expression(part_text, ast.Expression(body=part), self.columns, score=False))
+
+        # cheapest first. Anything needing prepare() goes after everything that doesn't. sorted() is stable so
+        # predicates of the same cost keep the order they were written in
+        self.predicates.sort(key=lambda predicate: (predicate.prepared, predicate.cost))
+
+        self.score_expression = None
+        if score:
+            self.score_expression = Expression(score, parse(score, self.columns, self.names), self.columns,
+                                               score=True)
+
+    def __str__(self):
+        return " and ".join("(%s)" % predicate for predicate in self.predicates)
+
+    def _namespace(self):
+        namespace = {'__builtins__': {}}
+        namespace.update(self.names)
+        return namespace
+
+    def _fill(self, namespace: dict, candidates: list, names: list, positions: list) -> None:
+        # only the positions still in play are looked up. The rest of the column stays None
+        for name in names:
+            key = '_' + name
+            values = namespace.get(key)
+            if values is None:
+                values = namespace[key] = [None] * len(candidates)
+
+            getter = self.columns[name].getter
+            for position in positions:
+                if values[position] is None:
+                    values[position] = getter(candidates[position])
+
+    def screen(self, candidates: list) -> list:
+        """
+        The candidates that pass every predicate that doesn't need prepare(), in their original order. Cheap enough to
+        run on each batch of candidates as they're built, so only the survivors have to be kept
+        """
+        return self._accept(candidates, [predicate for predicate in self.predicates if not predicate.prepared])
+
+    def accept(self, candidates: list, prepare=None, screened: bool = False) -> list:
+        """
+        The candidates that pass every predicate, in their original order. prepare(list of candidates) is called
+        once, on the survivors, before the first predicate that uses a prepared column. screened candidates already
+        went through screen(), so only the prepared predicates are left
+        """
+        predicates = self.predicates
+        if screened:
+            predicates = [predicate for predicate in predicates if predicate.prepared]
+
+        return self._accept(candidates, predicates, prepare)
+
+    def _accept(self, candidates: list, predicates: list, prepare=None) -> list:
+        namespace = self._namespace()
+        positions = list(range(len(candidates)))
+        prepared = False
+
+        for predicate in predicates:
+            if not positions:
+                break
+
+            if predicate.prepared and not prepared and prepare is not None:
+                prepare([candidates[position] for position in positions])
+                prepared = True
+
+            self._fill(namespace, candidates, predicate.names, positions)
+            positions = predicate.evaluate(namespace, positions)
+
+        return [candidates[position] for position in positions]
+
+    def scores(self, candidates: list) -> list:
+        """
+        The score expression worked out for each candidate. Prepared columns must already be filled in
+        """
+        if self.score_expression is None or not candidates:
+            return []
+
+        namespace = self._namespace()
+        positions = list(range(len(candidates)))
+        self._fill(namespace, candidates, self.score_expression.names, positions)
+
+        return self.score_expression.evaluate(namespace, positions)
+
+    @property
+    def scores_prepared(self) -> bool:
+        return self.score_expression is not None and self.score_expression.prepared
+
+
+def _source(text: str, node) -> str:
+    # the part of the rule a split predicate came from, for error messages
+    lines = text.strip().split('\n')
+    if len(lines) == 1 and hasattr(node, 'end_col_offset'):
+        return lines[0][node.col_offset:node.end_col_offset]
+
+    return "%s (part %s)" % (text.strip(), getattr(node, 'col_offset', '?'))
@@ -0,0 +1,510 @@
+"""
+Soak test of hunterd's cycle against a simulated TDA.
+
+The daemon's problems show up over hours, not in one scan: memory creeping up, scans running past "run frequency mins"
+and writes piling up behind them. This runs hunterd.run_cycle (the same scan and background writes the daemon does)
+over and over against SimulatedTDClient, in a throwaway working directory, and reports:
+
+    - cycle latency percentiles and how many cycles overran "run frequency mins"
+    - api calls per cycle (chains, quotes, price history) and how many were throttled
+    - RSS, logging handlers, threads, open files and live objects after every cycle, and the object types still
+      growing once the writers have caught up (compared to after the first cycle)
+    - the output stage's backlog after every cycle
+
+The market is a few thousand made up symbols whose prices random walk with simulated time, with option chains priced
+off them (Black-Scholes with a skew), so every cycle sees moved quotes and repriced strikes. Chain requests are
+narrowed by strikes, range, type and dates like TDA does. Every call waits latency ms (give or take half) and past
+throttle calls per minute they're held until the window allows another, like TDA making you wait.
+
+Simulated time: each cycle moves the market run frequency minutes on (more if it overran). The idle part of each
+period is slept for 1/speed of its length, so the background writers get less time to catch up than in production.
+A backlog here is a worst case.
+
+    python3 soak.py --symbols 2000 --minutes 390 --latency-ms 20 --throttle 120
+    python3 optionhunter.py soak --symbols 500 --minutes 60
+
+The report is printed and written to soak-report.json in the working directory.
+"""
+import gc
+import os
+import sys
+import json
+import math
+import zlib
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+# the package's modules are imported after changing into the working directory, since they read parameters.txt
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MINUTES_PER_YEAR = 252 * 390
+
+
+class SimulatedMarket:
+
+    def __init__(self, count: int, expirations: int = 4, strikes: int = 20, seed: int = 1):
+        rnd = random.Random(seed)
+        self.random = random.Random(seed + 1)
+
+        self.symbols = ["SIM%04d" % i for i in range(count)]
+        self.prices = {symbol: round(rnd.uniform(15, 600), 2) for symbol in self.symbols}
+        self.vols = {symbol: rnd.uniform(0.15, 0.9) for symbol in self.symbols}
+        self.opens = dict(self.prices)
+
+        self.expirations = expirations
+        self.strikes = strikes
+        self.minutes = 0
+
+        # fridays after today
+        today = datetime.today()
+        first = today + timedelta(days=(4 - today.weekday()) % 7 or 7)
+        self.dates = [first + timedelta(weeks=week) for week in range(expirations)]
+
+    def advance(self, minutes: float) -> None:
+        self.minutes += minutes
+        step = sqrt_years(minutes)
+        for symbol in self.symbols:
+            self.prices[symbol] = round(self.prices[symbol] * math.exp(self.vols[symbol] * step *
+                                                                       self.random.gauss(0, 1)), 2)
+
+    @staticmethod
+    def interval(price: float) -> float:
+        if price < 50:
+            return 1
+        if price < 100:
+            return 2.5
+        if price < 250:
+            return 5
+
+        return 10
+
+    def quote(self, symbol: str) -> dict:
+        price = self.prices[symbol]
+        low, high = sorted((price, self.opens[symbol]))
+        return {"symbol": symbol, "assetType": "EQUITY", "exchangeName": "NYSE", "marginable": True,
+                "securityStatus": "Normal", "lastPrice": price, "last": price, "mark": price,
+                "bid": round(price - 0.01, 2), "ask": round(price + 0.01, 2), "lowPrice": low, "highPrice": high,
+                "openPrice": self.opens[symbol], "totalVolume": 1000000 + int(self.minutes) * 1000}
+
+    def _strike(self, symbol: str, date: datetime, days: int, put_call: str, strike: float) -> dict:
+        price = self.prices[symbol]
+        years = max(days, 0.5) / 365
+        moneyness = math.log(strike / price)
+
+        # more IV on the put side, like most equities
+        iv = self.vols[symbol] * (1 - 0.6 * moneyness + 2 * moneyness * moneyness) * 100
+        value = black_scholes(put_call, price, strike, years, iv)
+
+        sigma = iv / 100 * math.sqrt(years)
+        d1 = (math.log(price / strike) + 0.5 * sigma * sigma) / sigma
+        delta = norm_cdf(d1) - (1 if put_call == 'PUT' else 0)
+        gamma = math.exp(-0.5 * d1 * d1) / math.sqrt(2 * math.pi) / (price * sigma)
+
+        tick = 0.05 if value >= 3 else 0.01
+        bid = max(round(value * 0.97 / tick) * tick, 0)
+        ask = round(value * 1.03 / tick) * tick + tick
+        in_the_money = strike < price if put_call == 'CALL' else strike > price
+
+        # open interest is set overnight and volume only goes up during the day
+        seed = zlib.crc32(("%s %s %s %s" % (symbol, date.day, put_call, strike)).encode()) % 100000
+        open_interest = 500 + seed % 20000
+        volume = int(50 + seed % 3000 * (1 + self.minutes / 390))
+
+        return {
+            "putCall": put_call,
+            "symbol": "%s_%s%s%g" % (symbol, date.strftime("%m%d%y"), put_call[0], strike),
+            "description": "%s %s %g %s" % (symbol, date.strftime("%b %d %Y"), strike, put_call.title()),
+            "exchangeName": "OPR", "bid": round(bid, 2), "ask": round(ask, 2), "last": round(value, 2),
+            "mark": round((bid + ask) / 2, 2), "bidSize": 10, "askSize": 10, "lowPrice": round(bid, 2),
+            "highPrice": round(ask, 2), "openPrice": 0, "closePrice": round(value, 2), "totalVolume": volume,
+            "netChange": 0, "volatility": round(iv, 3), "delta": round(delta, 3), "gamma": round(gamma, 4),
+            "theta": round(-value / max(days, 1) / 2, 3), "vega": round(price * math.sqrt(years) * 0.004, 3),
+            "rho": 0.01, "openInterest": open_interest, "timeValue": round(value, 2),
+            "theoreticalOptionValue": round(value, 2), "theoreticalVolatility": 29.0, "strikePrice": float(strike),
+            "expirationDate": int(date.timestamp() * 1000), "daysToExpiration": days, "expirationType": "R",
+            "multiplier": 100.0, "percentChange": 0, "inTheMoney": in_the_money, "nonStandard": False,
+        }
+
+    def chain(self, params: dict) -> dict:
+        """
+        A chain response for TDA chain request parameters. Honors contractType, strikeCount, range (OTM),
+        fromDate and toDate
+        """
+        symbol = params['symbol']
+        price = self.prices[symbol]
+        interval = self.interval(price)
+        atm = round(price / interval) * interval
+
+        count = params.get('strikeCount') or self.strikes
+        prices = [atm + interval * i for i in range(-min(count, self.strikes), min(count, self.strikes) + 1)]
+        prices = [strike for strike in prices if strike > 0]
+
+        contract_type = params.get('contractType', 'ALL')
+        otm = params.get('range', 'ALL') == 'OTM'
+        today = datetime.today()
+
+        maps = {'putExpDateMap': {}, 'callExpDateMap': {}}
+        contracts = 0
+        for date in self.dates:
+            day = date.strftime("%Y-%m-%d")
+            if (params.get('fromDate') and day < params['fromDate']) or (params.get('toDate') and day > params['toDate']):
+                continue
+
+            days = (date.date() - today.date()).days
+            key = "%s:%s" % (day, days)
+
+            for put_call, exp_map in (('PUT', 'putExpDateMap'), ('CALL', 'callExpDateMap')):
+                if contract_type not in ('ALL', put_call):
+                    continue
+
+                strikes = {}
+                for strike in prices:
+                    if otm and (strike >= price if put_call == 'PUT' else strike <= price):
+                        continue
+                    strikes["%.1f" % strike] = [self._strike(symbol, date, days, put_call, strike)]
+
+                maps[exp_map][key] = strikes
+                contracts += len(strikes)
+
+        quote = self.quote(symbol)
+        chain = {"symbol": symbol, "status": "SUCCESS", "underlying": quote, "strategy": "SINGLE", "interval": 0.0,
+                 "isDelayed": False, "isIndex": False, "interestRate": 0.1, "underlyingPrice": price,
+                 "volatility": self.vols[symbol] * 100, "daysToExpiration": 0.0, "numberOfContracts": contracts}
+        chain.update(maps)
+        return chain
+
+    def history(self, symbol: str, start_day: int, end_day: int) -> list:
+        # daily bars walking back from the open. Same every time for the same symbol
+        rnd = random.Random(symbol)
+        daily = self.vols[symbol] / math.sqrt(252)
+        price = self.opens[symbol]
+
+        candles = []
+        today = (datetime.today().date() - datetime(1970, 1, 1).date()).days
+        for day in range(today - 1, start_day - 1, -1):
+            price /= math.exp(daily * rnd.gauss(0, 1))
+            if day < end_day and (day + 3) % 7 < 5:
+                candles.append({"open": price, "high": price * (1 + daily / 2), "low": price * (1 - daily / 2),
+                                "close": price, "volume": 1000000, "datetime": day * 86400000 + 5 * 3600000})
+
+        candles.reverse()
+        return candles
+
+
+def sqrt_years(minutes: float) -> float:
+    return math.sqrt(minutes / MINUTES_PER_YEAR)
+
+
+def norm_cdf(x: float) -> float:
+    return 0.5 * (1 + math.erf(x / math.sqrt(2)))
+
+
+def black_scholes(put_call: str, price: float, strike: float, years: float, iv: float) -> float:
+    sigma = iv / 100 * math.sqrt(years)
+    d1 = (math.log(price / strike) + 0.5 * sigma * sigma) / sigma
+    d2 = d1 - sigma
+
+    call = price * norm_cdf(d1) - strike * norm_cdf(d2)
+    return call - price + strike if put_call == 'PUT' else call
+
+
+class SimulatedTDClient:
+    """
+    Stands in for td_auth.td_client. Only the calls a local watchlist scan makes are here
+    """
+
+    def __init__(self, market: SimulatedMarket, latency_ms: float = 0, throttle: int = 0):
+        self.market = market
+        self.latency = latency_ms / 1000
+        self.throttle = throttle
+
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.random = random.Random(7)
+        self.calls = Counter()
+        self.throttled = 0
+        self.throttle_wait = 0
+
+    def _call(self, kind: str) -> None:
+        if self.throttle:
+            with self.lock:
+                now = time.monotonic()
+                while self.recent and now - self.recent[0] >= 60:
+                    self.recent.popleft()
+
+                wait = 0
+                if len(self.recent) >= self.throttle:
+                    wait = 60 - (now - self.recent[len(self.recent) - self.throttle])
+                    self.throttled += 1
+                    self.throttle_wait += wait
+
+                self.recent.append(now + wait)
+
+            if wait > 0:
+                time.sleep(wait)
+
+        with self.lock:
+            self.calls[kind] += 1
+            latency = self.latency * self.random.uniform(0.5, 1.5)
+
+        if latency:
+            time.sleep(latency)
+
+    def get_options_chain(self, option_chain):
+        self._call("chains")
+        params = option_chain.query_parameters if hasattr(option_chain, 'query_parameters') else option_chain
+        return self.market.chain(params)
+
+    def get_quotes(self, instruments):
+        self._call("quotes")
+        return {symbol: self.market.quote(symbol) for symbol in instruments if symbol in self.market.prices}
+
+    def get_price_history(self, symbol, period_type=None, period=None, start_date=None, end_date=None,
+                          frequency_type=None, frequency=None, extended_hours=None):
+        self._call("history")
+        if symbol not in self.market.prices:
+            return {"candles": [], "symbol": symbol, "empty": True}
+
+        start, end = int(start_date) // 86400000, int(end_date) // 86400000 + 1
+        return {"candles": self.market.history(symbol, start, end), "symbol": symbol, "empty": False}
+
+    def take_counts(self) -> dict:
+        with self.lock:
+            counts = dict(self.calls)
+            counts["throttled"] = self.throttled
+            counts["throttle_wait"] = round(self.throttle_wait, 2)
+
+            self.calls = Counter()
+            self.throttled = 0
+            self.throttle_wait = 0
+
+        return counts
+
+
+class SimulatedAuth:
+    # what hunterd holds on to instead of a TDAuth
+    def __init__(self, client: SimulatedTDClient):
+        self.td_client = client
+
+    def close(self):
+        pass
+
+
+def rss_mb():
+    # linux only. None anywhere else
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+
+
+def open_files():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def handler_count() -> int:
+    loggers = [logging.getLogger()] + [logger for logger in logging.Logger.manager.loggerDict.values()
+                                       if isinstance(logger, logging.Logger)]
+    return sum(len(logger.handlers) for logger in loggers)
+
+
+def object_counts() -> Counter:
+    gc.collect()
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def percentile(values: list, percent: float):
+    # nearest rank
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    return round(ordered[max(int(math.ceil(percent / 100 * len(ordered))) - 1, 0)], 3)
+
+
+def setup_workdir(workdir: str, market: SimulatedMarket, overrides: dict) -> None:
+    os.makedirs(workdir, exist_ok=True)
+
+    with open(os.path.join(PACKAGE_DIR, "parameters.txt")) as param_file:
+        params = json.load(param_file)
+
+    params.update(overrides)
+    params["test watchlist"] = "soak-watchlist.txt"
+
+    with open(os.path.join(workdir, "parameters.txt"), 'w') as param_file:
+        json.dump(params, param_file, indent=4)
+
+    with open(os.path.join(workdir, "soak-watchlist.txt"), 'w') as watchlist_file:
+        watchlist_file.write("\n".join(market.symbols))
+
+
+def run_soak(options) -> dict:
+    market = SimulatedMarket(options.symbols, options.expirations, options.strikes, options.seed)
+    client = SimulatedTDClient(market, options.latency_ms, options.throttle)
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix="optionhunter-soak-")
+    overrides = {"api calls per minute": options.api_rate}
+    if options.params:
+        overrides.update(json.loads(options.params))
+
+    setup_workdir(workdir, market, overrides)
+    os.chdir(workdir)
+    if PACKAGE_DIR not in sys.path:
+        sys.path.insert(0, PACKAGE_DIR)
+
+    if not options.verbose:
+        logging.disable(logging.INFO)
+
+    from hunterd import run_cycle
+    from outputs import OutputStage
+    from chainregistry import get_registry
+    from utils import get_param
+
+    period = get_param("run frequency mins") or 5
+    cycles = max(int(options.minutes // period), 1)
+    scan_options = argparse.Namespace(local=False, remote=False, test=True)
+
+    auth = SimulatedAuth(client)
+    output = OutputStage()
+
+    print("Soaking %s cycles of %s symbols (%s simulated minutes) in %s" % (cycles, len(market.symbols),
+                                                                            options.minutes, workdir))
+
+    samples = []
+    baseline = None
+    try:
+        for cycle in range(1, cycles + 1):
+            # in production the next cycle is minutes away, well past "chain share secs"
+            get_registry().clear()
+
+            started = time.monotonic()
+            run_cycle(scan_options, auth, output)
+            elapsed = time.monotonic() - started
+
+            overrun = elapsed > period * 60
+            backlog = sum(stats["backlog"] for stats in output.stats().values())
+
+            sample = {"cycle": cycle, "seconds": round(elapsed, 3), "overrun": overrun, "backlog": backlog,
+                      "calls": client.take_counts(), "rss_mb": rss_mb(), "handlers": handler_count(),
+                      "threads": threading.active_count(), "open_files": open_files()}
+
+            # the first cycle loads modules and fills caches, so growth is counted from after it. Its writes are
+            # waited for, and the last cycle's below, so watchlists still queued for the writers don't count
+            if baseline is None:
+                output.drain()
+                baseline = object_counts()
+
+            sample["objects"] = len(gc.get_objects())
+
+            samples.append(sample)
+            print("cycle %3d: %7.2fs%s  rss %s MB  backlog %s  calls %s" % (
+                cycle, elapsed, " OVERRUN" if overrun else "", sample["rss_mb"], backlog,
+                {kind: count for kind, count in sample["calls"].items() if count}))
+
+            simulated = max(period, elapsed / 60)
+            market.advance(simulated)
+
+            idle = (period * 60 - elapsed) / options.speed
+            if idle > 0 and cycle < cycles:
+                time.sleep(idle)
+    finally:
+        output.close()
+        logging.disable(logging.NOTSET)
+
+    growth = object_counts() - baseline
+    report = build_report(samples, growth, period, options, workdir)
+
+    with open(os.path.join(workdir, "soak-report.json"), 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+
+    print_report(report)
+
+    if options.cleanup:
+        os.chdir(PACKAGE_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return report
+
+
+def build_report(samples: list, growth: Counter, period: float, options, workdir: str) -> dict:
+    seconds = [sample["seconds"] for sample in samples]
+    first, last = samples[0], samples[-1]
+
+    calls = Counter()
+    for sample in samples:
+        calls.update({kind: count for kind, count in sample["calls"].items() if kind != "throttle_wait"})
+
+    return {
+        "workdir": workdir,
+        "symbols": options.symbols,
+        "cycles": len(samples),
+        "run_frequency_mins": period,
+        "latency": {"p50": percentile(seconds, 50), "p90": percentile(seconds, 90), "p99": percentile(seconds, 99),
+                    "max": max(seconds), "mean": round(sum(seconds) / len(seconds), 3)},
+        "overruns": sum(1 for sample in samples if sample["overrun"]),
+        "max_backlog": max(sample["backlog"] for sample in samples),
+        "api_calls_per_cycle": {kind: round(count / len(samples), 1) for kind, count in calls.items()},
+        "rss_mb": {"first": first["rss_mb"], "last": last["rss_mb"],
+                   "max": max((sample["rss_mb"] or 0) for sample in samples)},
+        "handlers": {"first": first["handlers"], "last": last["handlers"]},
+        "threads": {"first": first["threads"], "last": last["threads"]},
+        "open_files": {"first": first["open_files"], "last": last["open_files"]},
+        "objects": {"first": first["objects"], "last": last["objects"],
+                    "grew": dict(growth.most_common(15))},
+        "samples": samples
+    }
+
+
+def print_report(report: dict) -> None:
+    latency = report["latency"]
+    print("")
+    print("%s cycles, %s symbols, every %s minutes" % (report["cycles"], report["symbols"],
+                                                      report["run_frequency_mins"]))
+    print("cycle seconds   p50 %s  p90 %s  p99 %s  max %s" % (latency["p50"], latency["p90"], latency["p99"],
+                                                             latency["max"]))
+    print("overruns        %s" % report["overruns"])
+    print("max backlog     %s" % report["max_backlog"])
+    print("calls/cycle     %s" % report["api_calls_per_cycle"])
+    for name in ("rss_mb", "handlers", "threads", "open_files", "objects"):
+        values = report[name]
+        print("%-15s %s -> %s" % (name, values["first"], values["last"]))
+
+    if report["objects"]["grew"]:
+        print("objects left over since cycle 1 (writes drained): %s" % report["objects"]["grew"])
+    print("report: %s" % os.path.join(report["workdir"], "soak-report.json"))
+
+
+def add_soak_options(parser) -> None:
+    parser.add_argument("--symbols", type=int, default=2000)
+    parser.add_argument("--minutes", type=float, default=60, help="simulated minutes to run for")
+    parser.add_argument("--expirations", type=int, default=4)
+    parser.add_argument("--strikes", type=int, default=20, help="strikes each side of the money")
+    parser.add_argument("--latency-ms", dest="latency_ms", type=float, default=20, help="per call")
+    parser.add_argument("--throttle", type=int, default=0, help="calls per minute the simulated TDA allows. 0 = off")
+    parser.add_argument("--api-rate", dest="api_rate", type=int, default=0,
+                        help='"api calls per minute" for the scan. 0 = no client side limit')
+    parser.add_argument("--speed", type=float, default=60, help="how much faster than real time the idle gaps run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--params", default=None, help='json of extra parameters.txt overrides')
+    parser.add_argument("--workdir", default=None, help="defaults to a new temp directory")
+    parser.add_argument("--cleanup", action="store_true", help="delete the working directory afterwards")
+    parser.add_argument('-v', "--verbose", action="store_true", help="keep the scan's info logging")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="soak")
+    add_soak_options(parser)
+    run_soak(parser.parse_args())
@@ -0,0 +1,177 @@
+"""
+Long lived TDA client for processes that call the API all day (hunterd).
+
+td's TDClient opens a new requests.Session for every call, so every call pays for its own TCP and TLS setup, and the
+access token is only refreshed once a call finds it about to expire. PooledTDClient keeps one session with a
+connection pool open for the life of the client, asks for compressed responses, and can refresh the access token on
+a background thread before it expires so no scan has to wait on a token round trip.
+"""
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from td.client import TDClient
+from utils import start_logger
+
+logger = start_logger("transport")
+
+
+def raise_for_status(response):
+    # raise the same errors the td client would so callers only have one set of exceptions to handle
+    from td.exceptions import TknExpError, ExdLmtError, NotNulError, ForbidError, NotFndError, ServerError, GeneralError
+
+    errors = {400: NotNulError, 401: TknExpError, 403: ForbidError, 404: NotFndError, 429: ExdLmtError,
+              500: ServerError, 503: ServerError}
+
+    error = errors.get(response.status_code, GeneralError)
+    raise error(message=response.text)
+
+
+class PooledTDClient(TDClient):
+    # access tokens last 30 minutes. The background refresher swaps them out this many seconds before they expire
+    refresh_margin = 300
+
+    # refresh tokens last 90 days. A new one is only asked for once the current one is this close to expiring
+    refresh_token_margin = 7 * 86400
+
+    def __init__(self, *args, pool_size=10, rate_budget=None, **kwargs):
+        """
+        rate_budget is an optional ratebudget.RateBudget every api call takes a token from first
+        """
+        super(PooledTDClient, self).__init__(*args, **kwargs)
+
+        self.rate_budget = rate_budget
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # chain responses are big and compress very well
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+        self.token_lock = threading.Lock()
+        self._refresher = None
+        self._stop_refresher = threading.Event()
+
+    def token_seconds(self) -> float:
+        return self.state['access_token_expires_at'] - time.time()
+
+    def refresh_token(self, margin: int = None) -> None:
+        """
+        Refreshes the access token if it expires within margin seconds. Safe to call from several threads at once,
+        only one of them will do the refresh
+        """
+        if margin is None:
+            margin = self.refresh_margin
+
+        with self.token_lock:
+            if not self.state['refresh_token'] or self.token_seconds() >= margin:
+                return
+
+            # grab_refresh_token asks for access_type offline, which mints a new 90 day refresh token and rewrites
+            # the credentials file. Only do that when the refresh token is running out, like td's validate_tokens
+            if self.state['refresh_token_expires_at'] - time.time() < self.refresh_token_margin:
+                logger.info("Refreshing refresh token")
+                self.grab_refresh_token()
+            else:
+                logger.info("Refreshing access token")
+                self.grab_access_token()
+
+    def start_refresher(self) -> None:
+        if self._refresher is not None:
+            return
+
+        self._stop_refresher.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, name="tda-token-refresher", daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self) -> None:
+        delay = 0
+        while not self._stop_refresher.wait(delay):
+            try:
+                self.refresh_token()
+                delay = max(self.token_seconds() - self.refresh_margin, 1)
+            except Exception:
+                logger.exception("Background token refresh failed. Trying again in 30s")
+                delay = 30
+
+    def close(self) -> None:
+        self._stop_refresher.set()
+        self._refresher = None
+        self.session.close()
+
+        if self.rate_budget is not None:
+            self.rate_budget.close()
+
+    def _check_throttled(self, response) -> None:
+        # one 429 pauses every process sharing the budget, not just the caller
+        if response.status_code == 429 and self.rate_budget is not None:
+            self.rate_budget.penalize()
+
+    def request_stream(self, endpoint: str, params: dict = None) -> requests.Response:
+        """
+        GET request with the body left unread so it can be streamed. The caller has to close the response
+        """
+        self.refresh_token(margin=60)
+
+        if self.rate_budget is not None:
+            self.rate_budget.acquire()
+
+        response = self.session.get(self._api_endpoint(endpoint=endpoint), headers=self._headers(),
+                                    params=params, stream=True)
+
+        if not response.ok:
+            self._check_throttled(response)
+
+            # the error message is in the body, so it has to be read before the connection goes back to the pool
+            try:
+                response.content
+            finally:
+                response.close()
+
+            raise_for_status(response)
+
+        return response
+
+    def _make_request(self, method: str, endpoint: str, mode: str = None, params: dict = None, data: dict = None,
+                      json: dict = None, order_details: bool = False):
+        """
+        Same contract as TDClient._make_request, sent through the pooled session
+        """
+        if endpoint != self.config['token_endpoint']:
+            # normally does nothing. The background refresher keeps the token well ahead of this
+            self.refresh_token(margin=60)
+
+        headers = self._headers(mode=mode)
+        if endpoint == self.config['token_endpoint']:
+            del headers['Authorization']
+        elif self.rate_budget is not None:
+            # token refreshes don't count against the api limit
+            self.rate_budget.acquire()
+
+        response = self.session.request(method=method.upper(), url=self._api_endpoint(endpoint=endpoint),
+                                        headers=headers, params=params, data=data, json=json)
+
+        if not response.ok:
+            self._check_throttled(response)
+            raise_for_status(response)
+
+        if order_details:
+            location = response.headers.get('Location', '')
+            order_id = location.split('orders/')[1] if 'orders/' in location else ''
+
+            return {
+                'order_id': order_id,
+                'headers': response.headers,
+                'content': response.content,
+                'status_code': response.status_code,
+                'request_body': response.request.body,
+                'request_method': response.request.method
+            }
+
+        # some calls (creating a watchlist) succeed with an empty body
+        if not response.content:
+            return {}
+
+        return response.json()
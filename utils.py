@@ -1,4 +1,6 @@
+import os
 import json
+import time
 import logging
 import optparse
 
@@ -11,30 +13,86 @@ def get_param(param):
     if param in param_data:
         return param_data[param]
 
+class RateLimiter:
+    """
+    Spaces calls out to stay under a calls per minute limit. Only waits for whatever is left of the interval,
+    so time spent doing the work between calls counts towards it
+    """
+
+    def __init__(self, calls_per_minute):
+        self.interval = 60 / calls_per_minute if calls_per_minute else 0
+        self.next_call = 0
+
+    @classmethod
+    def from_params(cls):
+        """
+        The process' own "api calls per minute" limiter. With the host wide "rate budget" on (see ratebudget.py) every
+        call already waits its turn there, so this one doesn't wait at all
+        """
+        if get_param('rate budget'):
+            return cls(0)
+
+        return cls(get_param('api calls per minute'))
+
+    def wait(self):
+        now = time.monotonic()
+        if now < self.next_call:
+            time.sleep(self.next_call - now)
+            now = self.next_call
+
+        self.next_call = now + self.interval
+
+def write_atomic(path, data):
+    """
+    Writes data to path as json through a temp file and a rename, so anything reading the directory (the query api,
+    elastic, people) never sees half a file
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as outfile:
+        outfile.write(json.dumps(data))
+
+    os.replace(tmp_path, path)
+
 def start_logger(name):
     # create logger
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
 
+    # getLogger hands back the same logger for a name, so only the first call gets a handler. Otherwise every
+    # repeat call adds another one and each line is logged (and held on to) once more
+    if logger.handlers:
+        return logger
+
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     ch.setFormatter(formatter)
     logger.addHandler(ch)
-    
+
     return logger
 
-def define_parser():
-    parser = optparse.OptionParser("usage: %prog [-l] [-r] [-t]")
-    parser.add_option('-l', "--local", action="store_true", dest="local", default=False)
-    parser.add_option('-r', "--remote", action="store_true", dest="remote", default=False)
-    parser.add_option('-t', "--test", action="store_true", dest="test", default=False)
-    options, args = parser.parse_args()
+def add_watchlist_options(parser):
+    """
+    Adds the -l/-r/-t watchlist flags to an argparse parser (or subparser)
+    """
+    parser.add_argument('-l', "--local", action="store_true", dest="local", default=False)
+    parser.add_argument('-r', "--remote", action="store_true", dest="remote", default=False)
+    parser.add_argument('-t', "--test", action="store_true", dest="test", default=False)
 
+def check_watchlist_options(parser, options):
     if options.local and options.remote:
         parser.error("You cannot specify a local and remote watchlist.")
 
     if not options.local and not options.remote and not options.test:
         parser.error("You must specify to use a local or remote watchlist with --local (-l) or --remote (-r)")
 
+def define_parser(args=None):
+    parser = optparse.OptionParser("usage: %prog [-l] [-r] [-t]")
+    parser.add_option('-l', "--local", action="store_true", dest="local", default=False)
+    parser.add_option('-r', "--remote", action="store_true", dest="remote", default=False)
+    parser.add_option('-t', "--test", action="store_true", dest="test", default=False)
+    options, args = parser.parse_args(args)
+
+    check_watchlist_options(parser, options)
+
     return options, args
@@ -0,0 +1,261 @@
+"""
+Implied volatility surface of a symbol's chain (strike x days to expiration).
+
+Each OptionStrike has its own IV, but nothing puts them together, so anything that wants the at the money IV,
+the skew or how rich IV is compared to earlier scans would have to dig through the chain for every spread. The
+surface is built once per chain and answers those from precomputed numbers:
+
+    surface = IVSurface.for_chain(chain, last)
+    surface.atm_iv                  30 day at the money IV (interpolated between expirations)
+    surface.skew                    30 day 25 delta put IV minus 25 delta call IV
+    surface.iv_percentile           percent of the 30 day ATM IVs seen in earlier scans that were below this one
+    surface.atm(days)               ATM IV of the expiration days out (an OptionStrike's daysToExpiration)
+    surface.expiration_skew(days)
+    surface.iv(strike, days)        IV anywhere on the surface
+
+Each pull of a chain gets its own surface, and the latest one of each symbol is kept in IVSurface.surfaces for the
+life of the process (a whole hunterd session). Pulling a symbol's chain again only rebuilds the expirations whose IVs
+changed, and adds a point to the symbol's IV history the percentile is taken from. IVs are in percent, like TDA
+sends them.
+"""
+import weakref
+from bisect import bisect_left, insort
+from collections import deque
+from math import sqrt
+from montecarlo import valid_iv
+from utils import get_param, start_logger
+
+logger = start_logger("volatility")
+
+# days of the constant maturity numbers (atm_iv, skew, iv_percentile)
+TARGET_DAYS = 30
+
+
+class IVSlice:
+    """
+    One expiration of the surface. Doesn't depend on the underlying's price, so an unchanged expiration's slice is
+    reused from one pull of the chain to the next
+    """
+    __slots__ = ('expiration', 'days', 'strikes', 'ivs', 'signature', 'skew')
+
+    def __init__(self, date, signature: tuple):
+        self.expiration = date.expiration
+        self.days = (date.puts or date.calls)[0].daysToExpiration
+        self.signature = signature
+
+        # one IV per strike price. Where there's a put and a call on the strike they're averaged
+        by_strike = {}
+        for strike in date.puts + date.calls:
+            if valid_iv(strike):
+                by_strike.setdefault(strike.strikePrice, []).append(strike.volatility)
+
+        self.strikes = sorted(by_strike)
+        self.ivs = [sum(by_strike[price]) / len(by_strike[price]) for price in self.strikes]
+
+        self.skew = self._skew(date)
+
+    def __len__(self):
+        return len(self.strikes)
+
+    @staticmethod
+    def _skew(date):
+        # IV of the put closest to 25 delta less the IV of the call closest to 25 delta
+        wings = []
+        for strikes, target in ((date.puts, -0.25), (date.calls, 0.25)):
+            usable = [strike for strike in strikes if valid_iv(strike) and isinstance(strike.delta, (int, float))
+                      and strike.delta != 0]
+            if not usable:
+                return None
+
+            wings.append(min(usable, key=lambda strike: abs(strike.delta - target)).volatility)
+
+        return round(wings[0] - wings[1], 3)
+
+    def iv(self, price: float):
+        """
+        IV at any strike price. Linear between strikes, flat past the ends
+        """
+        if not self.strikes:
+            return None
+
+        position = bisect_left(self.strikes, price)
+        if position == 0:
+            return self.ivs[0]
+        if position == len(self.strikes):
+            return self.ivs[-1]
+
+        low, high = self.strikes[position - 1], self.strikes[position]
+        weight = (price - low) / (high - low)
+        return self.ivs[position - 1] + weight * (self.ivs[position] - self.ivs[position - 1])
+
+
+class IVHistory:
+    """
+    30 day ATM IVs from earlier scans of a symbol, oldest first, and the same values sorted for the percentile
+    """
+
+    def __init__(self, size: int = None):
+        if size is None:
+            size = get_param('iv history size') or 2000
+
+        self.size = size
+        self.values = deque()
+        self.sorted_values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, iv: float):
+        """
+        Adds iv and returns its percentile against the values before it (None for the first one)
+        """
+        if len(self.values) == self.size:
+            oldest = self.values.popleft()
+            del self.sorted_values[bisect_left(self.sorted_values, oldest)]
+
+        percentile = None
+        if self.sorted_values:
+            percentile = round(bisect_left(self.sorted_values, iv) / len(self.sorted_values) * 100, 1)
+
+        self.values.append(iv)
+        insort(self.sorted_values, iv)
+
+        return percentile
+
+
+class IVSurface:
+    """
+    The surface of one pull of a chain. Never changed once built, so spreads analyzed (or written out on another
+    thread) while the next cycle pulls the symbol again keep seeing their own chain's numbers
+    """
+    # symbol -> latest surface, kept between scans
+    surfaces = {}
+
+    def __init__(self, chain, last: float, previous=None):
+        """
+        previous is the symbol's surface from the last pull. Its unchanged slices and its IV history carry over
+        """
+        self.symbol = chain.symbol
+        self.last = last
+
+        # the chain the surface was built from. Weak so the surface doesn't keep old chains alive. A surface restored
+        # from a checkpoint has no reference, only the time its chain was pulled
+        self._chain = weakref.ref(chain)
+        self.fetched_at = getattr(chain, 'fetched_at', None)
+
+        old_slices = previous.slices if previous is not None else {}
+        rebuilt = 0
+
+        # expiration -> IVSlice
+        self.slices = {}
+        for date in chain.dates:
+            signature = tuple((strike.putCall, strike.strikePrice, strike.volatility, strike.delta)
+                              for strike in date.puts + date.calls)
+
+            old = old_slices.get(date.expiration)
+            if old is not None and old.signature == signature:
+                self.slices[date.expiration] = old
+                continue
+
+            self.slices[date.expiration] = IVSlice(date, signature)
+            rebuilt += 1
+
+        # days to expiration -> ATM IV and skew, and the slices that have an ATM IV in days to expiration order
+        self.atm_ivs = {}
+        self.skews = {}
+        for iv_slice in self.slices.values():
+            iv = iv_slice.iv(last)
+            self.atm_ivs[iv_slice.days] = round(iv, 3) if iv is not None else None
+            self.skews[iv_slice.days] = iv_slice.skew
+
+        self.term = sorted((iv_slice for iv_slice in self.slices.values() if self.atm_ivs[iv_slice.days] is not None),
+                           key=lambda iv_slice: iv_slice.days)
+
+        self.atm_iv = self._constant_maturity(self.atm_ivs)
+        self.skew = self._constant_maturity(self.skews)
+
+        self.history = previous.history if previous is not None else IVHistory()
+        self.iv_percentile = self.history.add(self.atm_iv) if self.atm_iv is not None else None
+
+        logger.debug("%s: rebuilt %s of %s expirations" % (self, rebuilt, len(self.slices)))
+
+    def __str__(self):
+        return "%s IV surface (%s expirations)" % (self.symbol, len(self.term))
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_chain'] = None
+        return state
+
+    def same_chain(self, chain) -> bool:
+        if self._chain is None:
+            return self.fetched_at is not None and self.fetched_at == getattr(chain, 'fetched_at', None)
+
+        return self._chain() is chain
+
+    @classmethod
+    def for_chain(cls, chain, last: float):
+        previous = cls.surfaces.get(chain.symbol)
+
+        # the same chain handed out twice (overlapping watchlists, or restored with its surface) gets the same surface,
+        # and is only one sample
+        if previous is not None and previous.same_chain(chain) and previous.last == last:
+            return previous
+
+        surface = cls.surfaces[chain.symbol] = cls(chain, last, previous)
+        return surface
+
+    def _bracket(self, days: float):
+        """
+        The slices on either side of days, and how far between them days is (0 to 1)
+        """
+        if not self.term:
+            return None, None, 0
+
+        if days <= self.term[0].days:
+            return self.term[0], self.term[0], 0
+        if days >= self.term[-1].days:
+            return self.term[-1], self.term[-1], 0
+
+        position = bisect_left([iv_slice.days for iv_slice in self.term], days)
+        low, high = self.term[position - 1], self.term[position]
+        return low, high, (days - low.days) / (high.days - low.days)
+
+    def _constant_maturity(self, by_days: dict):
+        low, high, weight = self._bracket(TARGET_DAYS)
+        if low is None:
+            return None
+
+        low_value, high_value = by_days[low.days], by_days[high.days]
+        if low_value is None or high_value is None:
+            return low_value if high_value is None else high_value
+
+        return round(low_value + weight * (high_value - low_value), 3)
+
+    def iv(self, price: float, days: float):
+        """
+        IV at any strike and days to expiration. Linear in strike on each expiration and linear in total variance
+        (IV squared times time) between expirations
+        """
+        low, high, weight = self._bracket(days)
+        if low is None:
+            return None
+
+        low_iv, high_iv = low.iv(price), high.iv(price)
+        if low is high or weight == 0:
+            return low_iv
+
+        low_variance = low_iv ** 2 * max(low.days, 0.5)
+        high_variance = high_iv ** 2 * max(high.days, 0.5)
+        variance = low_variance + weight * (high_variance - low_variance)
+
+        return sqrt(max(variance, 0) / max(days, 0.5))
+
+    def atm(self, days: int):
+        return self.atm_ivs.get(days)
+
+    def expiration_skew(self, days: int):
+        return self.skews.get(days)
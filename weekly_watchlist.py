@@ -1,5 +1,5 @@
+import os
 import json
-import requests
 from utils import start_logger
 from account import get_watchlist
 
@@ -7,34 +7,48 @@ logger = start_logger("weekly-watchlist")
 
 headers = {"Accept": "application/json, text/plain, */*", "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36"}
 
-r = requests.get("https://api.nasdaq.com/api/screener/stocks?tableonly=true&limit=25&offset=0&download=true", headers=headers)
+def run_weekly():
+    import requests
 
-symbols = []
+    r = requests.get("https://api.nasdaq.com/api/screener/stocks?tableonly=true&limit=25&offset=0&download=true", headers=headers)
 
-if r.status_code == 200:
-    rows = json.loads(r.content)["data"]["rows"]
-    symbol_count = len(rows)
-    logger.info(f"Processing {symbol_count} symbols")
+    symbols = []
 
-    for row in rows:
-        symbol = row['symbol']
+    if r.status_code == 200:
+        rows = json.loads(r.content)["data"]["rows"]
+        symbol_count = len(rows)
+        logger.info(f"Processing {symbol_count} symbols")
 
-        if "^" not in symbol and "/" not in symbol:
-            symbols.append(symbol)
+        for row in rows:
+            symbol = row['symbol']
 
-else:
-    logger.error(f"Request failed with status: {r.status_code}")
+            if "^" not in symbol and "/" not in symbol:
+                symbols.append(symbol)
 
-with open("all-symbols.txt", "w") as symbols_fle:
-    for symbol in symbols:
-        symbols_fle.write(f"{symbol}\n")
+    else:
+        logger.error(f"Request failed with status: {r.status_code}")
 
-# initialize TDA connection and get the appropriate watchlist
-watchlist = get_watchlist(process_market=True)
+    # the market scan reads this file, so a failed request mustn't empty it. Keep last week's symbols instead
+    if r.status_code == 200 and symbols:
+        tmp_path = "watchlists/all-symbols.txt.tmp"
+        with open(tmp_path, "w") as symbols_fle:
+            for symbol in symbols:
+                symbols_fle.write(f"{symbol}\n")
 
-# calculate all PCS and CCS vertical spreads
-acceptable_symbols = watchlist.get_spreads(find_acceptable=True)
+        os.replace(tmp_path, "watchlists/all-symbols.txt")
+    else:
+        logger.warning("No symbols from nasdaq, scanning last week's watchlists/all-symbols.txt")
 
-with open("watchlists/weekly-watchlist.txt", 'w') as weekly_watchlist:
-    for symbol in acceptable_symbols:
-        weekly_watchlist.write(f"{symbol}\n")
+    # initialize TDA connection. Quotes for every symbol are screened in batches first
+    # and chains are only pulled for the symbols that pass
+    watchlist = get_watchlist(process_market=True)
+
+    # calculate all PCS and CCS vertical spreads
+    acceptable_symbols = watchlist.get_spreads(find_acceptable=True)
+
+    with open("watchlists/weekly-watchlist.txt", 'w') as weekly_watchlist:
+        for symbol in acceptable_symbols:
+            weekly_watchlist.write(f"{symbol}\n")
+
+if __name__ == "__main__":
+    run_weekly()
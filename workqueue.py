@@ -0,0 +1,330 @@
+"""
+Splits a scan across several worker processes (or machines) with a SQLite work queue.
+
+The coordinator puts one job per symbol of the watchlist on the queue and waits. Each worker claims jobs one at a
+time, pulls the symbol's chain with its own TDA connection and "api calls per minute" budget, analyzes it and puts
+the accepted spreads back on the job. Once every job is finished the coordinator merges the results in watchlist
+order, so the merged spreads are the same list Watchlist.get_spreads() would return for a single host scan, and
+writes them out like raw.py does.
+
+    python3 optionhunter.py coordinator -l
+    python3 optionhunter.py worker              (as many as the rate limits allow, anywhere that can see the queue)
+
+The queue is the sqlite file at "work queue path". Workers on other machines need it on a shared disk. SQLite's
+locking over network filesystems is only as good as the filesystem's, so for more than a handful of hosts this
+should be swapped for a real broker, which is why everything goes through the WorkQueue class.
+
+Claimed jobs are leased for "work queue lease secs". A job whose worker died is handed out again once its lease
+runs out, and a job that fails "work queue max attempts" times is given up on and left out of the merge.
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+from utils import get_param, start_logger, RateLimiter
+
+logger = start_logger("workqueue")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    created REAL,
+    total INTEGER
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    scan_id INTEGER,
+    position INTEGER,
+    symbol TEXT,
+    quote TEXT,
+    status TEXT,
+    worker TEXT,
+    leased_until REAL,
+    attempts INTEGER DEFAULT 0,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, leased_until);
+CREATE INDEX IF NOT EXISTS jobs_scan ON jobs (scan_id, position);
+"""
+
+
+class Job:
+
+    def __init__(self, job_id, scan_id, symbol, quote):
+        self.id = job_id
+        self.scan_id = scan_id
+        self.symbol = symbol
+        self.quote = json.loads(quote) if quote else None
+
+    def __str__(self):
+        return "%s (scan %s)" % (self.symbol, self.scan_id)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class WorkQueue:
+
+    def __init__(self, path: str = None, lease_seconds: int = None, max_attempts: int = None):
+        if path is None:
+            path = get_param('work queue path') or "out-data/work-queue.db"
+        if lease_seconds is None:
+            lease_seconds = get_param('work queue lease secs') or 300
+        if max_attempts is None:
+            max_attempts = get_param('work queue max attempts') or 3
+
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        queue_dir = os.path.dirname(path)
+        if queue_dir:
+            os.makedirs(queue_dir, exist_ok=True)
+
+        # transactions are managed by hand so a claim can take the write lock before it looks for a job
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def submit(self, symbols: list, quotes: dict = None) -> int:
+        """
+        Queues one job per symbol. quotes (symbol -> TDA quote) is passed on to the workers to narrow the chain
+        requests. Returns the scan's id
+        """
+        if quotes is None:
+            quotes = {}
+
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self.db.execute("INSERT INTO scans (created, total) VALUES (?, ?)", (time.time(), len(symbols)))
+            scan_id = cursor.lastrowid
+
+            self.db.executemany(
+                "INSERT INTO jobs (scan_id, position, symbol, quote, status) VALUES (?, ?, ?, ?, 'pending')",
+                [(scan_id, position, symbol, json.dumps(quotes[symbol]) if symbol in quotes else None)
+                 for position, symbol in enumerate(symbols)])
+
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+        logger.info("Queued scan %s with %s symbols" % (scan_id, len(symbols)))
+        return scan_id
+
+    def claim(self, worker: str):
+        """
+        Leases the next pending job (or one whose lease ran out) to worker. None when there's nothing to do
+        """
+        now = time.time()
+
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            # a job that keeps killing its worker (OOM, segfault, kill -9) never gets to fail(), so its expired
+            # leases count against its attempts here
+            self.db.execute("UPDATE jobs SET status = 'failed', error = COALESCE(error, 'lease expired') "
+                            "WHERE status = 'running' AND leased_until < ? AND attempts >= ?",
+                            (now, self.max_attempts))
+
+            row = self.db.execute(
+                "SELECT id, scan_id, symbol, quote FROM jobs "
+                "WHERE status = 'pending' OR (status = 'running' AND leased_until < ? AND attempts < ?) "
+                "ORDER BY scan_id, position LIMIT 1", (now, self.max_attempts)).fetchone()
+
+            if row is not None:
+                self.db.execute("UPDATE jobs SET status = 'running', worker = ?, leased_until = ?, "
+                                "attempts = attempts + 1 WHERE id = ?", (worker, now + self.lease_seconds, row[0]))
+
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+
+        return Job(*row)
+
+    def complete(self, job: Job, worker: str, spreads: list) -> bool:
+        """
+        Stores a job's accepted spreads. False if the lease was lost to another worker, whose result wins
+        """
+        cursor = self.db.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL "
+                                 "WHERE id = ? AND worker = ? AND status = 'running'",
+                                 (json.dumps(spreads), job.id, worker))
+
+        return cursor.rowcount == 1
+
+    def fail(self, job: Job, worker: str, error: str) -> None:
+        # back on the queue until it has used up its attempts
+        self.db.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                        "error = ?, leased_until = NULL WHERE id = ? AND worker = ? AND status = 'running'",
+                        (self.max_attempts, error, job.id, worker))
+
+    def progress(self, scan_id: int) -> dict:
+        # expired leases that are out of attempts would otherwise only be failed by the next claim
+        self.db.execute("UPDATE jobs SET status = 'failed', error = COALESCE(error, 'lease expired') "
+                        "WHERE scan_id = ? AND status = 'running' AND leased_until < ? AND attempts >= ?",
+                        (scan_id, time.time(), self.max_attempts))
+
+        rows = self.db.execute("SELECT status, COUNT(*) FROM jobs WHERE scan_id = ? GROUP BY status", (scan_id,))
+        return dict(rows.fetchall())
+
+    def wait(self, scan_id: int, poll: float = 5) -> dict:
+        """
+        Blocks until every job in the scan is done or failed
+        """
+        last = None
+        while True:
+            progress = self.progress(scan_id)
+            outstanding = progress.get('pending', 0) + progress.get('running', 0)
+
+            if progress != last:
+                logger.info("Scan %s: %s" % (scan_id, ", ".join("%s %s" % (count, status)
+                                                                 for status, count in sorted(progress.items()))))
+                last = progress
+
+            if not outstanding:
+                return progress
+
+            time.sleep(poll)
+
+    def results(self, scan_id: int) -> list:
+        """
+        The accepted spreads of every finished job, merged in watchlist order
+        """
+        spreads = []
+        rows = self.db.execute("SELECT symbol, status, result, error FROM jobs WHERE scan_id = ? ORDER BY position",
+                               (scan_id,))
+
+        for symbol, status, result, error in rows:
+            if status != 'done':
+                logger.warning("No spreads for %s, its job %s: %s" % (symbol, status, error))
+                continue
+
+            spreads.extend(json.loads(result))
+
+        return spreads
+
+
+class MergedSpread:
+    """
+    Stands in for a VertSpread when picking the portfolio from merged results. The coordinator only has the spread
+    dicts, so the legs are identified by what's in them
+    """
+
+    class Leg:
+        def __init__(self, symbol):
+            self.symbol = symbol
+
+    def __init__(self, spread: dict):
+        self.spread = spread
+        self.score = spread["Score"]
+        self.risk = spread["Max Loss"]
+        self.expiration = spread["Expiration Date"]
+        self.instrument = self.Leg(spread["Symbol"])
+
+        # P or C from PCS, CCAL, PDIAG, ...
+        put_call = spread["Type"][0]
+        long_expiration = spread.get("L. Expiration Date", self.expiration)
+        self.short = self.Leg("%s %s %s %s" % (spread["Symbol"], self.expiration, spread["S. Strike"], put_call))
+        self.long = self.Leg("%s %s %s %s" % (spread["Symbol"], long_expiration, spread["L. Strike"], put_call))
+
+    def to_dict(self) -> dict:
+        return self.spread
+
+
+def scan_symbol(client, symbol: str, quote: dict = None) -> list:
+    """
+    What a worker does for one job: pull the chain and return the accepted spreads as dicts
+    """
+    from options import Instrument
+    from account import analyze_instrument, accepted_dicts
+
+    instrument = Instrument(client, symbol, quote=quote)
+
+    # same as a watchlist, nothing to analyze without a quote for the underlying
+    if not instrument.quote:
+        return []
+
+    return accepted_dicts(analyze_instrument(instrument))
+
+
+def work(queue: WorkQueue, client, worker: str = None, exit_when_empty: bool = False, poll: float = 5) -> int:
+    """
+    Claims and runs jobs until the queue is empty (exit_when_empty) or forever. Returns the number of jobs done
+    """
+    if worker is None:
+        worker = "%s-%s" % (socket.gethostname(), os.getpid())
+
+    rate_limiter = RateLimiter.from_params()
+    done = 0
+
+    while True:
+        job = queue.claim(worker)
+
+        if job is None:
+            if exit_when_empty:
+                break
+
+            time.sleep(poll)
+            continue
+
+        rate_limiter.wait()
+
+        try:
+            spreads = scan_symbol(client, job.symbol, job.quote)
+        except Exception as e:
+            logger.exception("Job %s failed" % job)
+            queue.fail(job, worker, repr(e))
+            continue
+
+        if queue.complete(job, worker, spreads):
+            done += 1
+            logger.info("%s: %s accepted spreads" % (job, len(spreads)))
+        else:
+            logger.warning("Lost the lease on %s before it finished" % job)
+
+    logger.info("Worker %s finished %s jobs" % (worker, done))
+    return done
+
+
+def run_worker(options):
+    from account import TDAuth
+
+    td_auth = TDAuth(keep_alive=True)
+    queue = WorkQueue()
+
+    try:
+        work(queue, td_auth.td_client, worker=options.worker, exit_when_empty=options.exit_when_empty)
+    finally:
+        queue.close()
+        td_auth.close()
+
+
+def run_coordinator(options):
+    from account import watchlist_symbols
+    from raw import write_spreads, write_changes, write_portfolio
+    from portfolio import select_portfolio
+
+    queue = WorkQueue()
+
+    scan_id = queue.submit(watchlist_symbols(options))
+    queue.wait(scan_id)
+    spreads = queue.results(scan_id)
+    queue.close()
+
+    logger.info("Merged %s accepted spreads from scan %s" % (len(spreads), scan_id))
+
+    # written the same way as a single host raw scan
+    write_portfolio(select_portfolio([MergedSpread(spread) for spread in spreads]))
+
+    if get_param('output mode') == 'cdc':
+        write_changes(spreads)
+    else:
+        write_spreads(spreads)